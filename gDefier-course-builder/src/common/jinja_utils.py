@@ -30,6 +30,22 @@ CAN_USE_JINJA2_TEMPLATE_CACHE = config.ConfigProperty(
     default_value=True)
 
 
+class LocalBytecodeClient(object):
+    """Memcache client for jinja2 that also keeps bytecode in instance memory.
+
+    jinja2 keys bytecode by a hash of the template name and file name and
+    stores the checksum of the template source with it. A cached value that
+    does not match the current source is detected on load, then compiled
+    again and replaced, so no explicit invalidation is needed.
+    """
+
+    def get(self, key):
+        return models.MemcacheManager.get(key, local=True)
+
+    def set(self, key, value, timeout=models.DEFAULT_CACHE_TTL_SECS):
+        models.MemcacheManager.set(key, value, ttl=timeout, local=True)
+
+
 def finalize(x):
     """A finalize method which will correctly handle safe_dom elements."""
     if isinstance(x, safe_dom.Node) or isinstance(x, safe_dom.NodeList):
@@ -76,7 +92,7 @@ def create_jinja_environment(loader, locale=None):
     if CAN_USE_JINJA2_TEMPLATE_CACHE.value:
         prefix = 'jinja2:bytecode:%s:/' % models.MemcacheManager.get_namespace()
         cache = jinja2.MemcachedBytecodeCache(
-            models.MemcacheManager, timeout=models.DEFAULT_CACHE_TTL_SECS,
+            LocalBytecodeClient(), timeout=models.DEFAULT_CACHE_TTL_SECS,
             prefix=prefix)
 
     jinja_environment = jinja2.Environment(
@@ -63,6 +63,16 @@ class BaseTag(object):
         """Lists the inputEx modules required by the editor."""
         return []
 
+    @classmethod
+    def prefetch(cls, unused_nodes, unused_handler):
+        """Loads whatever all nodes of this tag in a page need at once.
+
+        Called before any of the nodes is rendered, with the list of all the
+        nodes of this tag, so a tag can batch the datastore and memcache reads
+        its render() would otherwise do one node at a time.
+        """
+        pass
+
     def render(self, unused_node, unused_handler):
         """Receive a node and return a node."""
         return cElementTree.XML('<div>[Unimplemented custom tag]</div>')
@@ -292,6 +302,17 @@ def html_to_safe_dom(html_string, handler):
     if root.text:
         node_list.append(safe_dom.Text(root.text))
 
+    nodes_by_tag = {}
+    for elt in root.iter():
+        if elt.tag in tag_bindings:
+            nodes_by_tag.setdefault(elt.tag, []).append(elt)
+    for tag_name, nodes in nodes_by_tag.iteritems():
+        try:
+            tag_bindings[tag_name].prefetch(nodes, handler)
+        except Exception as e:  # pylint: disable-msg=broad-except
+            # Each node loads what it needs on its own when rendered.
+            logging.error('Failed to prefetch tag %s: %s', tag_name, e)
+
     used_instance_ids = set([])
     for elt in root:
         node_list.append(_process_html_tree(elt, used_instance_ids))
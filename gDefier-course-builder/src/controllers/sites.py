@@ -104,6 +104,9 @@ not hosting multiple courses, your course will run in a default namespace
 Good luck!
 """
 
+import cStringIO
+import gzip
+import hashlib
 import logging
 import mimetypes
 import os
@@ -121,8 +124,10 @@ from models.config import ConfigPropertyEntity
 from models.config import Registry
 from models.counters import PerfCounter
 from models.courses import Course
+from models.models import MemcacheManager
 from models.roles import Roles
 from models.vfs import AbstractFileSystem
+from models.vfs import ChunkedFileStream
 from models.vfs import DatastoreBackedFileSystem
 from models.vfs import LocalReadOnlyFileSystem
 import webapp2
@@ -163,6 +168,14 @@ SITE_TYPE_COURSE = 'course'
 DEFAULT_CACHE_CONTROL_MAX_AGE = 600
 DEFAULT_CACHE_CONTROL_PUBLIC = 'public'
 
+# static text resources of these sizes are served gzip-compressed to clients
+# accepting it; the compressed bytes are cached in memcache
+GZIP_MIN_BYTES = 1024
+GZIP_MAX_BYTES = 900 * 1024
+GZIP_CONTENT_TYPES = [
+    'application/javascript', 'application/json', 'application/x-javascript',
+    'application/xml', 'image/svg+xml']
+
 # default HTTP headers for dynamic responses
 DEFAULT_EXPIRY_DATE = 'Mon, 01 Jan 1990 00:00:00 GMT'
 DEFAULT_PRAGMA = 'no-cache'
@@ -186,6 +199,12 @@ ZIP_HANDLER_COUNT = PerfCounter(
 NO_HANDLER_COUNT = PerfCounter(
     'gcb-sites-handler-none',
     'A number of times request was not matched to any handler.')
+STATIC_NOT_MODIFIED_COUNT = PerfCounter(
+    'gcb-sites-static-not-modified',
+    'A number of times a static resource was not sent as the client had it.')
+STATIC_GZIP_COUNT = PerfCounter(
+    'gcb-sites-static-gzip',
+    'A number of times a static resource was sent gzip-compressed.')
 
 HTTP_BYTES_IN = PerfCounter(
     'gcb-sites-bytes-in',
@@ -484,6 +503,180 @@ def set_static_resource_cache_control(handler):
     handler.response.cache_control.max_age = DEFAULT_CACHE_CONTROL_MAX_AGE
 
 
+def make_etag(*parts):
+    """Makes a strong, quoted entity tag of the given parts."""
+    return '"%s"' % '-'.join([str(part) for part in parts])
+
+
+def is_not_modified(request, etags, last_modified=None):
+    """Checks if a client already has the current version of a resource.
+
+    Args:
+        request: webapp2.Request. The request of the client.
+        etags: list of strings. Entity tags of the current version.
+        last_modified: datetime. The time of the last change, if known.
+
+    Returns:
+        True if a 304 Not Modified can be sent instead of the resource.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        for etag in if_none_match.split(','):
+            etag = etag.strip()
+            if etag.startswith('W/'):
+                etag = etag[len('W/'):]
+            if etag == '*' or etag in etags:
+                return True
+        return False
+
+    since = request.if_modified_since
+    if since and last_modified:
+        # HTTP dates have no fractions of a second.
+        return last_modified.replace(microsecond=0) <= since.replace(
+            tzinfo=None)
+    return False
+
+
+def parse_range(header, size):
+    """Parses a single 'bytes=' Range header of a resource of given size.
+
+    Args:
+        header: string. The value of the Range header, if any.
+        size: int. The size of the resource in bytes.
+
+    Returns:
+        A (start, end) tuple with end excluded, or None if the whole
+        resource must be served: no, malformed or multiple ranges.
+
+    Raises:
+        ValueError: if the range starts after the end of the resource.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, unused_dash, last = header[len('bytes='):].strip().partition('-')
+    if not first and not last:
+        return None
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # A suffix range, like 'bytes=-500', is the last bytes.
+        if not int(last):
+            raise ValueError('Empty suffix range.')
+        return max(size - int(last), 0), size
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if end <= start:
+        return None
+    if start >= size:
+        raise ValueError('Range starts after the end of the resource.')
+    return start, min(end, size)
+
+
+def _is_compressible(content_type):
+    content_type = content_type.split(';')[0].strip()
+    return (content_type.startswith('text/') or
+            content_type in GZIP_CONTENT_TYPES)
+
+
+def _accepts_gzip(request):
+    for encoding in request.headers.get('Accept-Encoding', '').split(','):
+        name, unused_semicolon, params = encoding.partition(';')
+        if name.strip() == 'gzip':
+            return params.replace(' ', '') not in ['q=0', 'q=0.0']
+    return False
+
+
+def _get_gzipped(etag, size, read_range):
+    """Returns gzip-compressed bytes of a resource, cached by its etag."""
+    key = 'sites:gzip:%s' % etag
+    data = MemcacheManager.get(key)
+    if data is None:
+        buf = cStringIO.StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+        for chunk in read_range(0, size):
+            gzip_file.write(chunk)
+        gzip_file.close()
+        data = buf.getvalue()
+        MemcacheManager.set(key, data)
+    return data
+
+
+def serve_static_resource(handler, size, read_range, etag, last_modified=None):
+    """Writes a static resource answering conditional and range requests.
+
+    Text resources are sent gzip-compressed to clients accepting it.
+
+    Args:
+        handler: webapp2.RequestHandler. The handler serving the resource;
+            its Content-Type and caching headers must already be set.
+        size: int. The size of the resource in bytes.
+        read_range: callable(start, end). Returns an iterable of the bytes of
+            the resource from start up to, but excluding, end.
+        etag: string. A strong entity tag of the content, see make_etag().
+        last_modified: datetime. The time of the last change, if known.
+    """
+    # A compressed copy is another representation, so it has its own tag.
+    gzip_etag = '%s-gzip"' % etag[:-1]
+    compressible = _is_compressible(
+        handler.response.headers.get('Content-Type', ''))
+    if compressible:
+        handler.response.headers['Vary'] = 'Accept-Encoding'
+    if last_modified:
+        handler.response.last_modified = last_modified
+    handler.response.headers['ETag'] = etag
+    handler.response.headers['Accept-Ranges'] = 'bytes'
+
+    if is_not_modified(handler.request, [etag, gzip_etag], last_modified):
+        STATIC_NOT_MODIFIED_COUNT.inc()
+        handler.response.set_status(304)
+        # There is no content to describe.
+        del handler.response.headers['Content-Type']
+        return
+
+    # Send the range only if the client has the current version of the rest.
+    byte_range = None
+    if_range = handler.request.headers.get('If-Range')
+    if not if_range or if_range == etag:
+        try:
+            byte_range = parse_range(handler.request.headers.get('Range'), size)
+        except ValueError:
+            handler.response.headers['Content-Range'] = 'bytes */%s' % size
+            handler.error(416)
+            return
+
+    if byte_range:
+        start, end = byte_range
+        handler.response.set_status(206)
+        handler.response.headers['Content-Range'] = 'bytes %s-%s/%s' % (
+            start, end - 1, size)
+    elif (compressible and GZIP_MIN_BYTES <= size <= GZIP_MAX_BYTES and
+          _accepts_gzip(handler.request)):
+        STATIC_GZIP_COUNT.inc()
+        handler.response.headers['ETag'] = gzip_etag
+        handler.response.headers['Content-Encoding'] = 'gzip'
+        handler.response.write(_get_gzipped(etag, size, read_range))
+        return
+    else:
+        start, end = 0, size
+    for data in read_range(start, end):
+        handler.response.write(data)
+
+
+def open_zip_file(zipfile_cache, zipfilename):
+    """Returns a cached zipfile.ZipFile, or None if it can't be opened."""
+    zipfile_object = zipfile_cache.get(zipfilename)
+    if zipfile_object is None:
+        try:
+            zipfile_object = zipfile.ZipFile(zipfilename)
+        except (IOError, RuntimeError, zipfile.BadZipfile), err:
+            # If the zipfile can't be opened, that's probably a
+            # configuration error in the app, so it's logged as an error.
+            logging.error('Can\'t open zipfile %s: %s', zipfilename, err)
+            zipfile_object = ''  # Special value to cache negative results.
+        zipfile_cache[zipfilename] = zipfile_object
+    return zipfile_object or None
+
+
 def set_default_response_headers(handler):
     """Sets the default headers for outgoing responses."""
 
@@ -528,13 +721,40 @@ def make_zip_handler(zipfilename):
                 return
 
             ZIP_HANDLER_COUNT.inc()
-            self.ServeFromZipFile(zipfilename, path)
+            self.serve_from_zip_file(zipfilename, path)
             count_stats(self)
 
         def SetCachingHeaders(self):  # pylint: disable=C6409
             """Properly controls caching."""
             set_static_resource_cache_control(self)
 
+        def serve_from_zip_file(self, zipfilename, name):
+            """Serves a file of a zip file; tagged with its CRC and size."""
+            zipfile_object = open_zip_file(self.zipfile_cache, zipfilename)
+            info = None
+            if zipfile_object:
+                try:
+                    info = zipfile_object.getinfo(name)
+                except KeyError:
+                    pass
+            if not info:
+                self.error(404)
+                self.response.out.write('Not found')
+                return
+
+            content_type = mimetypes.guess_type(name)[0]
+            if content_type:
+                self.response.headers['Content-Type'] = content_type
+            self.SetCachingHeaders()
+
+            def read_range(start, end):
+                return [zipfile_object.read(name)[start:end]]
+
+            serve_static_resource(
+                self, info.file_size, read_range,
+                make_etag('zip', '%08x' % (info.CRC & 0xffffffff),
+                          info.file_size))
+
     return CustomZipHandler
 
 
@@ -556,16 +776,7 @@ class CssComboZipHandler(zipserve.ZipHandler):
 
     def serve_from_zip_file(self, zipfilename, static_file_handler):
         """Assemble the download by reading file from zip file."""
-        zipfile_object = self.zipfile_cache.get(zipfilename)
-        if zipfile_object is None:
-            try:
-                zipfile_object = zipfile.ZipFile(zipfilename)
-            except (IOError, RuntimeError, zipfile.BadZipfile), err:
-                # If the zipfile can't be opened, that's probably a
-                # configuration error in the app, so it's logged as an error.
-                logging.error('Can\'t open zipfile %s: %s', zipfilename, err)
-                zipfile_object = ''  # Special value to cache negative results.
-            self.zipfile_cache[zipfilename] = zipfile_object
+        zipfile_object = open_zip_file(self.zipfile_cache, zipfilename)
         if not zipfile_object:
             self.error(404)
             return
@@ -581,16 +792,28 @@ class CssComboZipHandler(zipserve.ZipHandler):
 
         self.SetCachingHeaders()
 
+        # The tag covers the CRCs of the files and how they are combined.
+        versions = [static_file_handler]
+        contents = []
         for name in self.request.GET:
             try:
                 content = zipfile_object.read(name)
                 if content_type == 'text/css':
                     content = self._fix_css_paths(
                         name, content, static_file_handler)
-                self.response.out.write(content)
+                if isinstance(content, unicode):
+                    content = content.encode('utf-8')
+                contents.append(content)
+                versions.append('%s:%08x' % (
+                    name, zipfile_object.getinfo(name).CRC & 0xffffffff))
             except (KeyError, RuntimeError), err:
                 logging.error('Not found %s in %s', name, zipfilename)
 
+        content = ''.join(contents)
+        serve_static_resource(
+            self, len(content), lambda start, end: [content[start:end]],
+            make_etag('combo', hashlib.md5('\n'.join(versions)).hexdigest()))
+
     def _fix_css_paths(self, path, css, static_file_handler):
         """Transform relative url() settings in CSS to absolute.
 
@@ -663,7 +886,22 @@ class AssetHandler(webapp2.RequestHandler):
         set_static_resource_cache_control(self)
         self.response.headers['Content-Type'] = self.get_mime_type(
             self.filename)
-        self.response.write(stream.read())
+
+        # Files stored as blobs are tagged with the hash of their content and
+        # only the chunks needed are read; others are hashed when served.
+        metadata = getattr(stream, 'metadata', None)
+        if isinstance(stream, ChunkedFileStream):
+            size = stream.size
+            read_range = stream.iter_chunks
+            etag = make_etag(metadata.blob_hash)
+        else:
+            data = stream.read()
+            size = len(data)
+            read_range = lambda start, end: [data[start:end]]
+            etag = make_etag('md5', hashlib.md5(data).hexdigest())
+        serve_static_resource(
+            self, size, read_range, etag,
+            last_modified=getattr(metadata, 'updated_on', None))
 
 
 class ApplicationContext(object):
@@ -19,9 +19,12 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 import copy
 from datetime import datetime
 import logging
+import math
 import os
 import pickle
+import random
 import sys
+import time
 
 import appengine_config
 from common.schema_fields import FieldRegistry
@@ -54,6 +57,26 @@ SUPPORTED_ASSESSMENT_MODEL_VERSIONS = frozenset(
 # Example: '2013-03-21 13:00'
 ISO_8601_DATE_FORMAT = '%Y-%m-%d %H:%M'
 
+# The amount of time a cached course model is fresh for.
+CACHED_OBJECT_TTL_SECS = models.DEFAULT_CACHE_TTL_SECS
+
+# The amount of time a cached course model can still be served after it went
+# stale, while another request is rebuilding it.
+CACHED_OBJECT_STALE_TTL_SECS = 60 * 5
+
+# The longest time one request may spend rebuilding a course model before
+# another one can take over.
+CACHED_OBJECT_LEASE_SECS = 30
+
+# The longest time a request waits for another one to rebuild a course model
+# when there is no stale copy to serve, and how often it checks.
+CACHED_OBJECT_WAIT_SECS = 5
+CACHED_OBJECT_WAIT_POLL_SECS = 0.1
+
+# Scales how early a fresh course model may be rebuilt; values above 1 favor
+# rebuilding earlier.
+CACHED_OBJECT_EARLY_REFRESH_BETA = 1.0
+
 
 def deep_dict_merge(real_values_dict, default_values_dict):
     """Merges default and real value dictionaries recursively."""
@@ -335,16 +358,20 @@ class AbstractCachedObject(object):
         raise Exception('Not implemented')
 
     @classmethod
-    def load(cls, app_context):
-        """Loads instance from memcache; does not fail on errors."""
+    def _load_envelope(cls, app_context):
+        """Loads a dict with the instance and the times it was cached at."""
         try:
-            binary_data = MemcacheManager.get(
+            envelope = MemcacheManager.get(
                 cls._make_key(),
-                namespace=app_context.get_namespace_name())
-            if binary_data:
-                memento = cls.new_memento()
-                memento.deserialize(binary_data)
-                return cls.instance_from_memento(app_context, memento)
+                namespace=app_context.get_namespace_name(), local=True)
+            if not envelope:
+                return None
+            memento = cls.new_memento()
+            memento.deserialize(envelope['data'])
+            return {
+                'instance': cls.instance_from_memento(app_context, memento),
+                'expires_on': envelope['expires_on'],
+                'build_secs': envelope['build_secs']}
         except Exception as e:  # pylint: disable-msg=broad-except
             logging.error(
                 'Failed to load object \'%s\' from memcache. %s',
@@ -352,19 +379,101 @@ class AbstractCachedObject(object):
             return None
 
     @classmethod
-    def save(cls, app_context, instance):
-        """Saves instance to memcache."""
+    def load(cls, app_context):
+        """Loads instance from memcache; does not fail on errors."""
+        envelope = cls._load_envelope(app_context)
+        if envelope:
+            return envelope['instance']
+        return None
+
+    @classmethod
+    def save(cls, app_context, instance, build_secs=0):
+        """Saves instance to memcache.
+
+        Args:
+            app_context: the context of the course of the instance.
+            instance: the instance to cache.
+            build_secs: number of seconds it took to build the instance; the
+                longer, the earlier the instance is refreshed before it goes
+                stale.
+        """
         MemcacheManager.set(
-            cls._make_key(),
-            cls.memento_from_instance(instance).serialize(),
-            namespace=app_context.get_namespace_name())
+            cls._make_key(), {
+                'data': cls.memento_from_instance(instance).serialize(),
+                'expires_on': time.time() + CACHED_OBJECT_TTL_SECS,
+                'build_secs': build_secs},
+            ttl=CACHED_OBJECT_TTL_SECS + CACHED_OBJECT_STALE_TTL_SECS,
+            namespace=app_context.get_namespace_name(), local=True)
+
+    @classmethod
+    def _is_fresh(cls, envelope):
+        # Rebuild a little before the instance goes stale, at a random time
+        # that gets more likely as it gets closer, so that concurrent requests
+        # don't all find it stale at the same moment ("probabilistic early
+        # expiration").
+        early_secs = -(
+            envelope['build_secs'] * CACHED_OBJECT_EARLY_REFRESH_BETA *
+            math.log(1.0 - random.random()))
+        return time.time() + early_secs < envelope['expires_on']
+
+    @classmethod
+    def _build_and_save(cls, app_context, build_fn):
+        start = time.time()
+        instance = build_fn()
+        if instance:
+            cls.save(app_context, instance, build_secs=time.time() - start)
+        return instance
+
+    @classmethod
+    def load_or_build(cls, app_context, build_fn):
+        """Loads instance from memcache or builds it if it is missing or stale.
+
+        Only one request at a time rebuilds the instance. The others serve
+        the stale instance meanwhile, or wait for it to be rebuilt if there
+        is none.
+
+        Args:
+            app_context: the context of the course of the instance.
+            build_fn: callable with no arguments that builds the instance from
+                durable storage; may return None.
+
+        Returns:
+            The instance, or None if build_fn returns None.
+        """
+        envelope = cls._load_envelope(app_context)
+        if envelope and cls._is_fresh(envelope):
+            return envelope['instance']
+
+        namespace = app_context.get_namespace_name()
+        lease_key = '%s:lease' % cls._make_key()
+        if MemcacheManager.add(
+                lease_key, True, ttl=CACHED_OBJECT_LEASE_SECS,
+                namespace=namespace):
+            try:
+                return cls._build_and_save(app_context, build_fn)
+            finally:
+                MemcacheManager.delete(lease_key, namespace=namespace)
+
+        # Another request is rebuilding the instance.
+        if envelope:
+            return envelope['instance']
+        deadline = time.time() + CACHED_OBJECT_WAIT_SECS
+        while time.time() < deadline:
+            time.sleep(CACHED_OBJECT_WAIT_POLL_SECS)
+            instance = cls.load(app_context)
+            if instance:
+                return instance
+        logging.warning(
+            'Timed out waiting for object \'%s\' to be rebuilt.',
+            cls._make_key())
+        return cls._build_and_save(app_context, build_fn)
 
     @classmethod
     def delete(cls, app_context):
         """Deletes instance from memcache."""
         MemcacheManager.delete(
             cls._make_key(),
-            namespace=app_context.get_namespace_name())
+            namespace=app_context.get_namespace_name(), local=True)
 
     def serialize(self):
         """Saves instance to a pickle representation."""
@@ -483,14 +592,14 @@ class CourseModel12(object):
     @classmethod
     def load(cls, app_context):
         """Loads course data into a model."""
-        course = CachedCourse12.load(app_context)
-        if not course:
+
+        def build():
             units, lessons = load_csv_course(app_context)
             if units and lessons:
-                course = CourseModel12(app_context, units, lessons)
-        if course:
-            CachedCourse12.save(app_context, course)
-        return course
+                return CourseModel12(app_context, units, lessons)
+            return None
+
+        return CachedCourse12.load_or_build(app_context, build)
 
     @classmethod
     def _make_unit_id_to_lessons_lookup_dict(cls, lessons):
@@ -826,12 +935,8 @@ class CourseModel13(object):
     @classmethod
     def load(cls, app_context):
         """Loads course from memcache or persistence."""
-        course = CachedCourse13.load(app_context)
-        if not course:
-            course = PersistentCourse13.load(app_context)
-        if course:
-            CachedCourse13.save(app_context, course)
-        return course
+        return CachedCourse13.load_or_build(
+            app_context, lambda: PersistentCourse13.load(app_context))
 
     @classmethod
     def _make_unit_id_to_lessons_lookup_dict(cls, lessons):
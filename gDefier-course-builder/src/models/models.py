@@ -16,7 +16,12 @@
 
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
+import collections
 import logging
+import pickle
+import random
+import threading
+import time
 import appengine_config
 from config import ConfigProperty
 import counters
@@ -46,6 +51,27 @@ CAN_USE_MEMCACHE = ConfigProperty(
         'course content instantaneously.'),
     appengine_config.PRODUCTION_MODE)
 
+CAN_USE_LOCAL_CACHE = ConfigProperty(
+    'gcb_can_use_local_cache', bool, (
+        'Whether or not to also keep rarely changing objects, like the course '
+        'model and course files, in the memory of each application instance. '
+        'This saves a memcache round-trip for every such object read, but '
+        'other instances may see a change up to a few seconds late. Only '
+        'takes effect if memcache is enabled.'),
+    False)
+
+# The largest total size of the values cached in the memory of an instance.
+LOCAL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# The amount of time to keep an item in the memory of an instance.
+LOCAL_CACHE_TTL_SECS = 30
+
+# The amount of time an instance trusts its copy of the version of a namespace.
+LOCAL_CACHE_VERSION_CHECK_SECS = 1
+
+# The memcache key of the version of the locally cached items of a namespace.
+LOCAL_CACHE_VERSION_KEY = 'local-cache:version'
+
 # performance counters
 CACHE_PUT = PerfCounter(
     'gcb-models-cache-put',
@@ -59,6 +85,178 @@ CACHE_MISS = PerfCounter(
 CACHE_DELETE = PerfCounter(
     'gcb-models-cache-delete',
     'A number of times an object was deleted from memcache.')
+LOCAL_CACHE_HIT = PerfCounter(
+    'gcb-models-local-cache-hit',
+    'A number of times an object was found in the memory of an instance.')
+LOCAL_CACHE_EVICT = PerfCounter(
+    'gcb-models-local-cache-evict',
+    'A number of times an object was evicted from the memory of an instance '
+    'to make room for another one.')
+
+# The fraction of cache misses that are logged.
+CACHE_MISS_LOG_SAMPLE_RATE = 0.01
+
+# The fraction of values put into memcache that are measured for their size.
+CACHE_SIZE_SAMPLE_RATE = 0.01
+
+# Kinds of the counters kept for each memcache key prefix.
+PREFIX_COUNTER_HIT = 'hit'
+PREFIX_COUNTER_MISS = 'miss'
+PREFIX_COUNTER_PUT = 'put'
+PREFIX_COUNTER_SAMPLED_PUT = 'sampled-put'
+PREFIX_COUNTER_SAMPLED_BYTES = 'sampled-bytes'
+PREFIX_COUNTER_KINDS = [
+    PREFIX_COUNTER_HIT, PREFIX_COUNTER_MISS, PREFIX_COUNTER_PUT,
+    PREFIX_COUNTER_SAMPLED_PUT, PREFIX_COUNTER_SAMPLED_BYTES]
+
+# Counters of each memcache key prefix, created as keys are seen; maps
+# prefix to a dict of kind to PerfCounter.
+PREFIX_COUNTERS = {}
+PREFIX_COUNTERS_LOCK = threading.Lock()
+
+
+def get_key_prefix(key):
+    """Returns the prefix of a memcache key, e.g. 'vfs:dsbfs' or 'entity:x'."""
+    return ':'.join(key.lstrip('(').split(':', 2)[:2])
+
+
+def get_prefix_counters(prefix):
+    """Returns a dict of kind to the PerfCounter of a key prefix."""
+    prefix_counters = PREFIX_COUNTERS.get(prefix)
+    if prefix_counters is None:
+        with PREFIX_COUNTERS_LOCK:
+            prefix_counters = PREFIX_COUNTERS.get(prefix)
+            if prefix_counters is None:
+                prefix_counters = dict([(kind, PerfCounter(
+                    'gcb-models-cache-%s:%s' % (kind, prefix),
+                    'A number of memcache %ss of objects with a key starting '
+                    'with \'%s\'.' % (kind, prefix)))
+                    for kind in PREFIX_COUNTER_KINDS])
+                PREFIX_COUNTERS[prefix] = prefix_counters
+    return prefix_counters
+
+
+def inc_prefix_counter(kind, key, increment=1):
+    """Increments a counter of a given kind of the prefix of a key."""
+    get_prefix_counters(get_key_prefix(key))[kind].inc(increment=increment)
+
+
+def _record_hit(key):
+    CACHE_HIT.inc()
+    inc_prefix_counter(PREFIX_COUNTER_HIT, key)
+
+
+def _record_miss(key):
+    CACHE_MISS.inc(context=key)
+    inc_prefix_counter(PREFIX_COUNTER_MISS, key)
+    if random.random() < CACHE_MISS_LOG_SAMPLE_RATE:
+        logging.info('Cache miss, key: %s.', key)
+
+
+def _record_put(key, value):
+    CACHE_PUT.inc()
+    inc_prefix_counter(PREFIX_COUNTER_PUT, key)
+    if random.random() < CACHE_SIZE_SAMPLE_RATE:
+        try:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:  # pylint: disable-msg=broad-except
+            return
+        inc_prefix_counter(PREFIX_COUNTER_SAMPLED_PUT, key)
+        inc_prefix_counter(PREFIX_COUNTER_SAMPLED_BYTES, key, increment=size)
+
+
+class LocalCache(object):
+    """A size bounded least recently used cache kept in instance memory.
+
+    Values are kept pickled, so every reader gets its own copy, just like it
+    would from memcache. Each item is stamped with the version of its namespace
+    it was cached under; bumping the version drops all items of the namespace.
+    """
+
+    def __init__(
+        self, max_bytes=LOCAL_CACHE_MAX_BYTES, ttl=LOCAL_CACHE_TTL_SECS,
+        version_check_secs=LOCAL_CACHE_VERSION_CHECK_SECS):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._version_check_secs = version_check_secs
+        self._lock = threading.Lock()
+        # (namespace, key) -> (expires_on, version, pickled value)
+        self._items = collections.OrderedDict()
+        self._size = 0
+        # namespace -> (checked_until, version)
+        self._versions = {}
+
+    @property
+    def size(self):
+        return self._size
+
+    def _remove(self, item_key):
+        _, _, data = self._items.pop(item_key)
+        self._size -= len(data)
+
+    def get(self, namespace, key, version):
+        """Returns a copy of a value cached under a version, or None."""
+        item_key = (namespace, key)
+        with self._lock:
+            item = self._items.get(item_key)
+            if item is None:
+                return None
+            expires_on, item_version, data = item
+            if item_version != version or expires_on < time.time():
+                self._remove(item_key)
+                return None
+            # Move to the most recently used end.
+            del self._items[item_key]
+            self._items[item_key] = item
+        return pickle.loads(data)
+
+    def put(self, namespace, key, value, version):
+        """Caches a copy of a value; ignores values that can't fit."""
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:  # pylint: disable-msg=broad-except
+            return
+        item_key = (namespace, key)
+        with self._lock:
+            if item_key in self._items:
+                self._remove(item_key)
+            if len(data) > self._max_bytes:
+                return
+            while self._size + len(data) > self._max_bytes:
+                self._remove(iter(self._items).next())
+                LOCAL_CACHE_EVICT.inc()
+            self._items[item_key] = (time.time() + self._ttl, version, data)
+            self._size += len(data)
+
+    def discard(self, namespace, key):
+        with self._lock:
+            if (namespace, key) in self._items:
+                self._remove((namespace, key))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+            self._versions.clear()
+
+    def get_version(self, namespace, fetch_fn):
+        """Returns the version of a namespace, asking fetch_fn at most once a
+        version check period."""
+        with self._lock:
+            checked = self._versions.get(namespace)
+        if checked and checked[0] > time.time():
+            return checked[1]
+        version = fetch_fn()
+        self.set_version(namespace, version)
+        return version
+
+    def set_version(self, namespace, version):
+        with self._lock:
+            self._versions[namespace] = (
+                time.time() + self._version_check_secs, version)
+
+
+LOCAL_CACHE = LocalCache()
 
 
 class MemcacheManager(object):
@@ -79,36 +277,179 @@ class MemcacheManager(object):
         return cls.get_namespace()
 
     @classmethod
-    def get(cls, key, namespace=None):
-        """Gets an item from memcache if memcache is enabled."""
+    def _use_local(cls, local):
+        return local and CAN_USE_LOCAL_CACHE.value
+
+    @classmethod
+    def _get_local_version(cls, namespace):
+        return LOCAL_CACHE.get_version(
+            namespace, lambda: memcache.get(
+                LOCAL_CACHE_VERSION_KEY, namespace=namespace))
+
+    @classmethod
+    def get(cls, key, namespace=None, local=False):
+        """Gets an item from memcache if memcache is enabled.
+
+        Args:
+            key: string. The memcache key.
+            namespace: string. The namespace; the current one if None.
+            local: boolean. Whether to also look for the item in, and keep
+                it in, the memory of this instance. Only use for items that
+                rarely change and are invalidated by delete(local=True).
+
+        Returns:
+            The cached value or None.
+        """
         if not CAN_USE_MEMCACHE.value:
             return None
-        value = memcache.get(key, namespace=cls._get_namespace(namespace))
+        namespace = cls._get_namespace(namespace)
+        version = None
+        if cls._use_local(local):
+            version = cls._get_local_version(namespace)
+            value = LOCAL_CACHE.get(namespace, key, version)
+            if value is not None:
+                _record_hit(key)
+                LOCAL_CACHE_HIT.inc()
+                return value
+
+        value = memcache.get(key, namespace=namespace)
+        if value is not None and cls._use_local(local):
+            LOCAL_CACHE.put(namespace, key, value, version)
 
         # We store some objects in memcache that don't evaluate to True, but are
         # real objects, '{}' for example. Count a cache miss only in a case when
         # an object is None.
         if value != None:  # pylint: disable-msg=g-equals-none
-            CACHE_HIT.inc()
+            _record_hit(key)
         else:
-            logging.info('Cache miss, key: %s. %s', key, Exception())
-            CACHE_MISS.inc(context=key)
+            _record_miss(key)
         return value
 
     @classmethod
-    def set(cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None):
-        """Sets an item in memcache if memcache is enabled."""
+    def get_multi(cls, keys, namespace=None, local=False):
+        """Gets items from memcache in one call if memcache is enabled.
+
+        Args:
+            keys: list of strings. The memcache keys.
+            namespace: string. The namespace; the current one if None.
+            local: boolean. Whether to also use the memory of this instance;
+                see get().
+
+        Returns:
+            A dict of the keys found to their values; missing keys are left
+            out.
+        """
+        if not CAN_USE_MEMCACHE.value or not keys:
+            return {}
+        namespace = cls._get_namespace(namespace)
+        values = {}
+        version = None
+        if cls._use_local(local):
+            version = cls._get_local_version(namespace)
+            for key in keys:
+                value = LOCAL_CACHE.get(namespace, key, version)
+                if value is not None:
+                    LOCAL_CACHE_HIT.inc()
+                    values[key] = value
+
+        missing = [key for key in keys if key not in values]
+        if missing:
+            found = memcache.get_multi(missing, namespace=namespace)
+            if cls._use_local(local):
+                for key, value in found.iteritems():
+                    LOCAL_CACHE.put(namespace, key, value, version)
+            values.update(found)
+
+        for key in keys:
+            if key in values:
+                _record_hit(key)
+            else:
+                _record_miss(key)
+        return values
+
+    @classmethod
+    def set(
+        cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None,
+        local=False):
+        """Sets an item in memcache if memcache is enabled.
+
+        With local=True the item is also kept in the memory of this instance.
+        Other instances don't learn about the new value until the item is
+        deleted with delete(local=True), so only use it to fill the cache.
+        """
         if CAN_USE_MEMCACHE.value:
-            CACHE_PUT.inc()
-            memcache.set(
-                key, value, ttl, namespace=cls._get_namespace(namespace))
+            _record_put(key, value)
+            namespace = cls._get_namespace(namespace)
+            memcache.set(key, value, ttl, namespace=namespace)
+            if cls._use_local(local):
+                LOCAL_CACHE.put(
+                    namespace, key, value, cls._get_local_version(namespace))
+
+    @classmethod
+    def add(cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None):
+        """Sets an item in memcache only if it isn't there yet.
+
+        Returns:
+            True if the item was added, or if memcache is disabled; False if
+            the key was already there.
+        """
+        if not CAN_USE_MEMCACHE.value:
+            return True
+        _record_put(key, value)
+        return memcache.add(
+            key, value, ttl, namespace=cls._get_namespace(namespace))
+
+    @classmethod
+    def set_multi(
+        cls, mapping, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None, local=False):
+        """Sets items of a dict of keys to values in memcache in one call.
+
+        See set() for the meaning of local.
+        """
+        if CAN_USE_MEMCACHE.value and mapping:
+            for key, value in mapping.iteritems():
+                _record_put(key, value)
+            namespace = cls._get_namespace(namespace)
+            memcache.set_multi(mapping, ttl, namespace=namespace)
+            if cls._use_local(local):
+                version = cls._get_local_version(namespace)
+                for key, value in mapping.iteritems():
+                    LOCAL_CACHE.put(namespace, key, value, version)
 
     @classmethod
-    def delete(cls, key, namespace=None):
-        """Deletes an item from memcache if memcache is enabled."""
+    def delete(cls, key, namespace=None, local=False):
+        """Deletes an item from memcache if memcache is enabled.
+
+        With local=True the item is also dropped from the memory of all
+        instances; they drop every item of the namespace they keep in memory
+        within LOCAL_CACHE_VERSION_CHECK_SECS.
+        """
         if CAN_USE_MEMCACHE.value:
             CACHE_DELETE.inc()
-            memcache.delete(key, namespace=cls._get_namespace(namespace))
+            namespace = cls._get_namespace(namespace)
+            memcache.delete(key, namespace=namespace)
+            if local:
+                # Bump the version even if the local cache is disabled here,
+                # as it may be enabled on other instances.
+                LOCAL_CACHE.discard(namespace, key)
+                cls._bump_local_version(namespace)
+
+    @classmethod
+    def delete_multi(cls, keys, namespace=None, local=False):
+        """Deletes items from memcache in one call; see delete()."""
+        if CAN_USE_MEMCACHE.value and keys:
+            CACHE_DELETE.inc(increment=len(keys))
+            namespace = cls._get_namespace(namespace)
+            memcache.delete_multi(keys, namespace=namespace)
+            if local:
+                for key in keys:
+                    LOCAL_CACHE.discard(namespace, key)
+                cls._bump_local_version(namespace)
+
+    @classmethod
+    def _bump_local_version(cls, namespace):
+        LOCAL_CACHE.set_version(namespace, memcache.incr(
+            LOCAL_CACHE_VERSION_KEY, namespace=namespace, initial_value=0))
 
     @classmethod
     def incr(cls, key, delta, namespace=None):
@@ -577,10 +918,20 @@ class EventEntity(BaseEntity):
     data = db.TextProperty(indexed=False)
 
     @classmethod
-    def record(cls, source, user, data):
-        """Records new event into a datastore."""
+    def record(cls, source, user, data, recorded_on=None):
+        """Records new event into a datastore.
+
+        Args:
+            source: string. Place in the code where the event was recorded.
+            user: users.User who triggered the event.
+            data: string. JSON representation of the event.
+            recorded_on: datetime or None. When the event happened, if it is
+                recorded later; defaults to the time it is stored.
+        """
 
         event = EventEntity()
+        if recorded_on:
+            event.recorded_on = recorded_on
         event.source = source
         event.user_id = user.user_id()
         event.data = data
@@ -680,27 +1031,56 @@ class BaseJsonDao(object):
 
     @classmethod
     def _load_entity(cls, obj_id):
-        if not obj_id:
-            return None
-        memcache_key = cls._memcache_key(obj_id)
-        entity = MemcacheManager.get(memcache_key)
-        if NO_OBJECT == entity:
-            return None
-        if not entity:
-            entity = cls.ENTITY.get_by_id(int(obj_id))
+        return cls._load_entities([obj_id])[0]
+
+    @classmethod
+    def _load_entities(cls, obj_ids):
+        """Loads entities with one memcache and one datastore call at most.
+
+        Returns:
+            A list with the entity, or None, for each of obj_ids.
+        """
+        memcache_keys = dict([
+            (obj_id, cls._memcache_key(obj_id)) for obj_id in obj_ids
+            if obj_id])
+        cached = MemcacheManager.get_multi(memcache_keys.values())
+
+        entities = {}
+        missing = []
+        for obj_id, memcache_key in memcache_keys.iteritems():
+            entity = cached.get(memcache_key)
+            if NO_OBJECT == entity:
+                continue
             if entity:
-                MemcacheManager.set(memcache_key, entity)
+                entities[obj_id] = entity
             else:
-                MemcacheManager.set(memcache_key, NO_OBJECT)
-        return entity
+                missing.append(obj_id)
+
+        if missing:
+            mapping = {}
+            for obj_id, entity in zip(missing, cls.ENTITY.get_by_id(
+                    [int(obj_id) for obj_id in missing])):
+                if entity:
+                    entities[obj_id] = entity
+                mapping[memcache_keys[obj_id]] = entity if entity else NO_OBJECT
+            MemcacheManager.set_multi(mapping)
+
+        return [entities.get(obj_id) for obj_id in obj_ids]
 
     @classmethod
     def load(cls, obj_id):
-        entity = cls._load_entity(obj_id)
-        if entity:
-            return cls.DTO(obj_id, transforms.loads(entity.data))
-        else:
-            return None
+        return cls.bulk_load([obj_id])[0]
+
+    @classmethod
+    def bulk_load(cls, obj_ids):
+        """Loads DTOs in bulk; returns a DTO, or None, for each of obj_ids."""
+        dtos = []
+        for obj_id, entity in zip(obj_ids, cls._load_entities(obj_ids)):
+            if entity:
+                dtos.append(cls.DTO(obj_id, transforms.loads(entity.data)))
+            else:
+                dtos.append(None)
+        return dtos
 
     @classmethod
     def save(cls, dto):
@@ -716,16 +1096,17 @@ class BaseJsonDao(object):
     def save_all(cls, dtos):
         """Performs a block persist of a list of DTO's."""
         entities = []
-        for dto in dtos:
-            entity = cls._load_entity(dto.id)
+        for dto, entity in zip(
+                dtos, cls._load_entities([dto.id for dto in dtos])):
             if not entity:
                 entity = cls.ENTITY()
             entity.data = transforms.dumps(dto.dict)
             entities.append(entity)
 
         keys = db.put(entities)
-        for key, entity in zip(keys, entities):
-            MemcacheManager.set(cls._memcache_key(key.id()), entity)
+        MemcacheManager.set_multi(dict([
+            (cls._memcache_key(key.id()), entity)
+            for key, entity in zip(keys, entities)]))
         return [key.id() for key in keys]
 
     @classmethod
@@ -349,8 +349,8 @@ class UnitLessonCompletionTracker(object):
         try:
             question_group = QuestionGroupDAO.load(cpt['qgid'])
             questions = {}
-            for ind, quid in enumerate(question_group.question_ids):
-                question = QuestionDAO.load(quid)
+            for ind, question in enumerate(
+                    QuestionDAO.bulk_load(question_group.question_ids)):
                 if question.type == question.MULTIPLE_CHOICE:
                     q_id = 'u.%s.l.%s.c.%s.i.%s' % (
                         unit.unit_id, lesson.lesson_id, cpt['instanceid'], ind)
@@ -374,8 +374,8 @@ class UnitLessonCompletionTracker(object):
         try:
             question_group = QuestionGroupDAO.load(cpt['qgid'])
             questions = {}
-            for ind, quid in enumerate(question_group.question_ids):
-                question = QuestionDAO.load(quid)
+            for ind, question in enumerate(
+                    QuestionDAO.bulk_load(question_group.question_ids)):
                 if question.type == question.MULTIPLE_CHOICE:
                     q_id = 's.%s.c.%s.i.%s' % (
                         assessment.unit_id, cpt['instanceid'], ind)
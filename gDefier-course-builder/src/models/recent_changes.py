@@ -0,0 +1,118 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collections cached in memcache, built by queries and changed in place."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+from google.appengine.api import memcache
+
+# Attempts to update an item before dropping it for a concurrent writer.
+MAX_CAS_RETRIES = 10
+
+# Changes are remembered for this many seconds, long after queries that build
+# the items see them.
+RECENT_TTL_SECS = 10 * 60
+
+
+class RecentChanges(object):
+    """Keeps an item built from a query current with the changes made since.
+
+    Writers change the cached item with compare-and-set instead of dropping
+    it. The query building the item is eventually consistent, so changes are
+    also kept apart under a second key and applied to every item built while
+    they may still be missing from the query results.
+
+    Changes are dicts of member to True (added) or False (removed); how they
+    apply to the item is up to the caller.
+    """
+
+    def __init__(self, key, recent_key, namespace, apply_fn, expires_fn=None):
+        """Creates a helper for one cached item.
+
+        Args:
+            key: string. The memcache key of the item.
+            recent_key: string. The memcache key of its recent changes.
+            namespace: string. The memcache namespace of both.
+            apply_fn: callable taking the item and a dict of changes; applies
+                them in place and returns whether the item changed.
+            expires_fn: callable taking the item and returning the time it
+                expires, as memcache takes it; never if None.
+        """
+        self._key = key
+        self._recent_key = recent_key
+        self._namespace = namespace
+        self._apply_fn = apply_fn
+        self._expires_fn = expires_fn
+
+    def _expires(self, value):
+        if self._expires_fn:
+            return self._expires_fn(value)
+        return 0
+
+    def add(self, value):
+        """Caches an item just built, unless one is cached already.
+
+        Returns:
+            The item, with the recent changes applied in place.
+        """
+        # Never replace an item another request has already changed.
+        memcache.add(
+            self._key, value, self._expires(value), namespace=self._namespace)
+        # Read recent changes after the item is cached: a change made
+        # meanwhile is either seen here or applied to the cached item.
+        recent = memcache.get(self._recent_key, namespace=self._namespace)
+        if recent and self._apply_fn(value, recent):
+            self.update(recent)
+        return value
+
+    def change(self, changes):
+        """Applies changes to the cached item; call after they are stored."""
+        # Remember the changes before updating the item; see add().
+        self._remember(changes)
+        self.update(changes)
+
+    def _remember(self, changes):
+        client = memcache.Client()
+        for unused_attempt in range(MAX_CAS_RETRIES):
+            recent = client.gets(self._recent_key, namespace=self._namespace)
+            if recent is None:
+                if client.add(
+                        self._recent_key, changes, RECENT_TTL_SECS,
+                        namespace=self._namespace):
+                    return
+            else:
+                recent.update(changes)
+                if client.cas(
+                        self._recent_key, recent, RECENT_TTL_SECS,
+                        namespace=self._namespace):
+                    return
+        # Items built meanwhile could miss the changes; build it again.
+        memcache.delete(self._key, namespace=self._namespace)
+
+    def update(self, changes):
+        """Applies changes to the cached item only, if it is cached."""
+        client = memcache.Client()
+        for unused_attempt in range(MAX_CAS_RETRIES):
+            value = client.gets(self._key, namespace=self._namespace)
+            if value is None:
+                # Not cached; the next reader builds it.
+                return
+            if not self._apply_fn(value, changes):
+                return
+            if client.cas(
+                    self._key, value, self._expires(value),
+                    namespace=self._namespace):
+                return
+        memcache.delete(self._key, namespace=self._namespace)
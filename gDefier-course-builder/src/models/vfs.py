@@ -17,11 +17,20 @@
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 import datetime
+import hashlib
 import os
+import time
+import uuid
 from common import jinja_utils
 import jinja2
 from entities import BaseEntity
+from entities import delete as delete_entities
+from entities import get as get_entities
+from entities import put as put_entities
+from models import CAN_USE_MEMCACHE
 from models import MemcacheManager
+from recent_changes import RecentChanges
+from google.appengine.api import memcache
 from google.appengine.api import namespace_manager
 from google.appengine.ext import db
 
@@ -31,6 +40,32 @@ from google.appengine.ext import db
 # we cache this object below.
 NO_OBJECT = {}
 
+# The number of file names fetched from the datastore in one listing query.
+LIST_PAGE_SIZE = 1000
+
+# Listings of folders with more files than this are not cached in memcache;
+# nor are manifests of file systems with more files than this.
+LIST_CACHE_MAX_FILES = 5000
+
+# File content is stored in chunks of this many bytes, so that no entity and
+# no memcache item exceeds its 1 MB limit.
+FILE_CHUNK_SIZE = 900 * 1024
+
+# The namespace of the content of the files of all courses; files with the same
+# bytes share it, whatever namespace they belong to.
+BLOB_NAMESPACE = 'gcb-vfs-blobs'
+
+# The number of chunks of a file fetched at once when reading it.
+FILE_CHUNKS_PER_BATCH = 8
+
+# The most file names whose existence in an inherited file system is kept in
+# memory; any names can be requested, so it must be bounded.
+INHERITED_ISFILE_CACHE_MAX_FILES = 10000
+
+# A manifest is built again this many seconds after it was first built, so
+# whatever its query got wrong does not last; updates keep its expiry.
+MANIFEST_TTL_SECS = 60 * 60
+
 
 class AbstractFileSystem(object):
     """A generic file system interface that forwards to an implementation."""
@@ -174,12 +209,260 @@ class FileMetadataEntity(BaseEntity):
 
     size = db.IntegerProperty(indexed=False)
 
+    # The content is the FileBlobEntity of this hash, stored in chunks of
+    # chunk_size bytes of a generation. Files stored before blobs existed
+    # have a FileDataEntity instead.
+    blob_hash = db.StringProperty(indexed=False)
+    chunk_generation = db.StringProperty(indexed=False)
+    chunk_size = db.IntegerProperty(indexed=False)
+
 
 class FileDataEntity(BaseEntity):
     """An entity to represent file content; absolute file name is a key."""
     data = db.BlobProperty()
 
 
+class FileBlobEntity(BaseEntity):
+    """Content shared by all files with the same bytes; the hash is the key.
+
+    The bytes are stored in FileBlobChunkEntity chunks of a generation. The
+    blob counts the files that refer to it; the blob and its chunks are
+    deleted when the last of them is deleted or changed.
+    """
+    refs = db.IntegerProperty(indexed=False, default=0)
+    size = db.IntegerProperty(indexed=False)
+    generation = db.StringProperty(indexed=False)
+    chunk_size = db.IntegerProperty(indexed=False)
+
+    @classmethod
+    def make_hash(cls, raw_bytes):
+        # Key names can't start with a digit, so the hash is prefixed.
+        return 'sha256:%s' % hashlib.sha256(raw_bytes).hexdigest()
+
+
+class FileBlobChunkEntity(BaseEntity):
+    """A chunk of the content of a blob.
+
+    The key name is '<blob hash>:<chunk generation>:<chunk index>'.
+    """
+    data = db.BlobProperty()
+
+    @classmethod
+    def make_key_name(cls, blob_hash, generation, index):
+        return '%s:%s:%s' % (blob_hash, generation, index)
+
+    @classmethod
+    def make_memcache_key(cls, blob_hash, generation, index):
+        return 'vfs:blob-chunk:%s' % cls.make_key_name(
+            blob_hash, generation, index)
+
+
+def _in_blob_namespace(func):
+    """Decorates a function to run in the namespace of the blobs."""
+
+    def wrapper(*args, **kwargs):
+        old_namespace = namespace_manager.get_namespace()
+        try:
+            namespace_manager.set_namespace(BLOB_NAMESPACE)
+            return func(*args, **kwargs)
+        finally:
+            namespace_manager.set_namespace(old_namespace)
+
+    return wrapper
+
+
+@_in_blob_namespace
+def _get_chunks(blob_hash, generation, indexes):
+    """Returns the content of chunks of a blob; all are fetched at once.
+
+    A few large files would evict everything else from the in-process cache,
+    so chunks are only cached in memcache.
+    """
+    memcache_keys = [
+        FileBlobChunkEntity.make_memcache_key(blob_hash, generation, index)
+        for index in indexes]
+    chunks = MemcacheManager.get_multi(memcache_keys, namespace=BLOB_NAMESPACE)
+
+    missing = [
+        index for index, memcache_key in zip(indexes, memcache_keys)
+        if memcache_key not in chunks]
+    if missing:
+        entities = get_entities([
+            db.Key.from_path(
+                FileBlobChunkEntity.kind(),
+                FileBlobChunkEntity.make_key_name(blob_hash, generation, index))
+            for index in missing])
+        mapping = {}
+        for index, entity in zip(missing, entities):
+            if not entity:
+                raise IOError('Chunk %s of blob %s is missing.' % (
+                    index, blob_hash))
+            mapping[FileBlobChunkEntity.make_memcache_key(
+                blob_hash, generation, index)] = entity.data
+        MemcacheManager.set_multi(mapping, namespace=BLOB_NAMESPACE)
+        chunks.update(mapping)
+
+    return [chunks[memcache_key] for memcache_key in memcache_keys]
+
+
+def _put_chunks(blob, raw_bytes):
+    chunks = []
+    for index, offset in enumerate(range(0, len(raw_bytes), blob.chunk_size)):
+        chunks.append(FileBlobChunkEntity(
+            key_name=FileBlobChunkEntity.make_key_name(
+                blob.key().name(), blob.generation, index),
+            data=raw_bytes[offset:offset + blob.chunk_size]))
+    # Put a few at a time to stay below the size limit of a datastore call.
+    for offset in range(0, len(chunks), FILE_CHUNKS_PER_BATCH):
+        put_entities(chunks[offset:offset + FILE_CHUNKS_PER_BATCH])
+
+
+def _delete_chunks(blob):
+    chunk_count = (blob.size + blob.chunk_size - 1) // blob.chunk_size
+    delete_entities([
+        db.Key.from_path(
+            FileBlobChunkEntity.kind(),
+            FileBlobChunkEntity.make_key_name(
+                blob.key().name(), blob.generation, index))
+        for index in range(chunk_count)])
+
+
+@db.transactional
+def _add_blob_ref(blob_hash, new_blob):
+    """Adds a reference to a blob; puts new_blob if there is no blob yet.
+
+    Returns:
+        The blob referred to, or None if there is none and no new_blob.
+    """
+    blob = FileBlobEntity.get_by_key_name(blob_hash)
+    if not blob:
+        if not new_blob:
+            return None
+        blob = new_blob
+    blob.refs += 1
+    blob.put()
+    return blob
+
+
+@db.transactional
+def _remove_blob_ref(blob_hash):
+    """Removes a reference to a blob; returns the blob if it was deleted."""
+    blob = FileBlobEntity.get_by_key_name(blob_hash)
+    if not blob:
+        return None
+    blob.refs -= 1
+    if blob.refs > 0:
+        blob.put()
+        return None
+    blob.delete()
+    return blob
+
+
+@_in_blob_namespace
+def _acquire_blob(blob_hash, raw_bytes):
+    """Adds a reference to the blob of given hash and returns the blob.
+
+    Args:
+        blob_hash: string. The hash of the content.
+        raw_bytes: string. The content; its chunks are written only if there
+            is no blob with this hash yet. None if the blob must exist, like
+            when a file is copied.
+
+    Returns:
+        The FileBlobEntity referred to.
+
+    Raises:
+        IOError: if there is no blob of the hash and no raw_bytes.
+    """
+    blob = _add_blob_ref(blob_hash, None)
+    if blob:
+        return blob
+    if raw_bytes is None:
+        raise IOError('Blob %s does not exist.' % blob_hash)
+
+    # Chunks are written under a new generation before the blob, so no reader
+    # ever sees a blob whose chunks are missing. A blob being deleted
+    # concurrently can't remove them, as it has another generation.
+    new_blob = FileBlobEntity(
+        key_name=blob_hash, size=len(raw_bytes), generation=uuid.uuid4().hex,
+        chunk_size=FILE_CHUNK_SIZE)
+    _put_chunks(new_blob, raw_bytes)
+    blob = _add_blob_ref(blob_hash, new_blob)
+    if blob.generation != new_blob.generation:
+        # Another request has stored the same content meanwhile.
+        _delete_chunks(new_blob)
+    return blob
+
+
+@_in_blob_namespace
+def _release_blob(blob_hash):
+    """Removes a reference to a blob; deletes it if it was the last one."""
+    blob = _remove_blob_ref(blob_hash)
+    if blob:
+        _delete_chunks(blob)
+
+
+def delete_file_entities(metadata_entities):
+    """Deletes files of the current namespace without a file system.
+
+    Blobs live outside of the namespace of a course, so tools deleting the
+    files of a course in bulk must release them with this function rather
+    than only delete the FileMetadataEntity rows.
+
+    Args:
+        metadata_entities: list of FileMetadataEntity to delete.
+    """
+    db.delete([metadata.key() for metadata in metadata_entities])
+    for metadata in metadata_entities:
+        if metadata.blob_hash:
+            _release_blob(metadata.blob_hash)
+
+
+class ChunkedFileStream(object):
+    """A stream of a file stored as a blob; reads only the chunks it needs."""
+
+    def __init__(self, metadata):
+        self._metadata = metadata
+        self._position = 0
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def size(self):
+        return self._metadata.size
+
+    def iter_chunks(self, start=0, end=None):
+        """Yields bytes from start up to, but excluding, end chunk by chunk."""
+        if end is None or end > self.size:
+            end = self.size
+        if start >= end:
+            return
+        chunk_size = self._metadata.chunk_size
+        first = start // chunk_size
+        last = (end - 1) // chunk_size
+        for batch_first in range(first, last + 1, FILE_CHUNKS_PER_BATCH):
+            indexes = range(
+                batch_first, min(batch_first + FILE_CHUNKS_PER_BATCH, last + 1))
+            chunks = _get_chunks(
+                self._metadata.blob_hash, self._metadata.chunk_generation,
+                indexes)
+            for index, data in zip(indexes, chunks):
+                offset = index * chunk_size
+                yield data[max(start - offset, 0):end - offset]
+
+    def read_range(self, start, end):
+        """Returns bytes from start up to, but excluding, end."""
+        return ''.join(self.iter_chunks(start, end))
+
+    def read(self):
+        """Emulates stream.read(). Returns all bytes and emulates EOF."""
+        data = self.read_range(self._position, self.size)
+        self._position = self.size
+        return data
+
+
 class FileStreamWrapped(object):
     """A class that wraps a file stream, but adds extra attributes to it."""
 
@@ -232,12 +515,14 @@ class VirtualFileSystemTemplateLoader(jinja2.BaseLoader):
                 self._dir_names.append(AbstractFileSystem.normpath(dir_name))
 
     def get_source(self, unused_environment, template):
-        for dir_name in self._dir_names:
-            filename = AbstractFileSystem.normpath(
-                os.path.join(dir_name, template))
-            if self._fs.isfile(filename):
-                return self._fs.get(
-                    filename).read().decode('utf-8'), filename, True
+        filenames = [
+            AbstractFileSystem.normpath(os.path.join(dir_name, template))
+            for dir_name in self._dir_names]
+        # Look the template up in all folders at once.
+        streams = self._fs.get_multi(filenames)
+        for filename in filenames:
+            if streams.get(filename):
+                return streams[filename].read().decode('utf-8'), filename, True
         raise jinja2.TemplateNotFound(template)
 
     def list_templates(self):
@@ -247,13 +532,59 @@ class VirtualFileSystemTemplateLoader(jinja2.BaseLoader):
         return all_templates
 
 
+def _random_version():
+    """Returns a random start for a counter incremented in memcache."""
+    return uuid.uuid4().int % (2 ** 62)
+
+
+def _apply_manifest_changes(manifest, changes):
+    """Applies a dict of file name to True (put) or False (deleted).
+
+    Returns:
+        Whether the set of files changed.
+    """
+    files = manifest['files']
+    if files is None:
+        # Too many files to keep; nothing to update.
+        return False
+    changed = False
+    for filename, exists in changes.iteritems():
+        if exists and filename not in files:
+            files.add(filename)
+            changed = True
+        elif not exists and filename in files:
+            files.discard(filename)
+            changed = True
+    return changed
+
+
 class DatastoreBackedFileSystem(object):
     """A read-write file system backed by a datastore."""
 
+    # The memcache key of the version of all cached listings of a namespace.
+    LIST_VERSION_KEY = 'vfs:dsbfs-list:version'
+
+    # The memcache key of the manifest of a namespace: the names of all its
+    # files, so existence checks need no call per file. It is kept up to date
+    # by put() and delete() rather than rebuilt on every change.
+    MANIFEST_KEY = 'vfs:dsbfs-manifest'
+
+    # The memcache key of the files recently put or deleted in a namespace;
+    # see _get_manifest().
+    MANIFEST_RECENT_KEY = 'vfs:dsbfs-manifest:recent'
+
+    # The memcache key of a counter incremented on every change of the
+    # manifest, so the copy an instance keeps in memory is checked cheaply.
+    MANIFEST_VERSION_KEY = 'vfs:dsbfs-manifest:version'
+
     @classmethod
     def make_key(cls, filename):
         return 'vfs:dsbfs:%s' % filename
 
+    @classmethod
+    def make_list_key(cls, dir_name):
+        return 'vfs:dsbfs-list:%s' % dir_name
+
     def __init__(
         self, ns, logical_home_folder,
         inherits_from=None, inheritable_folders=None):
@@ -282,11 +613,17 @@ class DatastoreBackedFileSystem(object):
             logical_home_folder)
         self._inherits_from = inherits_from
         self._inheritable_folders = []
+        # Files of the inherited file system never change, so whether they
+        # exist is remembered; maps physical file names to booleans.
+        self._inherited_isfile_cache = {}
+        # A (version, manifest) tuple; see _get_manifest().
+        self._manifest = None
 
         if inheritable_folders:
             for folder in inheritable_folders:
                 self._inheritable_folders.append(AbstractFileSystem.normpath(
                     folder))
+        self._inheritable_prefixes = tuple(self._inheritable_folders)
 
     def __getattribute__(self, name):
         attr = object.__getattribute__(self, name)
@@ -358,101 +695,208 @@ class DatastoreBackedFileSystem(object):
 
     def _can_inherit(self, filename):
         """Checks if a file can be inherited from a parent file system."""
-        for prefix in self._inheritable_folders:
-            if filename.startswith(prefix):
-                return True
-        return False
+        return filename.startswith(self._inheritable_prefixes)
+
+    def _is_inherited_file(self, afilename, filename):
+        """Checks if a file is inherited from the parent file system."""
+        if not (self._inherits_from and self._can_inherit(filename)):
+            return False
+        result = self._inherited_isfile_cache.get(filename)
+        if result is None:
+            result = self._inherits_from.isfile(afilename)
+            if (len(self._inherited_isfile_cache) >=
+                INHERITED_ISFILE_CACHE_MAX_FILES):
+                self._inherited_isfile_cache.clear()
+            self._inherited_isfile_cache[filename] = result
+        return result
 
     def get(self, afilename):
         """Gets a file from a datastore. Raw bytes stream, no encodings."""
-        filename = self._logical_to_physical(afilename)
+        return self.get_multi([afilename]).get(afilename)
 
-        # Load from cache.
-        result = MemcacheManager.get(
-            self.make_key(filename), namespace=self._ns)
-        if result:
-            return result
-        if NO_OBJECT == result:
-            return None
+    def get_multi(self, afilenames):
+        """Gets files with one memcache and one datastore call at most.
 
-        # Load from a datastore.
-        metadata = FileMetadataEntity.get_by_key_name(filename)
-        if metadata:
-            data = FileDataEntity.get_by_key_name(filename)
-            if data:
-                result = FileStreamWrapped(metadata, data.data)
-                MemcacheManager.set(
-                    self.make_key(filename), result, namespace=self._ns)
-                return result
+        Args:
+            afilenames: list of strings. Logical names of the files.
 
-        result = None
-        metadata = None
+        Returns:
+            A dict of the names of the files found to their streams; missing
+            files are left out.
+        """
+        filenames = dict([
+            (afilename, self._logical_to_physical(afilename))
+            for afilename in afilenames])
+        if not filenames:
+            return {}
 
-        # Load from parent fs.
-        if self._inherits_from and self._can_inherit(filename):
-            result = self._inherits_from.get(afilename)
+        # Load from cache.
+        cached = MemcacheManager.get_multi(
+            [self.make_key(filename) for filename in filenames.values()],
+            namespace=self._ns, local=True)
+        results = {}
+        missing = []
+        for afilename, filename in filenames.iteritems():
+            result = cached.get(self.make_key(filename))
+            if NO_OBJECT == result:
+                continue
+            if result:
+                results[afilename] = result
+            else:
+                missing.append(afilename)
+        if not missing:
+            return results
+
+        # Load from a datastore; metadata and data of all files in one call.
+        keys = []
+        for afilename in missing:
+            keys.append(db.Key.from_path(
+                FileMetadataEntity.kind(), filenames[afilename]))
+            keys.append(db.Key.from_path(
+                FileDataEntity.kind(), filenames[afilename]))
+        entities = get_entities(keys)
+
+        mapping = {}
+        for index, afilename in enumerate(missing):
+            filename = filenames[afilename]
+            metadata, data = entities[2 * index], entities[2 * index + 1]
+            result = None
+            if metadata and metadata.blob_hash:
+                result = ChunkedFileStream(metadata)
+            elif metadata and data:
+                result = FileStreamWrapped(metadata, data.data)
 
-        # Cache result.
-        if result:
-            result = FileStreamWrapped(metadata, result.read())
-            MemcacheManager.set(
-                self.make_key(filename), result, namespace=self._ns)
-        else:
-            MemcacheManager.set(
-                self.make_key(filename), NO_OBJECT, namespace=self._ns)
+            # Load from parent fs.
+            elif self._is_inherited_file(afilename, filename):
+                result = FileStreamWrapped(
+                    None, self._inherits_from.get(afilename).read())
 
-        return result
+            # Cache result.
+            mapping[self.make_key(filename)] = result if result else NO_OBJECT
+            if result:
+                results[afilename] = result
+        MemcacheManager.set_multi(mapping, namespace=self._ns, local=True)
+
+        return results
 
-    @db.transactional(xg=True)
     def put(self, filename, stream, is_draft=False, metadata_only=False):
-        """Puts a file stream to a database. Raw bytes stream, no encodings."""
-        self.non_transactional_put(
-            filename, stream, is_draft=is_draft, metadata_only=metadata_only)
+        """Puts a file stream to a database. Raw bytes stream, no encodings.
+
+        The content is stored as a blob shared by all files with the same
+        bytes, in any namespace; a stream of another file stored as a blob
+        is copied by adding a reference to its blob, without reading it.
+        The metadata of the file is replaced in a transaction.
+        """
+        self._put(
+            filename, stream, is_draft, metadata_only,
+            self._put_entities_in_transaction)
 
     def non_transactional_put(
         self, filename, stream, is_draft=False, metadata_only=False):
         """Non-transactional put; use only when transactions are impossible."""
+        self._put(
+            filename, stream, is_draft, metadata_only, self._put_entities)
+
+    def _put(self, filename, stream, is_draft, metadata_only, put_fn):
         filename = self._logical_to_physical(filename)
 
+        blob = None
+        if not metadata_only:
+            source = getattr(stream, 'metadata', None)
+            if getattr(source, 'blob_hash', None):
+                blob = _acquire_blob(source.blob_hash, None)
+            else:
+                # We operate with raw bytes. The consumer must deal with
+                # encoding.
+                raw_bytes = stream.read()
+                blob = _acquire_blob(
+                    FileBlobEntity.make_hash(raw_bytes), raw_bytes)
+
+        try:
+            is_new, old_blob_hash = put_fn(
+                filename, blob, is_draft, metadata_only)
+        except:  # pylint: disable-msg=bare-except
+            if blob:
+                _release_blob(blob.key().name())
+            raise
+
+        if old_blob_hash:
+            _release_blob(old_blob_hash)
+        # The manifest and the listings change before copies kept in memory
+        # are dropped, so none of them is refilled with the old ones.
+        if is_new:
+            self._change_manifest({filename: True})
+            self._invalidate_listings()
+        MemcacheManager.delete(
+            self.make_key(filename), namespace=self._ns, local=True)
+
+    def _put_entities(self, filename, blob, is_draft, metadata_only):
+        """Puts the metadata of a file pointing to its blob.
+
+        Returns:
+            A tuple of whether the file is new and of the hash of the blob
+            the file no longer refers to, if any.
+        """
         metadata = FileMetadataEntity.get_by_key_name(filename)
-        if not metadata:
+        is_new = not metadata
+        if is_new:
             metadata = FileMetadataEntity(key_name=filename)
         metadata.updated_on = datetime.datetime.now()
         metadata.is_draft = is_draft
 
+        old_blob_hash = None
         if not metadata_only:
-            # We operate with raw bytes. The consumer must deal with encoding.
-            raw_bytes = stream.read()
+            old_blob_hash = metadata.blob_hash
+            metadata.size = blob.size
+            metadata.blob_hash = blob.key().name()
+            metadata.chunk_generation = blob.generation
+            metadata.chunk_size = blob.chunk_size
 
-            metadata.size = len(raw_bytes)
-
-            data = FileDataEntity(key_name=filename)
-            data.data = raw_bytes
-            data.put()
+            # Drop the content stored before files were stored as blobs.
+            FileDataEntity(key_name=filename).delete()
 
         metadata.put()
-
-        MemcacheManager.delete(self.make_key(filename), namespace=self._ns)
+        return is_new, old_blob_hash
 
     @db.transactional(xg=True)
+    def _put_entities_in_transaction(self, *args):
+        return self._put_entities(*args)
+
     def delete(self, filename):
         filename = self._logical_to_physical(filename)
 
+        metadata = self._delete_entities(filename)
+        if metadata:
+            if metadata.blob_hash:
+                _release_blob(metadata.blob_hash)
+            self._change_manifest({filename: False})
+            self._invalidate_listings()
+        # See _put() for why this comes after the manifest changes.
+        MemcacheManager.delete(
+            self.make_key(filename), namespace=self._ns, local=True)
+
+    @db.transactional(xg=True)
+    def _delete_entities(self, filename):
+        """Deletes the metadata and content of a file; returns the metadata."""
         metadata = FileMetadataEntity.get_by_key_name(filename)
         if metadata:
             metadata.delete()
-        data = FileDataEntity(key_name=filename)
-        if data:
-            data.delete()
-        MemcacheManager.delete(self.make_key(filename), namespace=self._ns)
+        FileDataEntity(key_name=filename).delete()
+        return metadata
 
     def isfile(self, afilename):
         """Checks file existence by looking up the datastore row."""
         filename = self._logical_to_physical(afilename)
 
+        # Check manifest. A file missing from it may have been put while it
+        # was built, so only the files it has are trusted.
+        manifest = self._get_manifest()
+        if manifest is not None and filename in manifest:
+            return True
+
         # Check cache.
         result = MemcacheManager.get(
-            self.make_key(filename), namespace=self._ns)
+            self.make_key(filename), namespace=self._ns, local=True)
         if result:
             return True
         if NO_OBJECT == result:
@@ -466,13 +910,13 @@ class DatastoreBackedFileSystem(object):
         result = False
 
         # Check with parent fs.
-        if self._inherits_from and self._can_inherit(filename):
-            result = self._inherits_from.isfile(afilename)
+        result = self._is_inherited_file(afilename, filename)
 
         # Put NO_OBJECT marker into memcache to avoid repeated lookups.
         if not result:
             MemcacheManager.set(
-                self.make_key(filename), NO_OBJECT, namespace=self._ns)
+                self.make_key(filename), NO_OBJECT, namespace=self._ns,
+                local=True)
 
         return result
 
@@ -488,19 +932,172 @@ class DatastoreBackedFileSystem(object):
             List of string. Lexicographically-sorted unique filenames
             recursively found in dir_name.
         """
-        dir_name = self._logical_to_physical(dir_name)
-        result = set()
-        keys = FileMetadataEntity.all(keys_only=True)
-        for key in keys.fetch(1000):
-            filename = key.name()
-            if filename.startswith(dir_name):
-                result.add(self._physical_to_logical(filename))
+        result = set([
+            self._physical_to_logical(filename) for filename in
+            self._list_physical(self._logical_to_physical(dir_name))])
         if include_inherited and self._inherits_from:
             for inheritable_folder in self._inheritable_folders:
                 result.update(set(self._inherits_from.list(
                     self._physical_to_logical(inheritable_folder))))
         return sorted(list(result))
 
+    def list_page(self, dir_name, cursor=None, limit=LIST_PAGE_SIZE):
+        """Lists files in a directory one page at a time; never cached.
+
+        Args:
+            dir_name: string. Directory to list contents of.
+            cursor: string. Cursor returned with the previous page, if any.
+            limit: int. The largest number of filenames to return.
+
+        Returns:
+            A tuple of a list of lexicographically-sorted filenames recursively
+            found in dir_name and the cursor of the next page, or None if this
+            is the last page. Inherited files are not listed.
+        """
+        query = self._list_query(self._logical_to_physical(dir_name))
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(limit)
+        next_cursor = None
+        if len(keys) == limit:
+            next_cursor = query.cursor()
+        return [
+            self._physical_to_logical(key.name()) for key in keys], next_cursor
+
+    def _list_query(self, dir_name):
+        """Makes a query of the keys of the files whose names start with a
+        prefix; file names are key names, so it is a range of keys."""
+        query = FileMetadataEntity.all(keys_only=True).order('__key__')
+        if dir_name:
+            query.filter('__key__ >=', db.Key.from_path(
+                FileMetadataEntity.kind(), dir_name))
+        query.filter('__key__ <', db.Key.from_path(
+            FileMetadataEntity.kind(), dir_name + u'\ufffd'))
+        return query
+
+    def _list_physical(self, dir_name):
+        """Lists all files whose physical names start with dir_name."""
+        list_key = self.make_list_key(dir_name)
+        cached = MemcacheManager.get_multi(
+            [self.LIST_VERSION_KEY, list_key], namespace=self._ns)
+        version = cached.get(self.LIST_VERSION_KEY)
+        listing = cached.get(list_key)
+        if version and listing and listing['version'] == version:
+            return listing['filenames']
+
+        # Set the version before listing the files, so a file put while they
+        # are listed changes it again and the listing cached is stale.
+        if not version:
+            version = self._invalidate_listings()
+        filenames = []
+        query = self._list_query(dir_name)
+        while True:
+            keys = query.fetch(LIST_PAGE_SIZE)
+            filenames += [key.name() for key in keys]
+            if len(keys) < LIST_PAGE_SIZE:
+                break
+            query.with_cursor(query.cursor())
+
+        if len(filenames) <= LIST_CACHE_MAX_FILES:
+            MemcacheManager.set(
+                list_key, {'version': version, 'filenames': filenames},
+                namespace=self._ns)
+        return filenames
+
+    def _memcache_namespace(self):
+        if self._ns is not None:
+            return self._ns
+        return MemcacheManager.get_namespace()
+
+    def _get_manifest_version(self):
+        namespace = self._memcache_namespace()
+        version = memcache.get(self.MANIFEST_VERSION_KEY, namespace=namespace)
+        if version is None:
+            # Start from a random value, so copies kept from before the
+            # counter was evicted are not taken for current ones.
+            memcache.add(
+                self.MANIFEST_VERSION_KEY, _random_version(),
+                namespace=namespace)
+            version = memcache.get(
+                self.MANIFEST_VERSION_KEY, namespace=namespace)
+        return version
+
+    def _bump_manifest_version(self):
+        memcache.incr(
+            self.MANIFEST_VERSION_KEY, namespace=self._memcache_namespace(),
+            initial_value=_random_version())
+
+    def _get_manifest(self):
+        """Returns the manifest of this file system, building it if missing.
+
+        A copy is kept in memory while the version in memcache is unchanged.
+        Files put or deleted while the manifest is built are applied to it
+        through RecentChanges, but those may be evicted, so callers must
+        treat a file missing from the manifest as unknown rather than as not
+        there.
+
+        Returns:
+            A set of the physical names of all files, or None if there is no
+            manifest: memcache is disabled or there are too many files.
+            Inherited files are not included.
+        """
+        if not CAN_USE_MEMCACHE.value:
+            return None
+        # Read the version first: a change made after it is read increments
+        # it again, so the copy kept in memory is not used once stale.
+        version = self._get_manifest_version()
+        if (self._manifest and self._manifest[0] == version and
+                time.time() < self._manifest[1]['expires']):
+            return self._manifest[1]['files']
+
+        manifest = memcache.get(
+            self.MANIFEST_KEY, namespace=self._memcache_namespace())
+        if manifest is None:
+            manifest = self._build_manifest()
+        if version is not None:
+            self._manifest = (version, manifest)
+        return manifest['files']
+
+    def _build_manifest(self):
+        files = set()
+        query = FileMetadataEntity.all(keys_only=True).order('__key__')
+        while True:
+            keys = query.fetch(LIST_PAGE_SIZE)
+            files.update([key.name() for key in keys])
+            if len(files) > LIST_CACHE_MAX_FILES:
+                files = None
+                break
+            if len(keys) < LIST_PAGE_SIZE:
+                break
+            query.with_cursor(query.cursor())
+
+        # A manifest of too many files is cached as None, so it is not
+        # rebuilt on every call. Memcache takes the expiry as a time, so
+        # updates can keep it.
+        manifest = {
+            'files': files, 'expires': int(time.time()) + MANIFEST_TTL_SECS}
+        return self._recent_changes().add(manifest)
+
+    def _recent_changes(self):
+        return RecentChanges(
+            self.MANIFEST_KEY, self.MANIFEST_RECENT_KEY,
+            self._memcache_namespace(), _apply_manifest_changes,
+            expires_fn=lambda manifest: manifest['expires'])
+
+    def _change_manifest(self, changes):
+        """Records files put (True) or deleted (False) in the manifest."""
+        if not CAN_USE_MEMCACHE.value:
+            return
+        self._recent_changes().change(changes)
+        # Even if the manifest is not cached, instances may keep a copy.
+        self._bump_manifest_version()
+
+    def _invalidate_listings(self):
+        """Makes all cached listings of this file system stale."""
+        version = uuid.uuid4().hex
+        MemcacheManager.set(self.LIST_VERSION_KEY, version, namespace=self._ns)
+        return version
+
     def get_jinja_environ(self, dir_names):
         return jinja_utils.create_jinja_environment(
             loader=VirtualFileSystemTemplateLoader(
@@ -32,6 +32,7 @@ from controllers.utils import ReflectiveRequestHandler
 from models import config
 from models import counters
 from models import custom_modules
+from models import models
 from models import roles
 from models.config import ConfigProperty
 import modules.admin.config
@@ -88,7 +89,7 @@ class AdminHandler(
     @property
     def get_actions(self):
         actions = [
-            self.default_action, 'settings', 'deployment', 'perf',
+            self.default_action, 'settings', 'deployment', 'perf', 'cache',
             'config_edit', 'add_course']
         if DIRECT_CODE_EXECUTION_UI_ENABLED:
             actions.append('console')
@@ -136,6 +137,7 @@ class AdminHandler(
             ('', 'Courses'),
             ('settings', 'Settings'),
             ('perf', 'Metrics'),
+            ('cache', 'Caches'),
             ('deployment', 'Deployment')]
         if DIRECT_CODE_EXECUTION_UI_ENABLED:
             nav_mappings.append(('console', 'Console'))
@@ -250,6 +252,65 @@ class AdminHandler(
             perf_counters, 'In-process Performance Counters (local/global)')
         self.render_page(template_values)
 
+    def get_cache(self):
+        """Shows memcache hit ratio and sizes by key prefix."""
+        template_values = {}
+        template_values['page_title'] = self.format_title('Caches')
+        template_values['page_description'] = messages.CACHES_DESCRIPTION
+
+        def get_value(counter):
+            # Prefer values aggregated across all instances when recorded.
+            global_value = counter.global_value
+            if global_value is None:
+                return counter.value
+            return global_value
+
+        content = safe_dom.NodeList()
+        content.append(safe_dom.Element('h3').add_text(
+            'Memcache Usage by Key Prefix'))
+        table = safe_dom.Element('table')
+        content.append(table)
+        header = safe_dom.Element('tr')
+        for caption in [
+                'Key Prefix', 'Hits', 'Misses', 'Hit Ratio', 'Puts',
+                'Average Size (bytes)', 'Estimated Bytes Put']:
+            header.add_child(safe_dom.Element('th').add_text(caption))
+        table.add_child(header)
+
+        for prefix in sorted(models.PREFIX_COUNTERS.keys()):
+            values = dict([
+                (kind, get_value(counter)) for kind, counter
+                in models.PREFIX_COUNTERS[prefix].iteritems()])
+            hits = values[models.PREFIX_COUNTER_HIT]
+            misses = values[models.PREFIX_COUNTER_MISS]
+            puts = values[models.PREFIX_COUNTER_PUT]
+            sampled_puts = values[models.PREFIX_COUNTER_SAMPLED_PUT]
+
+            hit_ratio = 'NA'
+            if hits + misses:
+                hit_ratio = '%.1f%%' % (100.0 * hits / (hits + misses))
+            average_size = 'NA'
+            estimated_bytes = 'NA'
+            if sampled_puts:
+                size = (
+                    values[models.PREFIX_COUNTER_SAMPLED_BYTES] / sampled_puts)
+                average_size = size
+                estimated_bytes = size * puts
+
+            row = safe_dom.Element('tr')
+            for value in [
+                    prefix, hits, misses, hit_ratio, puts, average_size,
+                    estimated_bytes]:
+                row.add_child(safe_dom.Element('td').add_text(str(value)))
+            table.add_child(row)
+
+        table.add_child(
+            safe_dom.Element('tr').add_child(
+                safe_dom.Element('td', colspan='7', align='right').add_text(
+                    'Total: %s prefix(es)' % len(models.PREFIX_COUNTERS))))
+        template_values['main_content'] = content
+        self.render_page(template_values)
+
     def _make_routes_dom(self, parent_element, routes, caption):
         """Renders routes as DOM."""
         if routes:
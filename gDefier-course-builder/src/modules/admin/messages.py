@@ -40,5 +40,11 @@ before uploading it to Google App Engine.
 METRICS_DESCRIPTION = assemble_sanitized_message(
     None, 'https://code.google.com/p/course-builder/wiki/AdminPage')
 
+CACHES_DESCRIPTION = assemble_sanitized_message("""
+Hits, misses and puts of memcache by key prefix, aggregated across all
+application instances if gcb_can_aggregate_counters is enabled, or for this
+instance only otherwise. Sizes are estimated from a sample of the puts.
+""", None)
+
 SETTINGS_DESCRIPTION = assemble_sanitized_message(
     None, 'https://code.google.com/p/course-builder/wiki/AdminPage')
@@ -345,26 +345,26 @@ class AnnouncementEntity(entities.BaseEntity):
 
     @classmethod
     def get_announcements(cls, allow_cached=True):
-        items = MemcacheManager.get(cls.memcache_key)
+        items = MemcacheManager.get(cls.memcache_key, local=True)
         if not allow_cached or items is None:
             items = AnnouncementEntity.all().order('-date').fetch(1000)
 
             # TODO(psimakov): prepare to exceed 1MB max item size
             # read more here: http://stackoverflow.com
             #   /questions/5081502/memcache-1-mb-limit-in-google-app-engine
-            MemcacheManager.set(cls.memcache_key, items)
+            MemcacheManager.set(cls.memcache_key, items, local=True)
         return items
 
     def put(self):
         """Do the normal put() and also invalidate memcache."""
         result = super(AnnouncementEntity, self).put()
-        MemcacheManager.delete(self.memcache_key)
+        MemcacheManager.delete(self.memcache_key, local=True)
         return result
 
     def delete(self):
         """Do the normal delete() and invalidate memcache."""
         super(AnnouncementEntity, self).delete()
-        MemcacheManager.delete(self.memcache_key)
+        MemcacheManager.delete(self.memcache_key, local=True)
 
 
 custom_module = None
@@ -17,6 +17,7 @@
 __author__ = 'sll@google.com (Sean Lip)'
 
 
+import copy
 import os
 
 from common import jinja_utils
@@ -31,8 +32,32 @@ from models import transforms
 RESOURCES_PATH = '/modules/assessment_tags/resources'
 
 
+def _prefetch(handler, dao, obj_ids):
+    """Bulk loads DTOs and keeps them in the handler rendering the page."""
+    if not hasattr(handler, 'prefetched_dtos'):
+        handler.prefetched_dtos = {}
+    obj_ids = [
+        obj_id for obj_id in set(obj_ids)
+        if obj_id and (dao, obj_id) not in handler.prefetched_dtos]
+    for obj_id, dto in zip(obj_ids, dao.bulk_load(obj_ids)):
+        handler.prefetched_dtos[(dao, obj_id)] = dto
+
+
+def _load(handler, dao, obj_id):
+    """Returns a copy of a prefetched DTO; loads the DTO if not prefetched."""
+    prefetched = getattr(handler, 'prefetched_dtos', {})
+    if (dao, obj_id) not in prefetched:
+        return dao.load(obj_id)
+    dto = prefetched[(dao, obj_id)]
+    if not dto:
+        return None
+    # The renderers add their own values to the dict of the DTO.
+    return dao.DTO(dto.id, copy.deepcopy(dto.dict))
+
+
 def render_question(
-    quid, instanceid, locale, embedded=False, weight=None, progress=None):
+    quid, instanceid, locale, embedded=False, weight=None, progress=None,
+    handler=None):
     """Generates the HTML for a question.
 
     Args:
@@ -50,12 +75,14 @@ def render_question(
       progress: None, 0 or 1. If None, no progress marker should be shown. If
           0, a 'not-started' progress marker should be shown. If 1, a
           'complete' progress marker should be shown.
+      handler: the handler rendering the page; the question is taken from
+          the questions the handler prefetched if given.
 
     Returns:
       a Jinja markup string that represents the HTML for the question.
     """
     try:
-        question_dto = m_models.QuestionDAO.load(quid)
+        question_dto = _load(handler, m_models.QuestionDAO, quid)
     except Exception:  # pylint: disable-msg=broad-except
         return '[Invalid question]'
 
@@ -134,6 +161,12 @@ class QuestionTag(tags.BaseTag):
     def vendor(cls):
         return 'gcb'
 
+    @classmethod
+    def prefetch(cls, nodes, handler):
+        _prefetch(
+            handler, m_models.QuestionDAO,
+            [node.attrib.get('quid') for node in nodes])
+
     def render(self, node, handler):
         """Renders a question."""
         locale = handler.app_context.get_environ()['course']['locale']
@@ -153,7 +186,7 @@ class QuestionTag(tags.BaseTag):
 
         html_string = render_question(
             quid, instanceid, locale, embedded=False, weight=weight,
-            progress=progress)
+            progress=progress, handler=handler)
         return tags.html_string_to_element_tree(html_string)
 
     def get_schema(self, unused_handler):
@@ -195,6 +228,20 @@ class QuestionGroupTag(tags.BaseTag):
     def vendor(cls):
         return 'gcb'
 
+    @classmethod
+    def prefetch(cls, nodes, handler):
+        qgids = [node.attrib.get('qgid') for node in nodes]
+        _prefetch(handler, m_models.QuestionGroupDAO, qgids)
+        quids = []
+        for qgid in qgids:
+            question_group_dto = _load(
+                handler, m_models.QuestionGroupDAO, qgid)
+            if question_group_dto:
+                quids += [
+                    item['question']
+                    for item in question_group_dto.dict['items']]
+        _prefetch(handler, m_models.QuestionDAO, quids)
+
     def render(self, node, handler):
         """Renders a question."""
 
@@ -202,7 +249,7 @@ class QuestionGroupTag(tags.BaseTag):
 
         qgid = node.attrib.get('qgid')
         group_instanceid = node.attrib.get('instanceid')
-        question_group_dto = m_models.QuestionGroupDAO.load(qgid)
+        question_group_dto = _load(handler, m_models.QuestionGroupDAO, qgid)
         if not question_group_dto:
             return tags.html_string_to_element_tree('[Deleted question group]')
 
@@ -226,7 +273,7 @@ class QuestionGroupTag(tags.BaseTag):
             question_instanceid = '%s.%s.%s' % (group_instanceid, ind, quid)
             template_values['question_html_array'].append(render_question(
                 quid, question_instanceid, locale, weight=item['weight'],
-                embedded=True
+                embedded=True, handler=handler
             ))
             js_data[question_instanceid] = item
         template_values['js_data'] = transforms.dumps(js_data)
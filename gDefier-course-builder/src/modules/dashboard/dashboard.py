@@ -95,7 +95,9 @@ class DashboardHandler(
         'compute_student_stats', 'create_or_edit_settings', 'add_unit',
         'add_link', 'add_assessment', 'add_lesson', 'index_course',
         'clear_index', 'edit_basic_course_settings', 'add_reviewer',
-        'delete_reviewer','edit_gDefier_course_settings']
+        'delete_reviewer','edit_gDefier_course_settings',
+        'enrol_gDefier_roster', 'schedule_gDefier_tournament',
+        'rebuild_gDefier_rankings', 'rebuild_gDefier_matchmaking']
     nav_mappings = [
         ('', 'Outline'),
         ('assets', 'Assets'),
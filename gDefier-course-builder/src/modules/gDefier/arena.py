@@ -0,0 +1,154 @@
+"""Live state of G-Defier defies shared by both players of an arena."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+import time
+
+from models.models import CAN_USE_MEMCACHE
+from models.models import MemcacheManager
+
+from google.appengine.api import memcache
+
+# Live state lives longer than a defy usually lasts; an evicted record is
+# rebuilt from the GDefierDefy entity.
+STATE_TTL_SECS = 60 * 60
+
+# Attempts to update the record before giving up to a concurrent writer.
+MAX_CAS_RETRIES = 10
+
+
+def _now_version():
+    # A rebuilt record must not reuse a version clients may still hold.
+    return int(time.time() * 1000)
+
+
+class ArenaState(object):
+    """Versioned rounds, ends and scores of both sides of one defy.
+
+    Round changes are only recorded here; the GDefierDefy entity is written
+    when a side ends or answers a question, or when memcache is disabled.
+    """
+
+    FIELDS = ['rround', 'lround', 'rended', 'lended', 'rscore', 'lscore']
+
+    def __init__(self, values):
+        self._values = values
+
+    @classmethod
+    def _memcache_key(cls, defy_key):
+        return 'gdefier:arena:%s' % defy_key
+
+    @classmethod
+    def _from_defy(cls, defy, version):
+        values = dict([(name, getattr(defy, name)) for name in cls.FIELDS])
+        values['version'] = version
+        return cls(values)
+
+    @property
+    def version(self):
+        return self._values['version']
+
+    def round_of(self, side):
+        if side == 'right':
+            return self._values['rround']
+        return self._values['lround']
+
+    def to_dict(self):
+        return dict(self._values)
+
+    @classmethod
+    def load(cls, defy):
+        """Returns the live state of a defy, rebuilding it if needed."""
+        key = cls._memcache_key(defy.key())
+        values = MemcacheManager.get(key)
+        if values is not None:
+            return cls(values)
+        state = cls._from_defy(defy, _now_version())
+        MemcacheManager.set(key, state.to_dict(), ttl=STATE_TTL_SECS)
+        return state
+
+    @classmethod
+    def peek(cls, defy_key):
+        """Returns the cached state of a defy or None; never reads datastore."""
+        values = MemcacheManager.get(cls._memcache_key(defy_key))
+        if values is None:
+            return None
+        return cls(values)
+
+    @classmethod
+    def _cas(cls, defy_key, mutator):
+        client = memcache.Client()
+        key = cls._memcache_key(defy_key)
+        namespace = MemcacheManager.get_namespace()
+        for unused_attempt in range(MAX_CAS_RETRIES):
+            values = client.gets(key, namespace=namespace)
+            if values is None:
+                return None
+            if not mutator(values):
+                return cls(values)
+            values['version'] += 1
+            if client.cas(key, values, STATE_TTL_SECS, namespace=namespace):
+                return cls(values)
+        return None
+
+    @classmethod
+    def advance(cls, defy, side, number):
+        """Records that one side of a defy has started a given round.
+
+        Rounds only move forward, so stale or repeated presses are ignored.
+
+        Returns:
+            The updated ArenaState.
+        """
+        field = 'rround' if side == 'right' else 'lround'
+
+        def mutator(values):
+            if values[field] >= number:
+                return False
+            values[field] = number
+            return True
+
+        state = None
+        if CAN_USE_MEMCACHE.value:
+            cls.load(defy)
+            state = cls._cas(defy.key(), mutator)
+        if state is None:
+            # No shared record to update; fall back to the datastore.
+            if getattr(defy, field) < number:
+                setattr(defy, field, number)
+                defy.put()
+            state = cls.sync(defy)
+        return state
+
+    @classmethod
+    def sync(cls, defy):
+        """Replaces the state with a defy just written to the datastore.
+
+        Rounds recorded only in the live state are kept. The record is
+        updated with compare-and-set, so a round advanced concurrently is not
+        overwritten.
+        """
+        state = cls._from_defy(defy, _now_version())
+        if not CAN_USE_MEMCACHE.value:
+            return state
+
+        def mutator(values):
+            for field in cls.FIELDS:
+                if field in ['rround', 'lround']:
+                    values[field] = max(values[field], state._values[field])
+                else:
+                    values[field] = state._values[field]
+            return True
+
+        client = memcache.Client()
+        # A record created concurrently makes add() fail; update it then.
+        for unused_attempt in range(2):
+            updated = cls._cas(defy.key(), mutator)
+            if updated:
+                return updated
+            if client.add(
+                    cls._memcache_key(defy.key()), state.to_dict(),
+                    STATE_TTL_SECS,
+                    namespace=MemcacheManager.get_namespace()):
+                return state
+        return state
@@ -0,0 +1,38 @@
+"""Elo skill ratings of G-Defier players."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+# Rating of a player that has not played yet.
+DEFAULT_RATING = 1200
+
+# Most rating points a player can win or lose in one defy.
+K_FACTOR = 32
+
+# Opponents suggested to a player are at most this many points away.
+OPPONENT_WINDOW = 200
+
+
+def expected(rating, opponent_rating):
+    """Returns the probability a player beats an opponent, from 0 to 1."""
+    return 1.0 / (1 + 10 ** ((opponent_rating - rating) / 400.0))
+
+
+def deltas(rrating, lrating, winner):
+    """Returns the rating change of the right and the left side of a defy.
+
+    Args:
+        rrating: int. Rating of the right side before the defy.
+        lrating: int. Rating of the left side before the defy.
+        winner: 'r', 'l' or None for a tie.
+
+    Returns:
+        A (right delta, left delta) tuple of ints adding up to zero.
+    """
+    if winner == 'r':
+        outcome = 1.0
+    elif winner == 'l':
+        outcome = 0.0
+    else:
+        outcome = 0.5
+    delta = int(round(K_FACTOR * (outcome - expected(rrating, lrating))))
+    return delta, -delta
@@ -13,6 +13,9 @@ import logging
 import datetime
 import re
 import ast
+import cgi
+import copy
+import hashlib
 from google.appengine.ext import db
 
 from controllers import utils
@@ -25,12 +28,18 @@ from controllers.sites import ApplicationContext
 from models import models
 from models import content
 from models import custom_modules
+from models import jobs
 from models import vfs
 from models import courses
 from models import roles
 from models import transforms
 from models.courses import deep_dict_merge
+from models.models import MemcacheManager
+import arena
 import gDefier_model
+import leaderboard
+import question_cast
+import tournament
 
 from tools import verify
 
@@ -40,6 +49,7 @@ from modules.dashboard import filer
 from modules.dashboard import messages
 from modules.dashboard.course_settings import CourseSettingsRights
 
+from google.appengine.api import namespace_manager
 from google.appengine.api import users
 
 GCB_GDEFIER_FOLDER_NAME = os.path.normpath('/modules/gDefier/')
@@ -59,34 +69,134 @@ def get_gDefier_config_filename(self):
 def get_course_dict():
         return get_environ2()
     
-def get_environ2():
-    """Returns currently defined course settings as a dictionary."""
-    gDefier_yaml = None
+# Parsed gDefier.yaml settings of each namespace held by this instance, as a
+# (version, settings) tuple.
+GDEFIER_SETTINGS_CACHE = {}
+
+# Compiled question casts of the blocks of each namespace, as a (version,
+# {block_title: [question descriptors]}) tuple.
+GDEFIER_QUESTIONS_CACHE = {}
+
+def _settings_version_key():
+    return 'gdefier:settings:version'
+
+def _settings_key(version):
+    return 'gdefier:settings:%s' % version
+
+def _open_settings_file(app_context):
+    """Returns the name of gDefier.yaml and a stream of it, or None."""
+    filename = sites.abspath(
+        app_context.get_home_folder(), DFR_CONFIG_FILENAME)
+    if app_context.fs.isfile(filename):
+        return filename, app_context.fs.open(filename)
+    return filename, None
+
+def _metadata_version(stream):
+    """Returns a version stamp of an opened gDefier.yaml, or None.
+
+    Only files with metadata have one; it is known without reading them.
+    """
+    metadata = getattr(stream, 'metadata', None)
+    if metadata and metadata.updated_on:
+        return metadata.updated_on.isoformat()
+    return None
+
+def _file_version(stream):
+    """Returns a version stamp of an opened gDefier.yaml."""
+    version = _metadata_version(stream)
+    if version:
+        return version
+    return hashlib.md5(stream.read()).hexdigest()
+
+def _parse_environ(course_data_filename, raw_bytes):
     gDefier_yaml_dict = None
-    
-    ns = ApplicationContext.get_namespace_name_for_request()
-    app_context = sites.get_app_context_for_namespace(ns)
-
-    course_data_filename = sites.abspath(app_context.get_home_folder(), DFR_CONFIG_FILENAME)
-
-    if app_context.fs.isfile(course_data_filename):
-        gDefier_yaml = app_context.fs.open(course_data_filename)
-    if not gDefier_yaml:
-        return deep_dict_merge(gDefier_model.DEFAULT_COURSE_GDEFIER_DICT,
-                               [])
-    try:
-        gDefier_yaml_dict = yaml.safe_load(
-            gDefier_yaml.read().decode('utf-8'))
-    except Exception as e:  # pylint: disable-msg=broad-except
-        logging.info(
-            'Error: gDefier.yaml file at %s not accessible, '
-            'loading defaults. %s', course_data_filename, e)
+    if raw_bytes is not None:
+        try:
+            gDefier_yaml_dict = yaml.safe_load(raw_bytes.decode('utf-8'))
+        except Exception as e:  # pylint: disable-msg=broad-except
+            logging.info(
+                'Error: gDefier.yaml file at %s not accessible, '
+                'loading defaults. %s', course_data_filename, e)
 
     if not gDefier_yaml_dict:
         return deep_dict_merge(gDefier_model.DEFAULT_COURSE_GDEFIER_DICT,
                                [])
     return deep_dict_merge(
         gDefier_yaml_dict, gDefier_model.DEFAULT_COURSE_GDEFIER_DICT)
+
+def _get_settings(ns):
+    """Returns a (version, settings) tuple; settings must not be modified.
+
+    The merged settings are cached per namespace in this instance and in
+    memcache under the version of gDefier.yaml they were parsed from, so the
+    file is only parsed again after it changes.
+    """
+    cached = GDEFIER_SETTINGS_CACHE.get(ns)
+
+    version = MemcacheManager.get(_settings_version_key(), namespace=ns)
+    if version:
+        if cached and cached[0] == version:
+            return cached
+        settings = MemcacheManager.get(_settings_key(version), namespace=ns)
+        if settings:
+            GDEFIER_SETTINGS_CACHE[ns] = (version, settings)
+            return version, settings
+
+    app_context = sites.get_app_context_for_namespace(ns)
+    # Files of a read-only file system never change while this instance
+    # runs, so they are parsed once.
+    if cached and not app_context.fs.is_read_write():
+        return cached
+
+    course_data_filename, gDefier_yaml = _open_settings_file(app_context)
+    raw_bytes = None
+    if gDefier_yaml:
+        version = _metadata_version(gDefier_yaml)
+        if not (version and cached and cached[0] == version):
+            raw_bytes = gDefier_yaml.read()
+            if not version:
+                version = hashlib.md5(raw_bytes).hexdigest()
+    else:
+        version = 'default'
+
+    if cached and cached[0] == version:
+        settings = cached[1]
+    else:
+        settings = _parse_environ(course_data_filename, raw_bytes)
+        GDEFIER_SETTINGS_CACHE[ns] = (version, settings)
+    MemcacheManager.set(_settings_key(version), settings, namespace=ns)
+    # Only invalidate_environ2() replaces the version, so a request that read
+    # the file before it changed never puts the old version back.
+    MemcacheManager.add(_settings_version_key(), version, namespace=ns)
+    return version, settings
+
+def get_environ2():
+    """Returns currently defined course settings as a dictionary."""
+    ns = ApplicationContext.get_namespace_name_for_request()
+    return copy.deepcopy(_get_settings(ns)[1])
+
+def get_block_questions(block_title):
+    """Returns the compiled question descriptors of a block.
+
+    Question casts are compiled once per version of the settings.
+    """
+    ns = ApplicationContext.get_namespace_name_for_request()
+    version, settings = _get_settings(ns)
+    cached = GDEFIER_QUESTIONS_CACHE.get(ns)
+    if not cached or cached[0] != version:
+        cached = (version, question_cast.compile_blocks(
+            settings['module']['blocks']))
+        GDEFIER_QUESTIONS_CACHE[ns] = cached
+    return cached[1].get(block_title, [])
+
+def invalidate_environ2(ns):
+    """Drops cached settings of a namespace after gDefier.yaml has changed."""
+    GDEFIER_SETTINGS_CACHE.pop(ns, None)
+    GDEFIER_QUESTIONS_CACHE.pop(ns, None)
+    unused_filename, gDefier_yaml = _open_settings_file(
+        sites.get_app_context_for_namespace(ns))
+    version = _file_version(gDefier_yaml) if gDefier_yaml else 'default'
+    MemcacheManager.set(_settings_version_key(), version, namespace=ns)
     
         
 class RegisterDefierHandler(BaseHandler):
@@ -104,8 +214,8 @@ class RegisterDefierHandler(BaseHandler):
         course_info = get_course_dict()
         blocks =  course_info['module']['blocks']
         if blocks:
-            for b in blocks:
-                gDefier_model.add_block_to_player(self, b['block_title'])
+            gDefier_model.add_blocks_to_player(
+                self, [b['block_title'] for b in blocks])
             self.redirect('/gDefier/home?registered=yes')
         else:
             self.redirect('/gDefier/home')   
@@ -117,9 +227,9 @@ class BlocksHandler(BaseHandler):
         self.redirect('/gDefier/block?title=' + block_title)
 
     def accept_request(self, user, block_title):  
-        gDefier_model.del_request_challenge(self, user, block_title)
-        # Create a challenge
-        gDefier_model.create_defy(self, user, block_title)
+        # Create a challenge, once even if the invitation is accepted twice
+        if gDefier_model.del_request_challenge(self, user, block_title):
+            gDefier_model.create_defy(self, user, block_title)
         self.redirect('/gDefier/block?title=' + block_title)
 
     def reject_request(self, user, block_title):
@@ -149,89 +259,58 @@ class BlocksHandler(BaseHandler):
 
         block = gDefier_model.add_block_to_player(self, block_title)
         
-        invitations=[]
-        if block.request:
-            invitations = block.request
+        invitations, invitations_cursor = gDefier_model.player_invitations(
+            self, block_title, received=True,
+            cursor=self.request.get('inv_cursor') or None)
+        sends, sends_cursor = gDefier_model.player_invitations(
+            self, block_title, received=False,
+            cursor=self.request.get('sends_cursor') or None)
 
         b_stats = gDefier_model.to_dict(block)
         b_stats.pop('player')
         b_stats.pop('blockID')
+        b_stats.pop('request')
+        b_stats.pop('sends')
+        b_stats.update(gDefier_model.block_stats(block))
         b_info.pop('question_cast')
+        questions = get_block_questions(block_title)
 
         path = sites.abspath(self.app_context.get_home_folder(),
                      GCB_GDEFIER_FOLDER_NAME)
         page = 'templates/gDefier_blocks.html'
         
         # Avoiding repeated opponents or defies
-        players = gDefier_model.get_players(self)
-        board_block = gDefier_model.GDefierBoardBlock.gql("WHERE blockID = '" + block_title + "'").get()
-        opponents = []
-        s1 = ""
-        s2 = ""
-        me = self.get_user().nickname()
-        for p in players:
-            existing_defy = False
-            if p.blocks.count() == 0:
-                #User unregistered in G-Defier module yet
-                continue
-            for s1 in block.sends:
-                if p.name == s1:
-                    break
-            for s2 in block.request:
-                if p.name == s2:
-                    break
-            if p.name == s1 or p.name == s2 or p.name == me:
-                    continue
-            for df in board_block.defies:
-                if df.rname == p.name and df.lname == me:
-                    existing_defy = True
-                    break
-                elif df.rname == me and df.lname == p.name:
-                    existing_defy = True
-                    break
-            if existing_defy:
-                continue
-            opponents.append(p.name)
+        by_skill = self.request.get('order') != 'name'
+        opponents = gDefier_model.player_opponents(
+            self, block, by_skill=by_skill)
             
-        my_defies = gDefier_model.player_defies(self, block_title)
+        ongoing_defies, ended_defies, next_cursor = (
+            gDefier_model.player_defies(
+                self, block_title, cursor=self.request.get('cursor') or None))
 
         template = self.get_template(page, additional_dirs=[path])
         self.template_value['navbar'] = {'gDefier': True}
         self.template_value['w_module'] = course_info['module']['w_module']
         self.template_value['b_info'] = b_info
         self.template_value['b_stats'] = b_stats
+        self.template_value['questions'] = questions
         self.template_value['block'] = block
         self.template_value['players'] = opponents
-        self.template_value['invitations'] = invitations
+        self.template_value['by_skill'] = by_skill
+        self.template_value['invitations'] = [i.sender for i in invitations]
+        self.template_value['invitations_cursor'] = invitations_cursor
+        self.template_value['sends'] = [i.receiver for i in sends]
+        self.template_value['sends_cursor'] = sends_cursor
         self.template_value['user'] = self.get_user().nickname()
-        self.template_value['my_defies'] = my_defies
+        self.template_value['ongoing_defies'] = ongoing_defies
+        self.template_value['ended_defies'] = ended_defies
+        self.template_value['next_cursor'] = next_cursor
         self.render(template)
 
 class ArenaHandler(BaseHandler):
     
-    def academy_answer(self, khandata):
-        data = models.EventEntity.get(khandata)
-        js_data = json.loads(data.data)
-        
-        # Getting the defy key presented in the location attribute of the model entity
-        # Nothing has to be after defy in location...
-        defy_key =  js_data['location'].split("defy%253D")[-1]
-        defy = db.get(defy_key)
-        gDefier_model.answer_solver(self, defy, js_data)
-            
-    def end_defy(self, defy_key, side, n_defies): 
-        defy = db.get(defy_key)
-        if side == 'right':
-            defy.rended = True
-            if defy.lended:
-                # Defy completely ENDED (2 sides)
-                gDefier_model.defy_solver(self, defy, n_defies)
-        else:
-            defy.lended = True
-            if defy.rended:
-                # Defy completely ENDED (2 sides)
-                gDefier_model.defy_solver(self, defy, n_defies)
-        defy.put()
+    def end_defy(self, defy_key, side): 
+        gDefier_model.end_defy(self, defy_key, side)
         self.redirect('/gDefier/arena?defy=' + defy_key)
     
     def post(self):
@@ -239,29 +318,20 @@ class ArenaHandler(BaseHandler):
         side = self.request.get('side')
         defy_key = self.request.get('defy')
         defy = db.get(defy_key)
-        if side == 'right':
-            defy.rround = int(button)
-        else:
-            defy.lround = int(button)
-        defy.put()
+        arena.ArenaState.advance(defy, side, int(button))
     
     def get(self):
         """Handles GET requests."""
         if not self.personalize_page_and_get_enrolled():
             return
 
-        # Cathing Khan answer
-        if self.request.get('khandata'):
-            self.academy_answer(self.request.get('khandata'))
-            return
-        
         defy_key = self.request.get('defy')
         
         course_info = get_course_dict()   
         
         # Cathing END exercise
         if self.request.get('end'):
-            self.end_defy(defy_key, self.request.get('end'), course_info['module']['n_defies'])
+            self.end_defy(defy_key, self.request.get('end'))
 
         defy = gDefier_model.GDefierDefy.get(defy_key)
         
@@ -270,24 +340,19 @@ class ArenaHandler(BaseHandler):
                      GCB_GDEFIER_FOLDER_NAME)
         page = 'templates/gDefier_arena.html'        
 
-        nick = self.get_user().nickname()
-        if defy.rname == nick:
-            side = 'right'
-        elif defy.lname == nick:
-            side = 'left'
-        else:
-            side = None
+        side = get_defy_side(self, defy)
+        if not side:
             # Defy from others users...
             page = 'error.html'
+        state = arena.ArenaState.load(defy)
         
         """ Getting rounds per defy and possible questions of this bloc"""
-        rounds = course_info['module']['defy']['n_round']
-        for b in course_info['module']['blocks']:
-            if defy.block_board.blockID == b['block_title']:
-                question = b['question_cast']
-                break
-        question = re.findall('[^>]+>', question)
-        questions = [i+j for i,j in zip(question[::2],question[1::2])]
+        rounds = int(course_info['module']['defy']['n_round'])
+        questions = question_cast.assign_rounds(
+            get_block_questions(defy.block_board.blockID), rounds,
+            order=course_info['module']['defy'].get('question_order'),
+            seed=defy_key)
+        questions = [q['html'] for q in questions]
         
         t_round = course_info['module']['defy']['round_time']
 
@@ -298,30 +363,80 @@ class ArenaHandler(BaseHandler):
         self.template_value['rounds'] = rounds
         self.template_value['t_round'] = t_round
         self.template_value['side'] = side
+        self.template_value['defy_round'] = state.round_of(side)
+        self.template_value['state_version'] = state.version
         self.template_value['self'] = self
         self.render(template)
 
+def get_defy_side(self, defy):
+    """Returns 'right' or 'left' for a player of a defy, None otherwise."""
+    nick = self.get_user().nickname()
+    if defy.rname == nick:
+        return 'right'
+    elif defy.lname == nick:
+        return 'left'
+    return None
+
+class ArenaStateHandler(BaseHandler):
+    """Serves the live state of a defy to the players in its arena.
+
+    A client passes the version it already has, either as the 'version'
+    parameter or as an If-None-Match header. The request never waits: if the
+    state did not change, 304 is returned at once and the client asks again
+    later, backing off while nothing changes.
+    """
+
+    def get(self):
+        """Handles GET requests."""
+        if not self.personalize_page_and_get_enrolled():
+            return
+
+        defy = gDefier_model.GDefierDefy.get(self.request.get('defy'))
+        if not defy or not get_defy_side(self, defy):
+            transforms.send_json_response(self, 404, 'Defy not found.')
+            return
+
+        version = self.request.get('version') or self.request.headers.get(
+            'If-None-Match', '').strip('"')
+        try:
+            version = int(version)
+        except ValueError:
+            version = None
+
+        state = arena.ArenaState.load(defy)
+        self.response.headers['ETag'] = '"%s"' % state.version
+        self.response.headers['Cache-Control'] = 'no-cache'
+        if state.version == version:
+            self.response.set_status(304)
+            return
+        transforms.send_json_response(
+            self, 200, 'Success.', payload_dict=state.to_dict())
+
 class StudentDefierHandler(BaseHandler):
     
     def post(self):
         kind = self.request.get('classification')
-        
-        x =gDefier_model.GDefierPlayer.all()
-        if kind=="score" or kind=="attempts" or kind=="wins":
-            ascend="-"
-        else:
-            ascend=""
-        y = x.order(ascend+kind)
-        result = """<div align=center><table>"""
+        if kind not in leaderboard.METRICS:
+            self.error(400)
+            return
+
+        ranking = gDefier_model.get_ranking(self, kind)
+        rows = ranking.page(0, leaderboard.MAX_PAGE_SIZE)
         me = self.get_user().nickname()
-        num = 1
-        for z in y:
-            z = gDefier_model.to_dict(z)
-            if me == z["name"]:
-                result += """<tr style="color: black; background: white;"><td align="center" valign="middle">""" + str(num) + """. </td><td align="center" valign="middle">""" + z["name"] + """</td><td align="center" valign="middle">""" + z[kind] + "</td></tr>"
+        if me not in [row['name'] for row in rows]:
+            player = gDefier_model.get_player(self)
+            if player:
+                value = getattr(player, kind)
+                rows.append({
+                    'rank': ranking.rank_of(value), 'name': me, 'value': value})
+
+        result = """<div align=center><table>"""
+        for row in rows:
+            if me == row["name"]:
+                result += """<tr style="color: black; background: white;">"""
             else:
-                result += """<tr><td align="center" valign="middle">""" + str(num) + """. </td><td align="center" valign="middle">""" + z["name"] + """</td><td align="center" valign="middle">""" + z[kind] + "</td></tr>"
-            num+=1
+                result += """<tr>"""
+            result += """<td align="center" valign="middle">""" + str(row["rank"]) + """. </td><td align="center" valign="middle">""" + cgi.escape(row["name"]) + """</td><td align="center" valign="middle">""" + str(row["value"]) + "</td></tr>"
         result += "</table></div>"    
         
         self.response.out.write(result)
@@ -359,7 +474,7 @@ class StudentDefierHandler(BaseHandler):
         
         prctng = []
         for b in player.blocks:
-            n = int(b.wins*100/entity['module']['n_defies'])
+            n = int(gDefier_model.block_stats(b)['wins']*100/entity['module']['n_defies'])
             for i in range(entity['module']['blocks'].__len__()):
                 if entity['module']['blocks'][i]["block_title"]==b.blockID:
                     prctng.insert(i, "n"+str(n))
@@ -373,10 +488,76 @@ class StudentDefierHandler(BaseHandler):
         self.template_value['navbar'] = {'gDefier': True}
         self.template_value['entity'] = entity
         self.template_value['player'] = player
+        self.template_value['stats'] = gDefier_model.player_stats(player)
         self.template_value['prctng'] = prctng
         self.template_value['noprctng'] = noprctng
         self.render(template)
 
+class LeaderboardHandler(BaseHandler):
+    """Serves pages of the G-Defier rankings as JSON."""
+
+    def get(self):
+        """Handles GET requests."""
+        if not self.personalize_page_and_get_enrolled():
+            return
+
+        metric = self.request.get('metric', 'score')
+        if metric not in leaderboard.METRICS:
+            transforms.send_json_response(
+                self, 400, 'Unknown metric.', {'metric': metric})
+            return
+        try:
+            page = max(int(self.request.get('page', 0)), 0)
+            page_size = int(self.request.get(
+                'page_size', leaderboard.DEFAULT_PAGE_SIZE))
+        except ValueError:
+            transforms.send_json_response(self, 400, 'Bad page.')
+            return
+        page_size = min(max(page_size, 1), leaderboard.MAX_PAGE_SIZE)
+
+        ranking = gDefier_model.get_ranking(self, metric)
+        payload = {
+            'metric': metric,
+            'page': page,
+            'page_size': page_size,
+            'total': ranking.total,
+            'entries': ranking.page(page * page_size, page_size)}
+
+        player = gDefier_model.get_player(self)
+        if player:
+            value = getattr(player, metric)
+            payload['me'] = {
+                'name': player.name,
+                'rank': ranking.rank_of(value),
+                'value': value}
+
+        transforms.send_json_response(
+            self, 200, 'Success.', payload_dict=payload)
+
+class FoldStatsHandler(utils.BaseHandler):
+    """Folds pending G-Defier statistics counters of all courses.
+
+    Runs from cron; a run that overlaps a previous one that is still folding
+    the statistics of a course skips that course.
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        old_namespace = namespace_manager.get_namespace()
+        try:
+            for context in sites.get_all_courses():
+                namespace = context.get_namespace_name()
+                namespace_manager.set_namespace(namespace)
+                n_defies = _get_settings(namespace)[1]['module']['n_defies']
+                count = gDefier_model.fold_stats(namespace, n_defies)
+                if count:
+                    logging.info(
+                        'Folded G-Defier statistics of %s entities in "%s".',
+                        count, namespace)
+        finally:
+            namespace_manager.set_namespace(old_namespace)
+        self.response.write('OK\n')
+
 class GDefierDashboardHandler(object):
     """Should only be inherited by DashboardHandler, not instantiated."""
 
@@ -410,6 +591,25 @@ class GDefierDashboardHandler(object):
                 'xsrf_token': self.create_xsrf_token(
                     'edit_gDefier_course_settings')})
 
+        gDefier_actions.append({
+            'id': 'enrol_gDefier_roster',
+            'caption': 'Enrol All Students',
+            'action': self.get_action_url('enrol_gDefier_roster'),
+            'xsrf_token': self.create_xsrf_token('enrol_gDefier_roster')})
+
+        gDefier_actions.append({
+            'id': 'rebuild_gDefier_rankings',
+            'caption': 'Rebuild Rankings',
+            'action': self.get_action_url('rebuild_gDefier_rankings'),
+            'xsrf_token': self.create_xsrf_token('rebuild_gDefier_rankings')})
+
+        gDefier_actions.append({
+            'id': 'rebuild_gDefier_matchmaking',
+            'caption': 'Rebuild Matchmaking',
+            'action': self.get_action_url('rebuild_gDefier_matchmaking'),
+            'xsrf_token': self.create_xsrf_token(
+                'rebuild_gDefier_matchmaking')})
+
         # gDefier.yaml file content.
         gDefier_info = []
 
@@ -422,19 +622,102 @@ class GDefierDashboardHandler(object):
         else:
             gDefier_info.append('< empty file >')
 
+        # Status of the last roster enrolment.
+        enrolment_info = []
+        job = gDefier_model.EnrolRosterJob(self.app_context, []).load()
+        if not job:
+            enrolment_info.append('Students were never enrolled in bulk.')
+        elif job.status_code == jobs.STATUS_CODE_COMPLETED:
+            counts = transforms.loads(job.output)
+            enrolment_info.append(
+                'Enrolled %s students (%s new players) in %s seconds, '
+                'finished on %s.' % (
+                    counts['students'], counts['created'],
+                    job.execution_time_sec, job.updated_on))
+        elif job.status_code == jobs.STATUS_CODE_FAILED:
+            enrolment_info.append(
+                'Enrolment failed on %s.' % job.updated_on)
+        else:
+            enrolment_info.append('Enrolment is in progress.')
+
         # Prepare template values.
         template_values['sections'] = [
             {
                 'title': 'Contents of DATA table from gDefier DB',
                 'description': "General settings for G-Defier Module to this course.",
                 'actions': gDefier_actions,
-                'children': gDefier_info}]
+                'children': gDefier_info},
+            {
+                'title': 'Student enrolment',
+                'description': "Registers every enrolled student of this course in all G-Defier blocks.",
+                'children': enrolment_info}]
+
+        # Tournaments of every block.
+        for b in get_course_dict()['module']['blocks'] or []:
+            block_ID = b['block_title']
+            record = tournament.GDefierTournament.get_by_key_name(block_ID)
+            if record:
+                tournament_info = [
+                    'System: %s, rounds: %s, %s: %s of %s defies.' % (
+                        record.system, record.rounds, record.status,
+                        record.defies_created, record.defies_total)]
+            else:
+                tournament_info = ['No tournament was scheduled.']
+            tournament_actions = []
+            for system, caption in [
+                    (tournament.SYSTEM_ROUND_ROBIN, 'Round Robin'),
+                    (tournament.SYSTEM_SWISS, 'Next Swiss Round')]:
+                tournament_actions.append({
+                    'id': 'schedule_gDefier_tournament_%s_%s' % (
+                        system, len(template_values['sections'])),
+                    'caption': caption,
+                    'action': self.get_action_url(
+                        'schedule_gDefier_tournament',
+                        extra_args={'block': block_ID, 'system': system}),
+                    'xsrf_token': self.create_xsrf_token(
+                        'schedule_gDefier_tournament')})
+            template_values['sections'].append({
+                'title': 'Tournament of block "%s"' % block_ID,
+                'description': "Creates defies between all players registered in this block.",
+                'actions': tournament_actions,
+                'children': tournament_info})
 
         self.render_page(template_values)
 
 class GDefierSettingsHandler(object):
     """G-Defier settings handler."""
 
+    def post_schedule_gDefier_tournament(self):
+        """Submits a job creating the defies of a tournament of a block."""
+        block_ID = self.request.get('block')
+        system = self.request.get('system')
+        blocks = get_course_dict()['module']['blocks'] or []
+        if (system not in tournament.SYSTEMS or
+            block_ID not in [b['block_title'] for b in blocks]):
+            self.error(400)
+            return
+        gDefier_model.ScheduleTournamentJob(
+            self.app_context, block_ID, system).submit()
+        self.redirect('/dashboard?action=gDefier')
+
+    def post_enrol_gDefier_roster(self):
+        """Submits a job registering all students in all G-Defier blocks."""
+        blocks = get_course_dict()['module']['blocks'] or []
+        gDefier_model.EnrolRosterJob(self.app_context, blocks).submit()
+        self.redirect('/dashboard?action=gDefier')
+
+    def post_rebuild_gDefier_rankings(self):
+        """Submits a job building all rankings again from the players."""
+        gDefier_model.RebuildRankingsJob(self.app_context).submit()
+        self.redirect('/dashboard?action=gDefier')
+
+    def post_rebuild_gDefier_matchmaking(self):
+        """Submits a job building the matchmaking index of every block."""
+        blocks = get_course_dict()['module']['blocks'] or []
+        gDefier_model.RebuildMatchmakingJob(
+            self.app_context, [b['block_title'] for b in blocks]).submit()
+        self.redirect('/dashboard?action=gDefier')
+
     def post_edit_gDefier_course_settings(self):
         """Handles editing of DATA table from gDefier.db"""
         assert is_editable_fs(self.app_context)
@@ -446,6 +729,7 @@ class GDefierSettingsHandler(object):
         if not fs.isfile(course_yaml):
             fs.put(course_yaml, vfs.string_to_stream(
                 courses.EMPTY_COURSE_YAML % users.get_current_user().email()))
+            invalidate_environ2(self.app_context.get_namespace_name())
         
         self.redirect(self.get_action_url(
             'edit_gDefier_settings', key='/gDefier.yaml'))
@@ -557,6 +841,7 @@ class GDefierSettingsRESTHandler(BaseRESTHandler):
         fs = self.app_context.fs.impl
         filename = fs.physical_to_logical(key)
         fs.put(filename, content_stream)
+        invalidate_environ2(self.app_context.get_namespace_name())
 
         # Send reply.
         transforms.send_json_response(self, 200, 'Saved.')
@@ -572,12 +857,14 @@ def register_module():
         ('/gDefier/home', StudentDefierHandler),
         ('/gDefier/register', RegisterDefierHandler),
         ('/gDefier/block', BlocksHandler),
-        ('/gDefier/arena', ArenaHandler)
+        ('/gDefier/arena', ArenaHandler),
+        ('/gDefier/arena/state', ArenaStateHandler),
+        ('/gDefier/leaderboard', LeaderboardHandler)
         ]
 
     global custom_module
     custom_module = custom_modules.Module(
         'gDefier',
         'A set of pages for using gDefier Module.',
-        [], gDefier_routes)
+        [('/cron/gdefier/fold_stats', FoldStatsHandler)], gDefier_routes)
     return custom_module
\ No newline at end of file
@@ -12,7 +12,24 @@ from common.schema_fields import SchemaField
 
 from controllers import sites
 
+from models import jobs
+from models import utils
+from models.models import MemcacheManager
+from models.models import NO_OBJECT
+from models.models import Student
+
+from google.appengine.api import namespace_manager
+from google.appengine.api import users
 from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+import arena
+import elo
+import leaderboard
+import matchmaking
+import membership
+import stats
+import tournament
 
 # Here are the defaults for a G-Defier module of a new course.
 DEFAULT_COURSE_GDEFIER_DICT = {
@@ -21,7 +38,7 @@ DEFAULT_COURSE_GDEFIER_DICT = {
        'blocks':[{'gdf_close_date': '2', 'w_block': 3, 'question_cast': '<khanex instanceid="KKkSLIxa1U2g" name="adding_decimals"></khanex><khanex instanceid="vYmNEoc8xxSM" name="absolute_value"></khanex>', 'gdf_start_date': '2', 'block_title': 'Primero'}, {'gdf_close_date': '2', 'w_block': 3, 'question_cast': '<khanex instanceid="KKkSLIxa1U2g" name="adding_decimals"></khanex><khanex instanceid="vYmNEoc8xxSM" name="absolute_value"></khanex>', 'gdf_start_date': '2', 'block_title': 'Segundo'}],
        'max_defies':8,
        'n_defies':3,
-       'defy' : {'time2accept': '24', 'n_round': '2', 'round_time': '2'}    
+       'defy' : {'time2accept': '24', 'n_round': '2', 'round_time': '2', 'question_order': 'sequential'}    
       }                  
 }
 
@@ -91,6 +108,13 @@ def create_gdefier_module_registry():
     defy_type.add_property(SchemaField(
         'module:defy:round_time', 'Round time', 'integer',
         description='Time in minutes to respond into each round'))
+    defy_type.add_property(SchemaField(
+        'module:defy:question_order', 'Question order', 'select',
+        select_data=[
+            ('sequential', 'In the order of the question cast'),
+            ('round_robin', 'Rotated for each defy'),
+            ('random', 'Shuffled for each defy')],
+        description='How the questions of a block are assigned to rounds'))
     
     block_type = schema_fields.FieldRegistry(
             'Question Block',
@@ -129,10 +153,11 @@ def create_gdefier_module_registry():
     return reg
 
 class GDefierGroup(db.Model):
+    """Players of a course; the namespace of the course is the key name."""
     name = db.StringProperty(indexed=True, required=True)
     @property
     def members(self):
-        return GDefierPlayer.gql("WHERE group = :1", self.key())
+        return get_members(self.key())
 
 class GDefierPlayer(db.Model):
     name = db.StringProperty(indexed=True, required=True)
@@ -142,6 +167,7 @@ class GDefierPlayer(db.Model):
     hints = db.IntegerProperty(indexed=True, default=0)
     wins = db.IntegerProperty(indexed=True, default=0)
     lost = db.IntegerProperty(indexed=True, default=0)
+    rating = db.IntegerProperty(indexed=True, default=elo.DEFAULT_RATING)
     """r_on = db.BooleanProperty(indexed=False, default=False)
     r_count = db.IntegerProperty(indexed=False, default=0)
     r_done = db.BooleanProperty(indexed=False, default=False)
@@ -162,19 +188,70 @@ class GDefierBlock(db.Model):
     score = db.ListProperty(item_type=int,default=[0,0,0,0])
     wins = db.IntegerProperty(indexed=False, default=0)
     lost = db.IntegerProperty(indexed=False, default=0)
+    rating = db.IntegerProperty(indexed=True, default=elo.DEFAULT_RATING)
+    # Deprecated; invitations are GDefierInvitation entities now.
     request = db.ListProperty(str)
     sends = db.ListProperty(str)
+
+    @classmethod
+    def make_key(cls, player_key, block_ID):
+        """Blocks are children of their player, keyed by blockID."""
+        return db.Key.from_path(cls.kind(), block_ID, parent=player_key)
     
 class GDefierBoard(db.Model):
+    """Board of a course; the namespace of the course is the key name."""
     name = db.StringProperty(indexed=True, required=True)  
     @property
     def members(self):
         return GDefierDefy.gql("WHERE board = :1", self.key())
     
+# Most entities written by one batch db.put().
+PUT_BATCH_SIZE = 500
+
+# Most values of one 'IN' query filter.
+IN_FILTER_SIZE = 30
+
+# Seconds a run of fold_stats() may take before another run can start.
+FOLD_LEASE_SECS = 10 * 60
+
+# Number of students registered per batch by EnrolRosterJob.
+ROSTER_BATCH_SIZE = 100
+
+# Number of ended defies listed per page of a block.
+DEFIES_PAGE_SIZE = 20
+
+# Number of invitations listed per page of a block.
+INVITATIONS_PAGE_SIZE = 20
+
+# Most pending invitations of a player considered when finding opponents.
+MAX_PENDING_INVITATIONS = 1000
+
+# Most players with a higher and with a lower rating suggested as opponents.
+MAX_RATED_OPPONENTS = 25
+
 class GDefierBoardBlock(db.Model):
+    """A block of the board of a course; blockID is the key name."""
     blockID = db.StringProperty(indexed=True, required=True)  
     # Board affiliation
     board = db.ListProperty(db.Key)
+    # Set once defies created before the participant index were indexed.
+    defies_indexed = db.BooleanProperty(indexed=False, default=False)
+    # Set once invitations kept in GDefierBlock lists were converted.
+    invitations_migrated = db.BooleanProperty(indexed=False, default=False)
+    # Set once blocks created before ratings existed were indexed.
+    ratings_indexed = db.BooleanProperty(indexed=False, default=False)
+
+class GDefierInvitation(db.Model):
+    """An invitation to a defy; key name is '<blockID>:<sender>:<receiver>'."""
+    blockID = db.StringProperty(indexed=True, required=True)
+    sender = db.StringProperty(indexed=True, required=True)
+    receiver = db.StringProperty(indexed=True, required=True)
+    created_on = db.DateTimeProperty(indexed=True, auto_now_add=True)
+
+    @classmethod
+    def make_key(cls, block_ID, sender, receiver):
+        return db.Key.from_path(
+            cls.kind(), '%s:%s:%s' % (block_ID, sender, receiver))
 
 class GDefierDefy(db.Model):
     block_board = db.ReferenceProperty(GDefierBoardBlock,
@@ -189,152 +266,655 @@ class GDefierDefy(db.Model):
     lround = db.IntegerProperty(indexed=False, default=0)
     rtime = db.TimeProperty(indexed=False)
     ltime = db.TimeProperty(indexed=False)
+    # Set once the result of the defy was applied to both players.
+    solved = db.BooleanProperty(indexed=True, default=False)
+    blockID = db.StringProperty(indexed=True)
+    # Names of both players, so defies of a player are an indexed query.
+    participants = db.StringListProperty(indexed=True)
+    created_on = db.DateTimeProperty(indexed=True, auto_now_add=True)
+
+    def get_blockID(self):
+        """Returns the blockID without loading block_board if possible."""
+        if self.blockID:
+            return self.blockID
+        return self.block_board.blockID
+
+class PlayerRepository(object):
+    """Loads and stores the GDefierPlayer entities of one course.
+
+    Players are keyed by course namespace and user_id, so looking up a player
+    is a get by key instead of a query by nickname. Every player loaded during
+    a request is kept in an identity map; memcache is used as a second tier and
+    is invalidated each time a player is put or deleted.
+    """
+
+    def __init__(self, namespace):
+        self._namespace = namespace
+        self._players = {}
+        self._names = {}
+
+    @classmethod
+    def make_key_name(cls, namespace, user_id):
+        return '%s:%s' % (namespace, user_id)
+
+    @classmethod
+    def _memcache_key(cls, key):
+        """Makes a memcache key from a player datastore key."""
+        return 'entity:gdefier-player:%s' % key
+
+    @classmethod
+    def _memcache_name_key(cls, name):
+        """Makes a memcache key for the nickname to player key mapping."""
+        return 'entity:gdefier-player-name:%s' % name
+
+    def make_key(self, user_id):
+        return db.Key.from_path(
+            GDefierPlayer.kind(), self.make_key_name(self._namespace, user_id))
+
+    def _remember(self, player):
+        self._players[str(player.key())] = player
+        self._names[player.name] = str(player.key())
+
+    def _load(self, key):
+        """Loads a player by key from the identity map, memcache or datastore."""
+        if str(key) in self._players:
+            return self._players[str(key)]
+        player = MemcacheManager.get(self._memcache_key(key))
+        if NO_OBJECT == player:
+            return None
+        if not player:
+            player = GDefierPlayer.get(key)
+            MemcacheManager.set(
+                self._memcache_key(key), player if player else NO_OBJECT)
+        if player:
+            self._remember(player)
+        return player
+
+    def _migrate(self, legacy, key):
+        """Re-keys a player created before players were keyed by user_id."""
+        player = GDefierPlayer(key_name=key.name(), name=legacy.name)
+        for name in GDefierPlayer.properties():
+            setattr(player, name, getattr(legacy, name))
+        player.put()
+        blocks = list(legacy.blocks)
+        for block in blocks:
+            block.player = player
+        db.put(blocks)
+        legacy.delete()
+        MemcacheManager.delete(self._memcache_key(key))
+        MemcacheManager.delete(self._memcache_name_key(player.name))
+        self._remember(player)
+        return player
+
+    def get(self, user):
+        """Returns the player of a given users.User or None."""
+        key = self.make_key(user.user_id())
+        player = self._load(key)
+        if not player:
+            legacy = GDefierPlayer.all().filter(
+                'name =', user.nickname()).get()
+            if legacy:
+                player = self._migrate(legacy, key)
+        return player
+
+    def get_by_name(self, name):
+        """Returns the player with a given nickname or None."""
+        key = self._names.get(name)
+        if not key:
+            key = MemcacheManager.get(self._memcache_name_key(name))
+        if key:
+            return self._load(db.Key(key))
+        player = GDefierPlayer.all().filter('name =', name).get()
+        if player:
+            self._remember(player)
+            MemcacheManager.set(
+                self._memcache_name_key(name), str(player.key()))
+        return player
+
+    def create(self, user, group_key):
+        """Creates and stores a new player for a given users.User."""
+        player = GDefierPlayer(
+            key_name=self.make_key_name(self._namespace, user.user_id()),
+            name=user.nickname(), group=[group_key])
+        self.put(player)
+        return player
+
+    def get_multi(self, users_list):
+        """Returns players of given users.User, None for users without one.
+
+        Players are read in one batch get; memcache is not used, so this is
+        meant for bulk jobs rather than for serving pages.
+        """
+        keys = [self.make_key(user.user_id()) for user in users_list]
+        unknown = [key for key in keys if str(key) not in self._players]
+        for player in db.get(unknown):
+            if player:
+                self._remember(player)
+
+        # Players created before they were keyed by user_id.
+        names = [user.nickname() for key, user in zip(keys, users_list)
+                 if str(key) not in self._players]
+        for i in range(0, len(names), IN_FILTER_SIZE):
+            query = GDefierPlayer.all().filter(
+                'name IN', names[i:i + IN_FILTER_SIZE])
+            for legacy in query:
+                if not legacy.key().name():
+                    for key, user in zip(keys, users_list):
+                        if user.nickname() == legacy.name:
+                            self._migrate(legacy, key)
+
+        return [self._players.get(str(key)) for key in keys]
+
+    def create_multi(self, users_list, group_key):
+        """Creates and stores new players for given users.User in one batch."""
+        players = [
+            GDefierPlayer(
+                key_name=self.make_key_name(self._namespace, user.user_id()),
+                name=user.nickname(), group=[group_key])
+            for user in users_list]
+        self.put_multi(players)
+        return players
+
+    def put(self, player):
+        self.put_multi([player])
+
+    def put_multi(self, players):
+        """Stores players in one batch and invalidates their cached copies."""
+        db.put(players)
+        self.invalidate(players)
+
+    def invalidate(self, players):
+        """Drops cached copies of players stored outside of this repository."""
+        for player in players:
+            self._remember(player)
+            MemcacheManager.delete(self._memcache_key(player.key()))
+
+    def delete(self, player):
+        self._players.pop(str(player.key()), None)
+        self._names.pop(player.name, None)
+        MemcacheManager.delete(self._memcache_key(player.key()))
+        MemcacheManager.delete(self._memcache_name_key(player.name))
+        player.delete()
+
+
+def get_player_repository(self):
+    """Returns the PlayerRepository bound to the current request handler."""
+    repository = getattr(self, '_gdefier_players', None)
+    if repository is None:
+        repository = PlayerRepository(namespace_manager.get_namespace())
+        self._gdefier_players = repository
+    return repository
+
 
 def get_player(self):
-    nick = self.get_user().nickname()
-    player = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
-    return player
+    return get_player_repository(self).get(self.get_user())
      
 def create_player(self):
-    nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
+    repository = get_player_repository(self)
+    alumn = repository.get(self.get_user())
     if not alumn:
         print "user created"
         #Creating and adding to correspondent group
-        course = sites.get_course_for_current_request()
-        aux_group = GDefierGroup.gql("WHERE name = '" + course.get_namespace_name() + "'").get()
-        if not aux_group:
-            print "First player..."
-            aux_group = create_group(self)
-        else:
-            aux_group=aux_group.key()
-        GDefierPlayer(name=nick, group=[aux_group]).put()
+        aux_group = create_group(self)
+        player = repository.create(self.get_user(), aux_group)
+        membership.Membership.add(aux_group, [player.key()])
+        leaderboard.Leaderboard.update(
+            [(player.name, leaderboard.values_of(player))])
         
 def delete_player(self):
-    nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
+    repository = get_player_repository(self)
+    alumn = repository.get(self.get_user())
     if alumn:
         print "Deleting player..."
         print "Player with blocks?"
         for block in alumn.blocks:
             "Deleting blocks..."
             delete_block(self, block.blockID)
-        alumn.delete()
+        leaderboard.Leaderboard.update([(alumn.name, None)])
+        repository.delete(alumn)
+        for group_key in alumn.group:
+            membership.Membership.remove(group_key, [alumn.key()])
 
-def add_block_to_player(self, block_ID):
-    nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
+def _rekey_block(alumn, b):
+    block = GDefierBlock(parent=alumn, key_name=b.blockID,
+                         player=alumn, blockID=b.blockID)
+    for name in GDefierBlock.properties():
+        setattr(block, name, getattr(b, name))
+    block.put()
+    b.delete()
+    return block
+
+def _migrate_block(alumn, block_ID):
+    """Re-keys a block created before blocks were children of their player."""
     for b in alumn.blocks:
-        if b.blockID == block_ID:
-            #print "Block already added..."
-            return b
-    print "Adding block to player...-->" ,block_ID
-    block = GDefierBlock(player=alumn, blockID=block_ID).put()
+        if b.blockID == block_ID and b.parent_key() is None:
+            return _rekey_block(alumn, b)
+    return None
+
+def get_block(alumn, block_ID):
+    """Returns the GDefierBlock of a player or None."""
+    block = GDefierBlock.get(GDefierBlock.make_key(alumn.key(), block_ID))
+    if not block:
+        block = _migrate_block(alumn, block_ID)
     return block
 
+def register_blocks(players, block_IDs):
+    """Registers players in blocks with batched datastore writes.
+
+    Blocks are keyed by player and blockID, so registering a player in a block
+    again returns the existing block. Every player is registered in the
+    matchmaking index again, so an index update that failed after its blocks
+    were put is repaired by the next registration.
+
+    Args:
+        players: list of GDefierPlayer.
+        block_IDs: list of block titles.
+
+    Returns:
+        A list with the GDefierBlock of every player in every block, ordered
+        by player and then by block.
+    """
+    keys = [GDefierBlock.make_key(alumn.key(), block_ID)
+            for alumn in players for block_ID in block_IDs]
+    blocks = db.get(keys)
+
+    # Blocks created before blocks were children of their player.
+    legacy = {}
+    player_keys = sorted(set(
+        [key.parent() for key, block in zip(keys, blocks) if not block]))
+    for i in range(0, len(player_keys), IN_FILTER_SIZE):
+        query = GDefierBlock.all().filter(
+            'player IN', player_keys[i:i + IN_FILTER_SIZE])
+        for b in query:
+            if b.parent_key() is None:
+                player_key = GDefierBlock.player.get_value_for_datastore(b)
+                legacy[(player_key, b.blockID)] = b
+
+    created = []
+    names = {}
+    for i, key in enumerate(keys):
+        alumn = players[i // len(block_IDs)]
+        block_ID = key.name()
+        names.setdefault(block_ID, []).append(alumn.name)
+        if blocks[i]:
+            continue
+        if (alumn.key(), block_ID) in legacy:
+            blocks[i] = _rekey_block(alumn, legacy[(alumn.key(), block_ID)])
+            continue
+        blocks[i] = GDefierBlock(parent=alumn, key_name=block_ID,
+                                 player=alumn, blockID=block_ID)
+        created.append(blocks[i])
+
+    for i in range(0, len(created), PUT_BATCH_SIZE):
+        db.put(created[i:i + PUT_BATCH_SIZE])
+    for block_ID, block_names in names.items():
+        matchmaking.Matchmaking.register_many(block_ID, block_names)
+    return blocks
+
+def add_blocks_to_player(self, block_IDs):
+    """Registers the current player in blocks; returns its GDefierBlocks."""
+    return register_blocks([get_player(self)], block_IDs)
+
+def add_block_to_player(self, block_ID):
+    return add_blocks_to_player(self, [block_ID])[0]
+
 def delete_block(self, block_ID):
-    nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
+    alumn = get_player(self)
     for b in alumn.blocks:
         if b.blockID == block_ID:
             print "Deleting block with ID -->", b.blockID
             b.delete()
+            matchmaking.Matchmaking.unregister(block_ID, alumn.name)
 
-def create_group(self):
-    course = sites.get_course_for_current_request()
-    group = GDefierGroup.gql("WHERE name = '" + course.get_namespace_name() + "'").get()
+def _get_keyed(model, key_name, name_property):
+    """Gets an entity by key name.
+
+    Entities created before they had deterministic key names are found by a
+    query once; the key found is kept in memcache.
+    """
+    entity = model.get_by_key_name(key_name)
+    if entity:
+        return entity
+    memcache_key = 'entity:gdefier-legacy:%s:%s' % (model.kind(), key_name)
+    legacy_key = MemcacheManager.get(memcache_key)
+    if legacy_key:
+        return model.get(legacy_key)
+    entity = model.all().filter(name_property + ' =', key_name).get()
+    if entity:
+        MemcacheManager.set(memcache_key, str(entity.key()))
+    return entity
+
+def _get_group_key(namespace):
+    """Returns the key of the GDefierGroup of a course, creating it if needed."""
+    group = _get_keyed(GDefierGroup, namespace, 'name')
     if not group:
         print "Creating group..." 
-        aux_group = GDefierGroup(name=course.get_namespace_name()).put()
-        return aux_group
-    return group
+        group = GDefierGroup.get_or_insert(namespace, name=namespace)
+    return group.key()
+
+def create_group(self):
+    course = sites.get_course_for_current_request()
+    return _get_group_key(course.get_namespace_name())
+
+def _build_members(group_key):
+    return GDefierPlayer.all(keys_only=True).filter('group =', group_key)
+
+def get_member_keys(group_key):
+    """Returns keys of the players of a group."""
+    unused_version, keys = membership.Membership.load(group_key, _build_members)
+    return [db.Key(key) for key in keys]
+
+def get_members(group_key):
+    """Returns the players of a group."""
+    return [player for player in db.get(get_member_keys(group_key)) if player]
     
 def get_players(self):
     course = sites.get_course_for_current_request().get_namespace_name()
-    results = db.GqlQuery("SELECT * FROM GDefierGroup WHERE name ='"+course+"'")
-    for x in results:
-        players = x.members
-        return players
+    group = _get_keyed(GDefierGroup, course, 'name')
+    if group:
+        return get_members(group.key())
+    return None
 
 def player_exist(self):
-    nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
+    alumn = get_player(self)
     if not alumn:
         return True
     return False
 
 def player_has_blocks(self):
-    nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
-    if alumn.blocks.count() != 0:
+    alumn = get_player(self)
+    if alumn.blocks.count(limit=1) != 0:
         return False
     return True        
 
 def to_dict(self):
     return dict([(p, unicode(getattr(self, p))) for p in self.properties()])
 
+def _migrate_invitations(block_ID):
+    """Converts invitations kept in GDefierBlock lists into entities."""
+    board_block = get_board_block(block_ID)
+    if not board_block or board_block.invitations_migrated:
+        return
+    updated = []
+    for b in GDefierBlock.all().filter('blockID =', block_ID):
+        if not (b.sends or b.request):
+            continue
+        sender = GDefierBlock.player.get_value_for_datastore(b)
+        sender = get_player_name(sender)
+        # Every invitation is in the sends of its sender and in the requests
+        # of its receiver; the sends are enough to rebuild all of them.
+        for receiver in b.sends:
+            updated.append(GDefierInvitation(
+                key=GDefierInvitation.make_key(block_ID, sender, receiver),
+                blockID=block_ID, sender=sender, receiver=receiver))
+        b.sends = []
+        b.request = []
+        updated.append(b)
+        if len(updated) >= PUT_BATCH_SIZE:
+            db.put(updated)
+            updated = []
+    db.put(updated)
+    board_block.invitations_migrated = True
+    board_block.put()
+
+def get_player_name(player_key):
+    """Returns the nickname of a player given its key."""
+    alumn = GDefierPlayer.get(player_key)
+    return alumn.name if alumn else None
+
+@db.transactional(xg=True)
+def _send_invitation(block_ID, sender, receiver):
+    key = GDefierInvitation.make_key(block_ID, sender, receiver)
+    reverse_key = GDefierInvitation.make_key(block_ID, receiver, sender)
+    if any(db.get([key, reverse_key])):
+        return None
+    invitation = GDefierInvitation(
+        key=key, blockID=block_ID, sender=sender, receiver=receiver)
+    invitation.put()
+    return invitation
+
 def add_request_challenge(self, user, block_ID):
+    """Sends an invitation from the current player to another one.
+
+    Returns:
+        The new GDefierInvitation, or None if either player already invited
+        the other one.
+    """
     nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
-    for b in alumn.blocks:
-        if b.blockID == block_ID:
-            b.sends.append(user)
-            b.put()
-            break
-    alumn = GDefierPlayer.gql("WHERE name = '" + user +"'").get()
-    for b in alumn.blocks:
-        if b.blockID == block_ID:
-            b.request.append(nick)
-            b.put()
-            break
+    if user == nick or not get_player_repository(self).get_by_name(user):
+        return None
+    return _send_invitation(block_ID, nick, user)
+
+@db.transactional()
+def _delete_invitation(key):
+    if not GDefierInvitation.get(key):
+        return False
+    db.delete(key)
+    return True
         
 def del_request_challenge(self, defier, block_ID):
+    """Removes an invitation sent by defier to the current player.
+
+    Returns:
+        True if the invitation existed; only one request can accept it.
+    """
     nick = self.get_user().nickname()
-    alumn = GDefierPlayer.gql("WHERE name = '" + nick +"'").get()
-    for b in alumn.blocks:
-        if b.blockID == block_ID:
-            for s in b.request:
-                if s == defier:
-                    del b.request[b.request.index(s)]
-                    b.put()
-                    break
-    alumn = GDefierPlayer.gql("WHERE name = '" + defier +"'").get()
-    for b in alumn.blocks:
-        if b.blockID == block_ID:
-            for s in b.sends:
-                if s == nick:
-                    del b.sends[b.sends.index(s)]
-                    b.put()
-                    break
+    return _delete_invitation(
+        GDefierInvitation.make_key(block_ID, defier, nick))
 
-def create_board(self, blocks):
-    course = sites.get_course_for_current_request()
-    board = GDefierBoard.gql("WHERE name = '" + course.get_namespace_name() + "'").get()
+def _invitations_query(block_ID, direction, nick):
+    return GDefierInvitation.all().filter('blockID =', block_ID).filter(
+        direction + ' =', nick)
+
+def player_invitations(self, block_ID, received=True, cursor=None,
+                       limit=INVITATIONS_PAGE_SIZE):
+    """Returns a page of invitations of the current player, newest first.
+
+    Args:
+        self: the handler of the request.
+        block_ID: string. The block title.
+        received: bool. Whether to list received or sent invitations.
+        cursor: string. Cursor of the page to return.
+        limit: int. Number of invitations per page.
+
+    Returns:
+        An (invitations, next_cursor) tuple; next_cursor is None when there
+        are no more invitations.
+    """
+    _migrate_invitations(block_ID)
+    query = _invitations_query(
+        block_ID, 'receiver' if received else 'sender',
+        self.get_user().nickname()).order('-created_on')
+    if cursor:
+        query.with_cursor(cursor)
+    invitations = query.fetch(limit)
+    next_cursor = None
+    if len(invitations) == limit:
+        next_cursor = query.cursor()
+    return invitations, next_cursor
+
+def pending_invitations(self, block_ID):
+    """Returns names of players with an invitation from or to the player."""
+    _migrate_invitations(block_ID)
+    nick = self.get_user().nickname()
+    names = []
+    for direction in ['sender', 'receiver']:
+        keys = _invitations_query(block_ID, direction, nick).fetch(
+            MAX_PENDING_INVITATIONS, keys_only=True)
+        for key in keys:
+            unused_block, sender, receiver = key.name().rsplit(':', 2)
+            names.append(receiver if sender == nick else sender)
+    return names
+
+def get_board_block(blockID):
+    """Returns the GDefierBoardBlock of a block or None."""
+    return _get_keyed(GDefierBoardBlock, blockID, 'blockID')
+
+def _create_board(namespace, blocks):
+    board = _get_keyed(GDefierBoard, namespace, 'name')
     if not board:
         print "Creating board..." 
-        aux_board = GDefierBoard(name=course.get_namespace_name()).put()
-        for b in blocks:
-            print "Creating block to board..." 
-            GDefierBoardBlock(blockID=b['block_title'], board=[aux_board]).put()        
-        return aux_board
-    return board
+        board = GDefierBoard.get_or_insert(namespace, name=namespace)
+    missing = [b['block_title'] for b in blocks
+               if not get_board_block(b['block_title'])]
+    db.put([GDefierBoardBlock(key_name=blockID, blockID=blockID,
+                              board=[board.key()])
+            for blockID in missing])
+    return board.key()
+
+def create_board(self, blocks):
+    course = sites.get_course_for_current_request()
+    return _create_board(course.get_namespace_name(), blocks)
 
 def create_defy(self, user, blockID):
-    block = GDefierBoardBlock.gql("WHERE blockID = '" + blockID + "'").get()
+    block = get_board_block(blockID)
     print "Creating Defy..."
-    GDefierDefy(block_board=block, rname=user, lname=self.get_user().nickname()).put()
+    nick = self.get_user().nickname()
+    GDefierDefy(block_board=block, blockID=blockID, rname=user, lname=nick,
+                participants=[user, nick]).put()
+    matchmaking.Matchmaking.pair(blockID, user, self.get_user().nickname())
     
-def player_defies(self, blockID):
-    nick = self.get_user().nickname()   
-    board_block = GDefierBoardBlock.gql("WHERE blockID = '" + blockID + "'").get()
-    defies = []
+def _build_matchmaking_index(blockID):
+    """Builds the matchmaking index of a block from the datastore."""
+    index = matchmaking.MatchmakingIndex(blockID, {})
+    player_keys = [
+        GDefierBlock.player.get_value_for_datastore(b)
+        for b in GDefierBlock.all().filter('blockID =', blockID)]
+    for player in db.get(player_keys):
+        if player:
+            index.register(player.name)
+    board_block = get_board_block(blockID)
+    if board_block:
+        for df in board_block.defies:
+            index.pair(df.rname, df.lname)
+    return index
+
+def _index_rating(block_key):
+    # Putting a block again adds its default rating to the index.
+    db.run_in_transaction(lambda: db.put(db.get(block_key)))
+
+def _index_legacy_ratings(namespace, blockID):
+    """Indexes ratings of blocks created before blocks had a rating."""
+    old_namespace = namespace_manager.get_namespace()
+    try:
+        namespace_manager.set_namespace(namespace)
+        board_block = get_board_block(blockID)
+        if not board_block or board_block.ratings_indexed:
+            return
+        query = GDefierBlock.all(keys_only=True).filter('blockID =', blockID)
+        for block_key in query:
+            _index_rating(block_key)
+        board_block.ratings_indexed = True
+        board_block.put()
+    finally:
+        namespace_manager.set_namespace(old_namespace)
+
+def _rated_blocks(blockID, rating, window, limit):
+    """Returns blocks with a rating within a window, closest ones first."""
+    base = GDefierBlock.all().filter('blockID =', blockID)
+    above = base.filter('rating >=', rating).filter(
+        'rating <=', rating + window).order('rating').fetch(limit)
+    base = GDefierBlock.all().filter('blockID =', blockID)
+    below = base.filter('rating <', rating).filter(
+        'rating >=', rating - window).order('-rating').fetch(limit)
+    return sorted(above + below, key=lambda b: abs(b.rating - rating))
+
+def player_opponents(self, block, by_skill=False):
+    """Returns names of players the current player can challenge in a block.
+
+    Args:
+        self: the handler of the request.
+        block: the GDefierBlock of the current player.
+        by_skill: bool. If True, only players with a block rating within
+            elo.OPPONENT_WINDOW are returned, closest rating first.
+
+    Returns:
+        A list of player names.
+    """
+    index = matchmaking.Matchmaking.load(
+        block.blockID, _build_matchmaking_index)
+    opponents = index.opponents_of(
+        self.get_user().nickname(),
+        pending=pending_invitations(self, block.blockID))
+    if not by_skill:
+        return opponents
+
+    board_block = get_board_block(block.blockID)
+    if board_block and not board_block.ratings_indexed:
+        marker = 'gdefier:ratings-indexing:%s' % block.blockID
+        if not MemcacheManager.get(marker):
+            MemcacheManager.set(marker, True)
+            deferred.defer(
+                _index_legacy_ratings, namespace_manager.get_namespace(),
+                block.blockID)
+
+    eligible = set(opponents)
+    blocks = _rated_blocks(
+        block.blockID, block_stats(block)['rating'], elo.OPPONENT_WINDOW,
+        MAX_RATED_OPPONENTS)
+    player_keys = [GDefierBlock.player.get_value_for_datastore(b)
+                   for b in blocks]
+    names = []
+    for alumn in db.get(player_keys):
+        if alumn and alumn.name in eligible and alumn.name not in names:
+            names.append(alumn.name)
+    return names
+
+def _index_legacy_defies(blockID):
+    """Adds participants to defies of a block created before they existed."""
+    board_block = get_board_block(blockID)
+    if not board_block or board_block.defies_indexed:
+        return
+    updated = []
     for df in board_block.defies:
-        if df.rname == nick or df.lname == nick:
-            defies.append(df)
-    return defies
+        if not df.participants:
+            df.participants = [df.rname, df.lname]
+            df.blockID = blockID
+            # Results of defies ended before were applied when they ended.
+            df.solved = df.solved or (df.rended and df.lended)
+            updated.append(df)
+            if len(updated) >= 100:
+                db.put(updated)
+                updated = []
+    db.put(updated)
+    board_block.defies_indexed = True
+    board_block.put()
+
+def _player_defies_query(nick, blockID, solved):
+    return GDefierDefy.all().filter('participants =', nick).filter(
+        'blockID =', blockID).filter('solved =', solved)
+
+def player_defies(self, blockID, cursor=None, limit=DEFIES_PAGE_SIZE):
+    """Returns defies of the current player in a block.
+
+    Ongoing defies are all returned; ended ones are returned newest first, a
+    page at a time.
+
+    Args:
+        self: the handler of the request.
+        blockID: string. The block title.
+        cursor: string. Cursor of the page of ended defies to return.
+        limit: int. Number of ended defies per page.
+
+    Returns:
+        A (ongoing, ended, next_cursor) tuple; next_cursor is None when there
+        are no more ended defies.
+    """
+    nick = self.get_user().nickname()
+    _index_legacy_defies(blockID)
+    ongoing = _player_defies_query(nick, blockID, False).fetch(1000)
+
+    query = _player_defies_query(nick, blockID, True).order('-created_on')
+    if cursor:
+        query.with_cursor(cursor)
+    ended = query.fetch(limit)
+    next_cursor = None
+    if len(ended) == limit:
+        next_cursor = query.cursor()
+    return ongoing, ended, next_cursor
 
-def defy_solver(self, defy, n_defies):
-    block = defy.block_board
+def defy_winner(defy):
+    """Returns 'r' or 'l' for the winning side of a defy, None if tied."""
     winner=None
     # Getting winner
     if defy.rscore[0]>defy.lscore[0]:
@@ -355,69 +935,398 @@ def defy_solver(self, defy, n_defies):
                 """ TODO hyper TIED"""
                 """ By now, both lost the challengue"""
                 pass 
+    return winner
 
-    ralumn = GDefierPlayer.gql("WHERE name = '" + defy.rname +"'").get()   
-    for b in ralumn.blocks:
-        if b.blockID == block.blockID:
-            ralumn.attempts += defy.rscore[1]
-            ralumn.fails += defy.rscore[2]
-            ralumn.hints += defy.rscore[3]
-            for s in range(len(defy.rscore)):
-                if not s==0: # NOT giving score if lost
-                    b.score[s] += defy.rscore[s]
-            if winner=="r":
-                ralumn.score += defy.rscore[0]
-                b.score[0] += defy.rscore[0]
-                b.wins += 1
-                ralumn.wins += 1
-                if b.wins >= n_defies:
-                    b.done = True
-            else:
-                b.lost += 1
-                ralumn.lost += 1
-            b.put()
-            break
-    ralumn.put()
-    
-    lalumn = GDefierPlayer.gql("WHERE name = '" + defy.lname +"'").get()
-    for b in lalumn.blocks:
-        if b.blockID == block.blockID:
-            lalumn.attempts += defy.lscore[1]
-            lalumn.fails += defy.lscore[2]
-            lalumn.hints += defy.lscore[3]
-            for s in range(len(defy.lscore)):
-                if not s==0:
-                    b.score[s] += defy.lscore[s]
-            if winner=="l":
-                lalumn.score += defy.lscore[0]
-                b.score[0] += defy.lscore[0]
-                b.wins += 1
-                lalumn.wins += 1
-                if b.wins >= n_defies:
-                    b.done = True
-            else:
-                b.lost += 1
-                lalumn.lost += 1
-            b.put()
-            break
-    lalumn.put()
+def _defy_side_deltas(score, won):
+    """Returns the statistics one side of a defy adds to its player/block."""
+    # [Score,Attempts,fails,Hints]; NOT giving score if lost
+    return {
+        'score': score[0] if won else 0,
+        'attempts': score[1],
+        'fails': score[2],
+        'hints': score[3],
+        'wins': 1 if won else 0,
+        'lost': 0 if won else 1}
+
+def defy_solver(defy, player_ratings, block_ratings):
+    """Returns statistics deltas of an ended defy.
+
+    Args:
+        defy: the ended GDefierDefy.
+        player_ratings: [right, left] ratings of the players before the defy.
+        block_ratings: [right, left] ratings of the players in the block.
+
+    Returns:
+        A list of [right, left] deltas of the players and a list of [right,
+        left] deltas of their blocks.
+    """
+    winner = defy_winner(defy)
+    defy.solved = True
+    sides = [_defy_side_deltas(defy.rscore, winner == "r"),
+             _defy_side_deltas(defy.lscore, winner == "l")]
+    result = []
+    for ratings in [player_ratings, block_ratings]:
+        side_deltas = [dict(deltas) for deltas in sides]
+        for deltas, change in zip(side_deltas, elo.deltas(
+                ratings[0], ratings[1], winner)):
+            deltas['rating'] = change
+        result.append(side_deltas)
+    return result
+
+@db.transactional()
+def _end_defy(defy_key, side, round_number, targets, ratings):
+    """Ends one side of a defy; resolves it if both sides have ended.
+
+    The result is recorded as a batch of increments that is a child of the
+    defy and is put with it, so it is counted exactly once even if both sides
+    end at the same time. No counter, player or block is written here; the
+    batch is added to the counters and folded into players and blocks by
+    fold_stats().
+
+    Returns:
+        A (defy, batch) tuple; batch is None unless the defy was resolved.
+    """
+    defy = GDefierDefy.get(defy_key)
+    # Rounds are only kept in the live arena state until a side ends.
+    if side == 'right':
+        defy.rended = True
+        defy.rround = max(defy.rround, round_number)
+    else:
+        defy.lended = True
+        defy.lround = max(defy.lround, round_number)
+    if not (defy.rended and defy.lended) or defy.solved:
+        defy.put()
+        return defy, None
+
+    player_deltas, block_deltas = defy_solver(defy, ratings[:2], ratings[2:])
+    batch = stats.Stats.record(
+        defy, 'result', zip(targets, player_deltas + block_deltas))
+    db.put([defy, batch])
+    return defy, batch
+
+def end_defy(self, defy_key, side):
+    """Ends the current player's side of a defy; returns the updated defy."""
+    repository = get_player_repository(self)
+    defy = GDefierDefy.get(defy_key)
+    block_ID = defy.get_blockID()
+    players = [repository.get_by_name(defy.rname),
+               repository.get_by_name(defy.lname)]
+    player_keys = [alumn.key() for alumn in players]
+    targets = ([str(key) for key in player_keys] +
+               [str(GDefierBlock.make_key(key, block_ID))
+                for key in player_keys])
+
+    # Current ratings, including changes not folded yet; a rating changed
+    # by a concurrent defy meanwhile only makes the update approximate.
+    ratings = [player_stats(alumn)['rating'] for alumn in players]
+    for alumn in players:
+        b = get_block(alumn, block_ID)
+        ratings.append(block_stats(b)['rating'] if b else elo.DEFAULT_RATING)
+
+    state = arena.ArenaState.peek(defy.key())
+    round_number = state.round_of(side) if state else 0
+    defy, batch = _end_defy(defy.key(), side, round_number, targets, ratings)
+    if batch:
+        stats.Stats.buffer(batch)
+    arena.ArenaState.sync(defy)
+    return defy
+
+def _block_values(b):
+    return {
+        'score': b.score[0], 'attempts': b.score[1], 'fails': b.score[2],
+        'hints': b.score[3], 'wins': b.wins, 'lost': b.lost,
+        'rating': b.rating}
+
+def player_stats(alumn):
+    """Returns current statistics of a player, including unfolded ones."""
+    values = leaderboard.values_of(alumn)
+    values['rating'] = alumn.rating
+    return stats.add(values, stats.Stats.pending(str(alumn.key())))
+
+def block_stats(b):
+    """Returns current statistics of a player's block."""
+    return stats.add(_block_values(b), stats.Stats.pending(str(b.key())))
+
+def _fold_into_player(alumn, deltas):
+    for name, value in deltas.items():
+        setattr(alumn, name, getattr(alumn, name) + value)
+
+def _fold_into_block(n_defies):
+    def apply_fn(b, deltas):
+        values = stats.add(_block_values(b), deltas)
+        b.score = [values['score'], values['attempts'], values['fails'],
+                   values['hints']]
+        b.wins = values['wins']
+        b.lost = values['lost']
+        b.rating = values['rating']
+        if b.wins >= n_defies:
+            b.done = True
+    return apply_fn
+
+def fold_stats(namespace, n_defies):
+    """Materializes pending counters onto players and blocks of a course.
+
+    Runs in the namespace of the course. Buffered increments are added to the
+    counters first. Rankings are updated from the folded player totals, so
+    they lag behind by at most one run of this function. Runs are serialized
+    by a lease, so a run that overlaps another one does nothing.
+
+    Returns:
+        The number of players and blocks updated.
+    """
+    token = stats.Stats.acquire_lease(FOLD_LEASE_SECS)
+    if not token:
+        return 0
+    try:
+        return _fold_stats(namespace, n_defies)
+    finally:
+        stats.Stats.release_lease(token)
+
+def _fold_stats(namespace, n_defies):
+    stats.Stats.flush()
+    repository = PlayerRepository(namespace)
+    changes = []
+    count = 0
+    for target in stats.Stats.dirty_targets():
+        key = db.Key(target)
+        if key.kind() == GDefierBlock.kind():
+            if not GDefierBlock.get(key):
+                alumn = GDefierPlayer.get(key.parent())
+                if alumn:
+                    _migrate_block(alumn, key.name())
+            if stats.Stats.fold(target, _fold_into_block(n_defies)):
+                count += 1
+        else:
+            alumn = GDefierPlayer.get(key)
+            if not alumn:
+                continue
+            alumn = stats.Stats.fold(target, _fold_into_player)
+            if alumn:
+                repository.invalidate([alumn])
+                changes.append((alumn.name, leaderboard.values_of(alumn)))
+                count += 1
+    if changes:
+        leaderboard.Leaderboard.update(changes)
+    leaderboard.Leaderboard.apply_changes()
+    return count
+
+def get_ranking(self, metric):
+    """Returns the leaderboard.Ranking of the players of this course."""
+    return leaderboard.Leaderboard.load(metric, GDefierPlayer.all)
     
-def answer_solver(self, defy, js_data):
-        # Algorithm to point an answer. It can be less than zero.
+def answer_solver(js_data):
+    """Returns [Score,Attempts,fails,Hints] deltas of a passed answer."""
+    # Algorithm to point an answer. It can be less than zero.
     score = 50 - js_data['count_hints'] * 15 - (js_data['attempt_number']-1)* 15
     if score<0:
         score = 0
-    # [Score,Attempts,fails,Hints] 
-    nick = self.get_user().nickname()
-    if defy.rname == nick:
-        defy.rscore[0] += score
-        defy.rscore[1] += js_data['attempt_number']
-        defy.rscore[2] += js_data['attempt_number']-1
-        defy.rscore[3] += js_data['count_hints']
+    return [score, js_data['attempt_number'], js_data['attempt_number']-1,
+            js_data['count_hints']]
+
+@db.transactional()
+def _add_answer(defy_key, nick, deltas):
+    defy = GDefierDefy.get(defy_key)
+    if not defy or defy.solved:
+        return None
+    if defy.rname == nick and not defy.rended:
+        defy.rscore = [a + b for a, b in zip(defy.rscore, deltas)]
+    elif defy.lname == nick and not defy.lended:
+        defy.lscore = [a + b for a, b in zip(defy.lscore, deltas)]
     else:
-        defy.lscore[0] += score
-        defy.lscore[1] += js_data['attempt_number']
-        defy.lscore[2] += js_data['attempt_number']-1
-        defy.lscore[3] += js_data['count_hints']
+        return None
     defy.put()
-    
+    return defy
+
+def record_answer(self, defy_key, js_data):
+    """Adds a passed Khan exercise answer to the current player's defy score.
+
+    Args:
+        self: the handler of the request.
+        defy_key: string. Key of the GDefierDefy the answer was given in.
+        js_data: dict. The decoded exercise submission.
+
+    Returns:
+        The updated GDefierDefy, or None if the user can't score in it.
+    """
+    try:
+        defy_key = db.Key(defy_key)
+    except db.BadKeyError:
+        return None
+    if defy_key.kind() != GDefierDefy.kind():
+        return None
+    defy = _add_answer(
+        defy_key, self.get_user().nickname(), answer_solver(js_data))
+    if defy:
+        arena.ArenaState.sync(defy)
+    return defy
+
+def enrol_users(repository, users_list, group_key, block_IDs):
+    """Creates missing players of users.User and registers them in blocks.
+
+    Returns:
+        The number of players created.
+    """
+    players = repository.get_multi(users_list)
+    new_users = [user for user, alumn in zip(users_list, players) if not alumn]
+    created = []
+    if new_users:
+        created = repository.create_multi(new_users, group_key)
+        membership.Membership.add(
+            group_key, [alumn.key() for alumn in created])
+        leaderboard.Leaderboard.update(
+            [(alumn.name, leaderboard.values_of(alumn)) for alumn in created])
+    players = [alumn for alumn in players if alumn] + created
+    register_blocks(players, block_IDs)
+    return len(created)
+
+class EnrolRosterJob(jobs.DurableJob):
+    """A job that registers all enrolled students in all G-Defier blocks."""
+
+    def __init__(self, app_context, blocks):
+        super(EnrolRosterJob, self).__init__(app_context)
+        self._blocks = blocks
+
+    def run(self):
+        """Registers students in batches of ROSTER_BATCH_SIZE."""
+        _create_board(self._namespace, self._blocks)
+        group_key = _get_group_key(self._namespace)
+        block_IDs = [b['block_title'] for b in self._blocks]
+        repository = PlayerRepository(self._namespace)
+        batch = []
+        counts = {'students': 0, 'created': 0}
+
+        def flush():
+            counts['students'] += len(batch)
+            counts['created'] += enrol_users(
+                repository, batch, group_key, block_IDs)
+            del batch[:]
+
+        def map_fn(student):
+            if student.is_enrolled and student.user_id:
+                batch.append(users.User(
+                    email=student.key().name(), _user_id=student.user_id))
+                if len(batch) >= ROSTER_BATCH_SIZE:
+                    flush()
+
+        mapper = utils.QueryMapper(
+            Student.all(), batch_size=ROSTER_BATCH_SIZE, report_every=1000)
+        mapper.run(map_fn)
+        if batch:
+            flush()
+        return counts
+
+class RebuildMatchmakingJob(jobs.DurableJob):
+    """A job that builds the matchmaking indexes of blocks from the datastore."""
+
+    def __init__(self, app_context, block_IDs):
+        super(RebuildMatchmakingJob, self).__init__(app_context)
+        self._block_IDs = block_IDs
+
+    def run(self):
+        for block_ID in self._block_IDs:
+            matchmaking.Matchmaking.rebuild(
+                block_ID, _build_matchmaking_index)
+        return {'blocks': len(self._block_IDs)}
+
+class RebuildRankingsJob(jobs.DurableJob):
+    """A job that builds all rankings of a course again from its players."""
+
+    def run(self):
+        """Replaces the rankings and drops the changes they already have."""
+        leaderboard.Leaderboard.apply_changes()
+        players = []
+        mapper = utils.QueryMapper(
+            GDefierPlayer.all(), batch_size=ROSTER_BATCH_SIZE,
+            report_every=1000)
+        mapper.run(players.append)
+        leaderboard.Leaderboard.rebuild(players)
+        return {'players': len(players)}
+
+def _tournament_defy_key(block_ID, number, rname, lname):
+    return db.Key.from_path(GDefierDefy.kind(), 'tournament:%s:%s:%s:%s' % (
+        block_ID, number, rname, lname))
+
+class ScheduleTournamentJob(jobs.DurableJob):
+    """A job that creates the defies of a tournament of one block.
+
+    A round robin tournament is scheduled at once. A Swiss tournament is
+    scheduled one round per run, pairing players by the wins they have in
+    the block so far. Defies are keyed by tournament round and players, so
+    a retried run does not create them twice. The pairs of a Swiss round are
+    stored before its defies are created, and a run retried before the round
+    was finished creates the defies of those pairs rather than pairing the
+    players again.
+    """
+
+    def __init__(self, app_context, block_ID, system):
+        super(ScheduleTournamentJob, self).__init__(app_context)
+        self._job_name = 'job-%s-%s-%s' % (
+            self.__class__.__name__, self._namespace, block_ID)
+        self._block_ID = block_ID
+        self._system = system
+
+    def _schedule(self, index):
+        names = sorted(index.registered)
+        if self._system == tournament.SYSTEM_ROUND_ROBIN:
+            return tournament.round_robin(names)
+        wins = {}
+        for b in GDefierBlock.all().filter('blockID =', self._block_ID):
+            wins[GDefierBlock.player.get_value_for_datastore(b)] = b.wins
+        scores = {}
+        for alumn in db.get(wins.keys()):
+            if alumn:
+                scores[alumn.name] = wins[alumn.key()]
+        return [tournament.swiss(names, scores, index.played)]
+
+    def run(self):
+        """Creates the defies of the next rounds in batches."""
+        board_block = get_board_block(self._block_ID)
+        if not board_block:
+            raise Exception('Block %s has no board.' % self._block_ID)
+        record = tournament.GDefierTournament.get_or_create(
+            self._block_ID, self._system)
+
+        if self._system == tournament.SYSTEM_SWISS:
+            first = record.rounds
+            pairs = record.scheduling_pairs()
+            if pairs is None:
+                index = matchmaking.Matchmaking.load(
+                    self._block_ID, _build_matchmaking_index)
+                pairs = [(first, rname, lname)
+                         for rname, lname in self._schedule(index)[0]]
+            record.start(len(pairs), pairs)
+            rounds = 1
+        else:
+            # A round robin is always the same, so scheduling it again only
+            # creates defies that are missing.
+            first = 0
+            index = matchmaking.Matchmaking.load(
+                self._block_ID, _build_matchmaking_index)
+            schedule = self._schedule(index)
+            pairs = []
+            for number, round_pairs in enumerate(schedule):
+                for rname, lname in round_pairs:
+                    pairs.append((number, rname, lname))
+            rounds = len(schedule)
+            record.start(len(pairs))
+
+        for i in range(0, len(pairs), PUT_BATCH_SIZE):
+            batch = pairs[i:i + PUT_BATCH_SIZE]
+            keys = [_tournament_defy_key(self._block_ID, number, r, l)
+                    for number, r, l in batch]
+            existing = db.get(keys)
+            defies = []
+            for key, entity, (number, rname, lname) in zip(
+                    keys, existing, batch):
+                if not entity:
+                    defies.append(GDefierDefy(
+                        key=key, block_board=board_block,
+                        blockID=self._block_ID, rname=rname, lname=lname,
+                        participants=[rname, lname]))
+            db.put(defies)
+            matchmaking.Matchmaking.pair_many(
+                self._block_ID, [(r, l) for unused_number, r, l in batch])
+            record.progress(len(batch))
+
+        record.finish(first + rounds)
+        return {'rounds': rounds, 'defies': len(pairs)}
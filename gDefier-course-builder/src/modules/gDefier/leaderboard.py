@@ -0,0 +1,358 @@
+"""Materialized G-Defier rankings of the players of a course."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+import bisect
+import datetime
+import json
+import zlib
+
+from models.models import MemcacheManager
+
+from google.appengine.ext import db
+
+# Ranked metrics of a GDefierPlayer; True if the highest value ranks first.
+METRICS = {
+    'score': True,
+    'attempts': True,
+    'wins': True,
+    'fails': False,
+    'hints': False,
+    'lost': False,
+}
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Number of shards buffering changes of players not in the rankings yet.
+NUM_CHANGE_SHARDS = 8
+
+# Decoded rankings held by this instance for each (namespace, metric), as a
+# (version, Ranking) tuple.
+RANKINGS_CACHE = {}
+
+
+class GDefierRankingEntity(db.Model):
+    """Sorted ranking of all players for one metric; metric is the key name."""
+    updated_on = db.DateTimeProperty(indexed=True)
+
+    # zlib compressed JSON list of [sort_key, name], sorted by sort_key.
+    data = db.BlobProperty()
+
+
+class GDefierRankingChanges(db.Model):
+    """Player changes not applied to the rankings yet.
+
+    The key name is the index of the shard; the changes of a player always go
+    to the same shard, so the latest one is the one kept.
+    """
+    updated_on = db.DateTimeProperty(indexed=False)
+
+    # JSON dict of player name to values_of() the player, or to None if the
+    # player was removed.
+    data = db.TextProperty()
+
+    @classmethod
+    def make_key(cls, index):
+        return db.Key.from_path(cls.kind(), str(index))
+
+    @classmethod
+    def key_of(cls, name):
+        """Returns the key of the shard the changes of a player go to."""
+        return cls.make_key(
+            zlib.crc32(name.encode('utf-8')) % NUM_CHANGE_SHARDS)
+
+    def changes(self):
+        return json.loads(self.data) if self.data else {}
+
+
+def _version_of(entity):
+    """Returns a version stamp of a GDefierRankingEntity."""
+    return entity.updated_on.isoformat()
+
+
+def values_of(player):
+    """Returns a dict with the value of every ranked metric of a player."""
+    return dict([(metric, getattr(player, metric)) for metric in METRICS])
+
+
+class Ranking(object):
+    """A sorted list of players for one metric with O(log n) rank lookups.
+
+    Every player is in the list once; entries are found by player name, so
+    they can be replaced without knowing the value they were ranked with.
+    """
+
+    def __init__(self, metric, entries):
+        self._metric = metric
+        self._entries = []
+        self._keys = {}
+        for sort_key, name in entries:
+            self._remove(name)
+            self._keys[name] = sort_key
+            self._entries.append([sort_key, name])
+        self._entries.sort()
+
+    @classmethod
+    def decode(cls, metric, data):
+        return cls(metric, json.loads(zlib.decompress(data)))
+
+    def encode(self):
+        return zlib.compress(json.dumps(self._entries))
+
+    @property
+    def metric(self):
+        return self._metric
+
+    @property
+    def total(self):
+        return len(self._entries)
+
+    def _sort_key(self, value):
+        if METRICS[self._metric]:
+            return -value
+        return value
+
+    def _value(self, sort_key):
+        if METRICS[self._metric]:
+            return -sort_key
+        return sort_key
+
+    def _rank_of_key(self, sort_key):
+        # Players with the same value share the same rank.
+        return bisect.bisect_left(self._entries, [sort_key]) + 1
+
+    def _remove(self, name):
+        sort_key = self._keys.pop(name, None)
+        if sort_key is None:
+            return
+        index = bisect.bisect_left(self._entries, [sort_key, name])
+        if index < len(self._entries) and self._entries[index] == [
+                sort_key, name]:
+            del self._entries[index]
+
+    def value_of(self, name):
+        """Returns the value a player is ranked with, or None."""
+        sort_key = self._keys.get(name)
+        if sort_key is None:
+            return None
+        return self._value(sort_key)
+
+    def set(self, name, value):
+        """Ranks a player with a value, replacing its previous entry."""
+        self._remove(name)
+        sort_key = self._sort_key(value)
+        self._keys[name] = sort_key
+        bisect.insort(self._entries, [sort_key, name])
+
+    def remove(self, name):
+        """Removes a player, whatever value it is ranked with."""
+        self._remove(name)
+
+    def rank_of(self, value):
+        """Returns a 1-based rank a player with a given value has."""
+        return self._rank_of_key(self._sort_key(value))
+
+    def page(self, offset, limit):
+        """Returns a list of dicts with rank, name and value of the players."""
+        items = []
+        for sort_key, name in self._entries[offset:offset + limit]:
+            items.append({
+                'rank': self._rank_of_key(sort_key),
+                'name': name,
+                'value': self._value(sort_key)})
+        return items
+
+
+class Leaderboard(object):
+    """Loads and maintains the rankings of the current course.
+
+    Changes of players are buffered in GDefierRankingChanges shards and
+    applied to the rankings in batches by apply_changes(), so a ranking is
+    written at most once per batch rather than on every change.
+    """
+
+    @classmethod
+    def _memcache_key(cls, metric):
+        return 'gdefier:ranking:%s' % metric
+
+    @classmethod
+    def _version_key(cls, metric):
+        return 'gdefier:ranking-version:%s' % metric
+
+    @classmethod
+    def _build(cls, metric, players):
+        ranking = Ranking(metric, [])
+        for player in players:
+            ranking.set(player.name, getattr(player, metric))
+        return ranking
+
+    @classmethod
+    @db.transactional()
+    def _create(cls, metric, data):
+        """Stores a freshly built ranking unless another request did first."""
+        entity = GDefierRankingEntity.get_by_key_name(metric)
+        if entity:
+            return entity
+        entity = GDefierRankingEntity(key_name=metric)
+        entity.updated_on = datetime.datetime.now()
+        entity.data = data
+        entity.put()
+        return entity
+
+    @classmethod
+    def load(cls, metric, players):
+        """Returns the Ranking of a metric; it must not be modified.
+
+        The decoded ranking is kept in this instance while the version in
+        memcache is unchanged, so most requests neither fetch nor decode it.
+
+        Args:
+            metric: string. One of METRICS.
+            players: callable returning an iterable of all players; only called
+                when the ranking was never materialized for this course.
+
+        Returns:
+            A Ranking instance.
+        """
+        assert metric in METRICS
+        cache_key = (MemcacheManager.get_namespace(), metric)
+        cached = RANKINGS_CACHE.get(cache_key)
+        version = MemcacheManager.get(cls._version_key(metric))
+        if version and cached and cached[0] == version:
+            return cached[1]
+
+        item = MemcacheManager.get(cls._memcache_key(metric))
+        if not item or item['version'] != version:
+            entity = GDefierRankingEntity.get_by_key_name(metric)
+            if not entity:
+                entity = cls._create(
+                    metric, cls._build(metric, players()).encode())
+            item = {'version': _version_of(entity), 'data': entity.data}
+            MemcacheManager.set(cls._memcache_key(metric), item)
+            # Only writers replace the version, so a request that read the
+            # ranking before it changed never puts the old version back.
+            MemcacheManager.add(cls._version_key(metric), item['version'])
+
+        if cached and cached[0] == item['version']:
+            return cached[1]
+        ranking = Ranking.decode(metric, item['data'])
+        RANKINGS_CACHE[cache_key] = (item['version'], ranking)
+        return ranking
+
+    @classmethod
+    def rebuild(cls, players):
+        """Replaces all rankings with ones built from the players.
+
+        Args:
+            players: iterable of all players of the course.
+        """
+        rankings = dict([(metric, Ranking(metric, [])) for metric in METRICS])
+        for player in players:
+            for metric, ranking in rankings.items():
+                ranking.set(player.name, getattr(player, metric))
+        now = datetime.datetime.now()
+        entities = [
+            GDefierRankingEntity(
+                key_name=metric, updated_on=now, data=ranking.encode())
+            for metric, ranking in rankings.items()]
+        db.put(entities)
+        for entity in entities:
+            MemcacheManager.set(
+                cls._version_key(entity.key().name()), _version_of(entity))
+
+    @classmethod
+    @db.transactional()
+    def _add_changes(cls, shard_key, changes):
+        shard = GDefierRankingChanges.get(shard_key)
+        if not shard:
+            shard = GDefierRankingChanges(key=shard_key)
+        pending = shard.changes()
+        pending.update(changes)
+        shard.data = json.dumps(pending)
+        shard.updated_on = datetime.datetime.now()
+        shard.put()
+
+    @classmethod
+    def update(cls, changes):
+        """Records player changes to be applied to all rankings.
+
+        Args:
+            changes: a list of (name, values) tuples, where values is a dict
+                returned by values_of(), or None for a removed player.
+        """
+        shards = {}
+        for name, values in changes:
+            shards.setdefault(
+                GDefierRankingChanges.key_of(name), {})[name] = values
+        for shard_key, shard_changes in shards.items():
+            cls._add_changes(shard_key, shard_changes)
+
+    @classmethod
+    @db.transactional()
+    def _apply_to_metric(cls, metric, changes):
+        """Applies changes to a ranking; returns its new version or None."""
+        entity = GDefierRankingEntity.get_by_key_name(metric)
+        if not entity:
+            # Not materialized yet; the first load builds it from the players.
+            return None
+        ranking = Ranking.decode(metric, entity.data)
+        changed = False
+        for name, values in changes.items():
+            if values is None:
+                if ranking.value_of(name) is not None:
+                    ranking.remove(name)
+                    changed = True
+            elif ranking.value_of(name) != values[metric]:
+                ranking.set(name, values[metric])
+                changed = True
+        if not changed:
+            return None
+        entity.updated_on = datetime.datetime.now()
+        entity.data = ranking.encode()
+        entity.put()
+        return _version_of(entity)
+
+    @classmethod
+    @db.transactional()
+    def _remove_changes(cls, shard_key, applied):
+        """Drops applied changes a newer change has not replaced meanwhile."""
+        shard = GDefierRankingChanges.get(shard_key)
+        if not shard:
+            return
+        pending = shard.changes()
+        for name, values in applied.items():
+            if name in pending and pending[name] == values:
+                del pending[name]
+        if pending:
+            shard.data = json.dumps(pending)
+            shard.put()
+        else:
+            shard.delete()
+
+    @classmethod
+    def apply_changes(cls):
+        """Applies the buffered player changes to all rankings.
+
+        Applying a change twice has no effect, so changes are only dropped
+        from their shards once they are in the rankings.
+
+        Returns:
+            The number of player changes applied.
+        """
+        shard_keys = [
+            GDefierRankingChanges.make_key(index)
+            for index in range(NUM_CHANGE_SHARDS)]
+        shards = [shard for shard in db.get(shard_keys) if shard]
+        changes = {}
+        for shard in shards:
+            changes.update(shard.changes())
+        if not changes:
+            return 0
+        for metric in METRICS:
+            version = cls._apply_to_metric(metric, changes)
+            if version:
+                MemcacheManager.set(cls._version_key(metric), version)
+        for shard in shards:
+            cls._remove_changes(shard.key(), shard.changes())
+        return len(changes)
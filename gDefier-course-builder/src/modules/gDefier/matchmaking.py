@@ -0,0 +1,244 @@
+"""Per block index of G-Defier players used to find eligible opponents."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+import datetime
+import json
+import zlib
+
+from models.models import MemcacheManager
+
+from google.appengine.ext import db
+
+
+# Number of entities the index of a block is split into; more shards allow
+# more concurrent registrations and pairings.
+NUM_SHARDS = 8
+
+
+def shard_of(name):
+    """Returns the index of the shard the pairings of a player are in."""
+    return zlib.crc32(name.encode('utf-8')) % NUM_SHARDS
+
+
+class GDefierMatchmakingEntity(db.Model):
+    """Registered players and pairings of a shard of the index of a block.
+
+    The key name is '<blockID>:<shard index>'; every shard of a block exists
+    once the index of the block is built.
+    """
+    updated_on = db.DateTimeProperty(indexed=True)
+
+    # JSON dict of player name to a list of names the player has defies with,
+    # for the players of this shard.
+    data = db.TextProperty()
+
+    @classmethod
+    def make_key(cls, block_id, index):
+        return db.Key.from_path(cls.kind(), '%s:%s' % (block_id, index))
+
+
+class MatchmakingIndex(object):
+    """Registered players of a block and the opponents they already faced."""
+
+    def __init__(self, block_id, pairings):
+        self._block_id = block_id
+        self._pairings = pairings
+
+    @classmethod
+    def decode(cls, block_id, data):
+        return cls(block_id, json.loads(data))
+
+    @classmethod
+    def merge(cls, block_id, datas):
+        """Returns the index made of the encoded pairings of some shards."""
+        pairings = {}
+        for data in datas:
+            pairings.update(json.loads(data))
+        return cls(block_id, pairings)
+
+    def encode(self):
+        return json.dumps(self._pairings)
+
+    def encode_shard(self, index):
+        """Returns the encoded pairings of the players of one shard."""
+        return json.dumps(dict([
+            (name, opponents) for name, opponents in self._pairings.items()
+            if shard_of(name) == index]))
+
+    @property
+    def registered(self):
+        return set(self._pairings.keys())
+
+    def register(self, name):
+        self._pairings.setdefault(name, [])
+
+    def unregister(self, name):
+        for opponent in self._pairings.pop(name, []):
+            if name in self._pairings.get(opponent, []):
+                self._pairings[opponent].remove(name)
+
+    def played(self, name):
+        """Returns names of players a given player already has defies with."""
+        return list(self._pairings.get(name, []))
+
+    def pair(self, rname, lname):
+        for name, opponent in [(rname, lname), (lname, rname)]:
+            opponents = self._pairings.setdefault(name, [])
+            if opponent not in opponents:
+                opponents.append(opponent)
+
+    def opponents_of(self, name, pending=None):
+        """Returns names of players a given player can send an invitation to.
+
+        Args:
+            name: string. Nickname of the player.
+            pending: iterable of names with a pending invitation from or to
+                the player.
+
+        Returns:
+            A sorted list of player names.
+        """
+        excluded = set(self._pairings.get(name, []))
+        excluded.add(name)
+        if pending:
+            excluded.update(pending)
+        return sorted(self.registered - excluded)
+
+
+class Matchmaking(object):
+    """Loads and transactionally updates the MatchmakingIndex of a block.
+
+    The index can always be built again from the blocks and defies in the
+    datastore with rebuild(), so an update lost between writing a block or a
+    defy and writing the index is repaired by registering or pairing again.
+    """
+
+    @classmethod
+    def _memcache_key(cls, block_id):
+        return 'gdefier:matchmaking:%s' % block_id
+
+    @classmethod
+    def _shard_keys(cls, block_id, indexes=None):
+        if indexes is None:
+            indexes = range(NUM_SHARDS)
+        return [GDefierMatchmakingEntity.make_key(block_id, index)
+                for index in indexes]
+
+    @classmethod
+    def _put_shards(cls, block_id, index):
+        now = datetime.datetime.now()
+        db.put([
+            GDefierMatchmakingEntity(
+                key=key, updated_on=now, data=index.encode_shard(i))
+            for i, key in enumerate(cls._shard_keys(block_id))])
+
+    @classmethod
+    @db.transactional(xg=True)
+    def _create(cls, block_id, index):
+        entities = db.get(cls._shard_keys(block_id))
+        if all(entities):
+            return MatchmakingIndex.merge(
+                block_id, [entity.data for entity in entities])
+        cls._put_shards(block_id, index)
+        return index
+
+    @classmethod
+    def load(cls, block_id, build):
+        """Returns the MatchmakingIndex of a block.
+
+        Args:
+            block_id: string. The block title.
+            build: callable taking a block_id and returning a MatchmakingIndex
+                built from the datastore; only called the first time the index
+                of a block is needed.
+
+        Returns:
+            A MatchmakingIndex instance.
+        """
+        data = MemcacheManager.get(cls._memcache_key(block_id))
+        if data:
+            return MatchmakingIndex.decode(block_id, data)
+        entities = db.get(cls._shard_keys(block_id))
+        if all(entities):
+            index = MatchmakingIndex.merge(
+                block_id, [entity.data for entity in entities])
+        else:
+            index = cls._create(block_id, build(block_id))
+        MemcacheManager.set(cls._memcache_key(block_id), index.encode())
+        return index
+
+    @classmethod
+    def rebuild(cls, block_id, build):
+        """Replaces the index of a block with one built from the datastore."""
+        cls._put_shards(block_id, build(block_id))
+        MemcacheManager.delete(cls._memcache_key(block_id))
+
+    @classmethod
+    @db.transactional(xg=True)
+    def _update(cls, block_id, indexes, mutator):
+        keys = cls._shard_keys(block_id, indexes)
+        entities = db.get(keys)
+        if not all(entities):
+            # Not built yet; the first load builds it from the datastore.
+            return
+        index = MatchmakingIndex.merge(
+            block_id, [entity.data for entity in entities])
+        mutator(index)
+        changed = []
+        for shard_index, entity in zip(
+                indexes or range(NUM_SHARDS), entities):
+            data = index.encode_shard(shard_index)
+            if json.loads(data) != json.loads(entity.data):
+                entity.updated_on = datetime.datetime.now()
+                entity.data = data
+                changed.append(entity)
+        db.put(changed)
+
+    @classmethod
+    def update(cls, block_id, names, mutator):
+        """Applies mutator(index) to the stored index of a block.
+
+        Args:
+            block_id: string. The block title.
+            names: iterable of names of the players the mutator changes, or
+                None to load every shard of the index.
+            mutator: callable taking a MatchmakingIndex with at least the
+                pairings of the given players.
+        """
+        indexes = None
+        if names is not None:
+            indexes = sorted(set([shard_of(name) for name in names]))
+            if not indexes:
+                return
+        cls._update(block_id, indexes, mutator)
+        MemcacheManager.delete(cls._memcache_key(block_id))
+
+    @classmethod
+    def register(cls, block_id, name):
+        cls.register_many(block_id, [name])
+
+    @classmethod
+    def register_many(cls, block_id, names):
+        """Registers players in a block; registered players are unchanged."""
+        def mutator(index):
+            for name in names:
+                index.register(name)
+        cls.update(block_id, names, mutator)
+
+    @classmethod
+    def unregister(cls, block_id, name):
+        # Opponents of the player may be in any shard.
+        cls.update(block_id, None, lambda index: index.unregister(name))
+
+    @classmethod
+    def pair(cls, block_id, rname, lname):
+        cls.pair_many(block_id, [(rname, lname)])
+
+    @classmethod
+    def pair_many(cls, block_id, pairs):
+        def mutator(index):
+            for rname, lname in pairs:
+                index.pair(rname, lname)
+        names = [name for pair in pairs for name in pair]
+        cls.update(block_id, names, mutator)
@@ -0,0 +1,83 @@
+"""Cached list of the players that are members of a G-Defier group."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+from models.models import CAN_USE_MEMCACHE
+from models.models import MemcacheManager
+from models.recent_changes import RecentChanges
+
+
+def _apply(values, changes):
+    """Applies a dict of player key to True (added) or False (removed)."""
+    keys = values['keys']
+    changed = False
+    for player_key, added in changes.items():
+        if added and player_key not in keys:
+            keys.append(player_key)
+            changed = True
+        elif not added and player_key in keys:
+            keys.remove(player_key)
+            changed = True
+    if changed:
+        keys.sort()
+        values['version'] += 1
+    return changed
+
+
+class Membership(object):
+    """Versioned list of player keys of a group kept in memcache.
+
+    The datastore stays the source of truth: a missing list is rebuilt from
+    the players, and changes made since are applied to it; see
+    RecentChanges. Every change increments the version, so readers holding
+    an older version can tell their copy is stale.
+    """
+
+    @classmethod
+    def _memcache_key(cls, group_key):
+        return 'gdefier:group-members:%s' % group_key
+
+    @classmethod
+    def _recent_key(cls, group_key):
+        return 'gdefier:group-members-recent:%s' % group_key
+
+    @classmethod
+    def _recent_changes(cls, group_key):
+        return RecentChanges(
+            cls._memcache_key(group_key), cls._recent_key(group_key),
+            MemcacheManager.get_namespace(), _apply)
+
+    @classmethod
+    def load(cls, group_key, build):
+        """Returns a (version, [player key strings]) tuple of a group.
+
+        Args:
+            group_key: db.Key of the GDefierGroup.
+            build: callable taking the group_key and returning a list of
+                player keys; called when the list is not cached.
+        """
+        values = MemcacheManager.get(cls._memcache_key(group_key))
+        if values is None:
+            values = {
+                'version': 0,
+                'keys': sorted([str(key) for key in build(group_key)])}
+            if CAN_USE_MEMCACHE.value:
+                cls._recent_changes(group_key).add(values)
+        return values['version'], values['keys']
+
+    @classmethod
+    def _change(cls, group_key, changes):
+        if CAN_USE_MEMCACHE.value:
+            cls._recent_changes(group_key).change(changes)
+
+    @classmethod
+    def add(cls, group_key, player_keys):
+        """Adds players to the cached list; call after they were put."""
+        cls._change(group_key, dict(
+            [(str(player_key), True) for player_key in player_keys]))
+
+    @classmethod
+    def remove(cls, group_key, player_keys):
+        """Removes players from the cached list; call after they were deleted."""
+        cls._change(group_key, dict(
+            [(str(player_key), False) for player_key in player_keys]))
@@ -0,0 +1,79 @@
+"""Compiles the question cast of G-Defier blocks into question descriptors."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+import random
+import re
+import zlib
+
+# Matches one custom tag of a question cast, e.g. <khanex name="x"></khanex>.
+QUESTION_TAG = re.compile(
+    r'<(?P<tag>[\w-]+)(?P<attributes>[^>]*?)(?:/>|>.*?</(?P=tag)\s*>)', re.S)
+QUESTION_ATTRIBUTE = re.compile(r'([\w-]+)\s*=\s*"([^"]*)"')
+
+# Ways of assigning the questions of a block to the rounds of a defy.
+ORDER_SEQUENTIAL = 'sequential'
+ORDER_ROUND_ROBIN = 'round_robin'
+ORDER_RANDOM = 'random'
+ORDERS = [ORDER_SEQUENTIAL, ORDER_ROUND_ROBIN, ORDER_RANDOM]
+
+
+def compile_cast(html):
+    """Returns a list of question descriptors found in question cast HTML.
+
+    Each descriptor is a dict with the 'tag' name, its 'attributes' dict, the
+    'html' to render and the 'index' of the question in the cast.
+    """
+    questions = []
+    if not html:
+        return questions
+    for match in QUESTION_TAG.finditer(html):
+        questions.append({
+            'tag': match.group('tag'),
+            'attributes': dict(
+                QUESTION_ATTRIBUTE.findall(match.group('attributes'))),
+            'html': match.group(0),
+            'index': len(questions)})
+    return questions
+
+
+def compile_blocks(blocks):
+    """Returns a dict of block title to the compiled questions of the block."""
+    compiled = {}
+    for block in blocks or []:
+        compiled[block['block_title']] = compile_cast(
+            block.get('question_cast'))
+    return compiled
+
+
+def assign_rounds(questions, rounds, order=ORDER_SEQUENTIAL, seed=None):
+    """Picks a question for each round of a defy.
+
+    Args:
+        questions: list of question descriptors of a block.
+        rounds: int. Number of rounds of the defy.
+        order: string. One of ORDERS.
+        seed: hashable. Identifies the defy, so both of its players get the
+            same questions in the same order.
+
+    Returns:
+        A list of question descriptors, one for each round, extended with the
+        'round' they were assigned to.
+    """
+    if not questions or rounds <= 0:
+        return []
+    # Stable across instances, unlike hash() of the seed.
+    stable_seed = zlib.crc32(str(seed)) & 0xffffffff
+    indexes = range(len(questions))
+    if order == ORDER_RANDOM:
+        random.Random(stable_seed).shuffle(indexes)
+    elif order == ORDER_ROUND_ROBIN:
+        offset = stable_seed % len(indexes)
+        indexes = indexes[offset:] + indexes[:offset]
+
+    assigned = []
+    for number in range(rounds):
+        question = dict(questions[indexes[number % len(indexes)]])
+        question['round'] = number
+        assigned.append(question)
+    return assigned
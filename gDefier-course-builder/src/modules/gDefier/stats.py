@@ -0,0 +1,342 @@
+"""Sharded counters for the aggregate statistics of G-Defier players."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+import datetime
+import json
+import random
+import uuid
+
+from models.models import CAN_USE_MEMCACHE
+from models.models import MemcacheManager
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+# Statistics counted for every player and for every block of a player.
+STATS = ['score', 'attempts', 'fails', 'hints', 'wins', 'lost', 'rating']
+
+# Number of shards of each counter; more shards allow more concurrent writes.
+NUM_SHARDS = 8
+
+# Buffered increments are flushed into counter shards in batches of this size.
+FLUSH_BATCH_SIZE = 100
+
+# Attempts to update a memcache buffer before giving up to concurrent writers.
+MAX_CAS_RETRIES = 10
+
+# Buffered increments expire from memcache after this many seconds; they are
+# flushed into the counters long before.
+BUFFER_TTL_SECS = 60 * 60
+
+
+class GDefierStatShard(db.Model):
+    """Pending increments of one player or block not yet folded into it.
+
+    The key name is '<target key>:<shard index>', where target is the key of
+    the GDefierPlayer or GDefierBlock the increments belong to.
+    """
+    target = db.StringProperty(indexed=False)
+    dirty = db.BooleanProperty(indexed=True, default=False)
+    updated_on = db.DateTimeProperty(indexed=True)
+
+    score = db.IntegerProperty(indexed=False, default=0)
+    attempts = db.IntegerProperty(indexed=False, default=0)
+    fails = db.IntegerProperty(indexed=False, default=0)
+    hints = db.IntegerProperty(indexed=False, default=0)
+    wins = db.IntegerProperty(indexed=False, default=0)
+    lost = db.IntegerProperty(indexed=False, default=0)
+    rating = db.IntegerProperty(indexed=False, default=0)
+
+    @classmethod
+    def make_key(cls, target_key, index):
+        return db.Key.from_path(cls.kind(), '%s:%s' % (target_key, index))
+
+    def values(self):
+        return dict([(name, getattr(self, name)) for name in STATS])
+
+
+class GDefierStatBatch(db.Model):
+    """Increments of several targets not yet added to their counter shards.
+
+    A batch is a child of the entity whose change produced it, so it is put
+    in the same transaction as that entity without writing any counter.
+    """
+    pending = db.BooleanProperty(indexed=True, default=True)
+    updated_on = db.DateTimeProperty(indexed=False)
+
+    # JSON list of [target key, deltas] pairs.
+    data = db.TextProperty()
+
+    def increments(self):
+        return json.loads(self.data)
+
+
+class GDefierStatLease(db.Model):
+    """Lease of the job folding the counters of a course."""
+    token = db.StringProperty(indexed=False)
+    expires_on = db.DateTimeProperty(indexed=False)
+
+
+def zero():
+    return dict([(name, 0) for name in STATS])
+
+
+def add(values, deltas):
+    """Returns a new dict with deltas added to values."""
+    result = dict(values)
+    for name in STATS:
+        result[name] = result.get(name, 0) + deltas.get(name, 0)
+    return result
+
+
+class Stats(object):
+    """Records increments into shards and folds them into their targets."""
+
+    @classmethod
+    def _memcache_key(cls, target_key):
+        return 'gdefier:stats:pending:%s' % target_key
+
+    @classmethod
+    def _buffer_key(cls, target_key):
+        return 'gdefier:stats:buffer:%s' % target_key
+
+    @classmethod
+    def pick_shard_key(cls, target_key):
+        """Returns the key of a random shard of a target."""
+        return GDefierStatShard.make_key(
+            target_key, random.randint(0, NUM_SHARDS - 1))
+
+    @classmethod
+    def increment(cls, shard_key, shard, deltas):
+        """Adds deltas to a shard; creates the shard if it is None.
+
+        Call from within the transaction that reads the shard, and put the
+        returned shard in the same transaction.
+        """
+        if not shard:
+            shard = GDefierStatShard(key_name=shard_key.name())
+            shard.target = shard_key.name().rsplit(':', 1)[0]
+        for name in STATS:
+            setattr(shard, name, getattr(shard, name) + deltas.get(name, 0))
+        shard.dirty = True
+        shard.updated_on = datetime.datetime.now()
+        return shard
+
+    @classmethod
+    def record(cls, parent, key_name, increments):
+        """Returns a new batch of increments of several targets.
+
+        Put the batch in the transaction that changes its parent; the
+        increments are added to counter shards later by flush().
+
+        Args:
+            parent: the entity whose change produced the increments.
+            key_name: string. Unique name of the change within the parent.
+            increments: list of (target key, deltas) tuples.
+        """
+        return GDefierStatBatch(
+            parent=parent, key_name=key_name,
+            updated_on=datetime.datetime.now(), data=json.dumps(
+                [[str(target_key), deltas]
+                 for target_key, deltas in increments]))
+
+    @classmethod
+    def _update_buffer(cls, target_key, mutator):
+        client = memcache.Client()
+        key = cls._buffer_key(target_key)
+        namespace = MemcacheManager.get_namespace()
+        for unused_attempt in range(MAX_CAS_RETRIES):
+            values = client.gets(key, namespace=namespace)
+            if values is None:
+                values = {}
+                mutator(values)
+                if client.add(
+                        key, values, BUFFER_TTL_SECS, namespace=namespace):
+                    return
+            else:
+                mutator(values)
+                if client.cas(key, values, BUFFER_TTL_SECS,
+                              namespace=namespace):
+                    return
+
+    @classmethod
+    def buffer(cls, batch):
+        """Makes a committed batch visible to pending() until it is flushed.
+
+        Increments are buffered in memcache by target; a buffer lost to
+        eviction only hides increments from pending() until the next flush.
+        """
+        if not CAN_USE_MEMCACHE.value:
+            return
+        batch_key = str(batch.key())
+        for target_key, deltas in batch.increments():
+            cls._update_buffer(
+                target_key,
+                lambda values, deltas=deltas: values.update(
+                    {batch_key: deltas}))
+
+    @classmethod
+    def _unbuffer(cls, batch):
+        if not CAN_USE_MEMCACHE.value:
+            return
+        batch_key = str(batch.key())
+        for target_key, unused_deltas in batch.increments():
+            cls._update_buffer(
+                target_key, lambda values: values.pop(batch_key, None))
+
+    @classmethod
+    @db.transactional(xg=True)
+    def _flush_batch(cls, batch_key):
+        batch = GDefierStatBatch.get(batch_key)
+        if not batch or not batch.pending:
+            return None
+        increments = batch.increments()
+        shard_keys = [cls.pick_shard_key(target_key)
+                      for target_key, unused_deltas in increments]
+        shards = db.get(shard_keys)
+        updated = []
+        for shard_key, shard, (unused_target, deltas) in zip(
+                shard_keys, shards, increments):
+            updated.append(cls.increment(shard_key, shard, deltas))
+        batch.pending = False
+        db.put(updated + [batch])
+        return batch
+
+    @classmethod
+    def flush(cls, limit=1000):
+        """Adds pending batches of increments to counter shards.
+
+        Returns:
+            The number of batches flushed.
+        """
+        count = 0
+        query = GDefierStatBatch.all(keys_only=True).filter('pending =', True)
+        for batch_key in query.fetch(limit):
+            batch = cls._flush_batch(batch_key)
+            if not batch:
+                continue
+            cls.invalidate([target_key for target_key, unused_deltas
+                            in batch.increments()])
+            cls._unbuffer(batch)
+            count += 1
+        return count
+
+    @classmethod
+    def invalidate(cls, target_keys):
+        """Drops cached pending values; call after a transaction commits."""
+        for target_key in target_keys:
+            MemcacheManager.delete(cls._memcache_key(target_key))
+
+    @classmethod
+    def _pending_in_shards(cls, target_key):
+        values = MemcacheManager.get(cls._memcache_key(target_key))
+        if values is not None:
+            return values
+        values = zero()
+        keys = [GDefierStatShard.make_key(target_key, index)
+                for index in range(NUM_SHARDS)]
+        for shard in db.get(keys):
+            if shard:
+                values = add(values, shard.values())
+        MemcacheManager.set(cls._memcache_key(target_key), values)
+        return values
+
+    @classmethod
+    def _pending_in_buffer(cls, target_key):
+        values = zero()
+        buffered = memcache.get(
+            cls._buffer_key(target_key),
+            namespace=MemcacheManager.get_namespace())
+        if not buffered:
+            return values
+
+        # A batch flushed before it was buffered is never unbuffered; its
+        # increments are in the shards already, so only count pending ones.
+        batch_keys = sorted(buffered.keys())
+        flushed = []
+        for batch_key, batch in zip(
+                batch_keys, db.get([db.Key(key) for key in batch_keys])):
+            if batch and batch.pending:
+                values = add(values, buffered[batch_key])
+            else:
+                flushed.append(batch_key)
+        if flushed:
+            def unbuffer(values):
+                for batch_key in flushed:
+                    values.pop(batch_key, None)
+            cls._update_buffer(target_key, unbuffer)
+        return values
+
+    @classmethod
+    def pending(cls, target_key):
+        """Returns the sum of increments not yet folded into a target."""
+        values = cls._pending_in_shards(target_key)
+        if CAN_USE_MEMCACHE.value:
+            values = add(values, cls._pending_in_buffer(target_key))
+        return values
+
+    @classmethod
+    @db.transactional()
+    def acquire_lease(cls, seconds):
+        """Returns a token if no other job holds the fold lease, else None."""
+        now = datetime.datetime.now()
+        lease = GDefierStatLease.get_by_key_name('fold')
+        if lease and lease.expires_on > now:
+            return None
+        token = uuid.uuid4().hex
+        GDefierStatLease(
+            key_name='fold', token=token,
+            expires_on=now + datetime.timedelta(seconds=seconds)).put()
+        return token
+
+    @classmethod
+    @db.transactional()
+    def release_lease(cls, token):
+        lease = GDefierStatLease.get_by_key_name('fold')
+        if lease and lease.token == token:
+            lease.delete()
+
+    @classmethod
+    def dirty_targets(cls, limit=1000):
+        """Returns keys of targets with increments waiting to be folded."""
+        shards = GDefierStatShard.all().filter('dirty =', True).fetch(limit)
+        return sorted(set([shard.target for shard in shards]))
+
+    @classmethod
+    @db.transactional(xg=True)
+    def _fold_shard(cls, shard_key, apply_fn):
+        shard = GDefierStatShard.get(shard_key)
+        if not shard or not shard.dirty:
+            return None
+        target = db.get(db.Key(shard.target))
+        if not target:
+            return None
+        apply_fn(target, shard.values())
+        for name in STATS:
+            setattr(shard, name, 0)
+        shard.dirty = False
+        shard.updated_on = datetime.datetime.now()
+        db.put([target, shard])
+        return target
+
+    @classmethod
+    def fold(cls, target_key, apply_fn):
+        """Moves pending increments of a target onto the target entity.
+
+        Args:
+            target_key: string. Key of the GDefierPlayer or GDefierBlock.
+            apply_fn: callable(target, deltas) that adds a dict of deltas to
+                the target entity; it must not put the target.
+
+        Returns:
+            The updated target entity, or None if nothing was folded.
+        """
+        target = None
+        for index in range(NUM_SHARDS):
+            folded = cls._fold_shard(
+                GDefierStatShard.make_key(target_key, index), apply_fn)
+            if folded:
+                target = folded
+        cls.invalidate([target_key])
+        return target
@@ -0,0 +1,126 @@
+"""Pairings and progress of G-Defier tournaments."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+import datetime
+import json
+
+from google.appengine.ext import db
+
+# Pairing systems of a tournament.
+SYSTEM_ROUND_ROBIN = 'round_robin'
+SYSTEM_SWISS = 'swiss'
+SYSTEMS = [SYSTEM_ROUND_ROBIN, SYSTEM_SWISS]
+
+# Tournament states.
+STATUS_SCHEDULING = 'scheduling'
+STATUS_SCHEDULED = 'scheduled'
+
+
+class GDefierTournament(db.Model):
+    """Progress of the tournament of one block; blockID is the key name."""
+    system = db.StringProperty(indexed=False)
+    status = db.StringProperty(indexed=False)
+    # Number of rounds scheduled so far.
+    rounds = db.IntegerProperty(indexed=False, default=0)
+    defies_total = db.IntegerProperty(indexed=False, default=0)
+    defies_created = db.IntegerProperty(indexed=False, default=0)
+    updated_on = db.DateTimeProperty(indexed=True)
+    # JSON list of [round, name, name] of the defies being scheduled, kept
+    # until scheduling finishes so a retried run creates the same defies.
+    pairs = db.TextProperty()
+
+    @classmethod
+    def get_or_create(cls, block_id, system):
+        tournament = cls.get_by_key_name(block_id)
+        if not tournament or tournament.system != system:
+            tournament = cls(key_name=block_id, system=system)
+        return tournament
+
+    def start(self, defies_total, pairs=None):
+        """Records that defies are being scheduled.
+
+        Args:
+            defies_total: number of defies to create.
+            pairs: list of (round, name, name) tuples of the defies, if
+                scheduling them again could pair players differently.
+        """
+        self.status = STATUS_SCHEDULING
+        self.defies_total = defies_total
+        self.defies_created = 0
+        self.pairs = json.dumps(pairs) if pairs is not None else None
+        self.updated_on = datetime.datetime.now()
+        self.put()
+
+    def scheduling_pairs(self):
+        """Returns pairs recorded by start() of an unfinished run, or None."""
+        if self.status != STATUS_SCHEDULING or not self.pairs:
+            return None
+        return [tuple(pair) for pair in json.loads(self.pairs)]
+
+    def progress(self, defies_created):
+        self.defies_created += defies_created
+        self.updated_on = datetime.datetime.now()
+        self.put()
+
+    def finish(self, rounds):
+        self.status = STATUS_SCHEDULED
+        self.rounds = rounds
+        self.pairs = None
+        self.updated_on = datetime.datetime.now()
+        self.put()
+
+
+def round_robin(names):
+    """Returns rounds where every player meets every other player once.
+
+    Uses the circle method; with an odd number of players one of them rests
+    in every round.
+
+    Args:
+        names: list of player names.
+
+    Returns:
+        A list of rounds, each a list of (name, name) pairs.
+    """
+    players = sorted(names)
+    if len(players) % 2:
+        players.append(None)
+    rounds = []
+    for unused_round in range(len(players) - 1):
+        half = len(players) / 2
+        pairs = []
+        for a, b in zip(players[:half], reversed(players[half:])):
+            if a is not None and b is not None:
+                pairs.append((a, b))
+        rounds.append(pairs)
+        # Keep the first player fixed and rotate all the others.
+        players = [players[0], players[-1]] + players[1:-1]
+    return rounds
+
+
+def swiss(names, scores, played):
+    """Returns the pairs of the next round of a Swiss tournament.
+
+    Players are sorted by score and each one is paired with the next player
+    with a similar score that it has not played yet. With an odd number of
+    players the lowest ranked one left rests.
+
+    Args:
+        names: list of player names.
+        scores: dict of name to a number; missing names score 0.
+        played: callable taking a name and returning names already faced.
+
+    Returns:
+        A list of (name, name) pairs.
+    """
+    pending = sorted(names, key=lambda name: (-scores.get(name, 0), name))
+    pairs = []
+    while len(pending) > 1:
+        player = pending.pop(0)
+        faced = set(played(player))
+        for index, opponent in enumerate(pending):
+            if opponent not in faced:
+                pairs.append((player, pending.pop(index)))
+                break
+    return pairs
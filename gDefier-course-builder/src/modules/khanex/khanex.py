@@ -84,6 +84,7 @@ Good luck!
 __author__ = 'Pavel Simakov (pavel@vokamis.com)'
 
 import cgi
+import datetime
 import os
 import urllib2
 import urlparse
@@ -100,6 +101,10 @@ from models.counters import PerfCounter
 from models import custom_modules
 from models import models
 from models import transforms
+from modules.gDefier import gDefier_model
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import deferred
 
 ATTEMPT_COUNT = PerfCounter(
     'gcb-khanex-attempt-count',
@@ -246,6 +251,18 @@ class KhanExerciseTag(tags.BaseTag):
         return reg
 
 
+def _record_event(namespace, user, data, recorded_on):
+    """Deferred task recording an exercise submission event."""
+    old_namespace = namespace_manager.get_namespace()
+    try:
+        namespace_manager.set_namespace(namespace)
+        models.EventEntity.record(
+            'module-khanex.exercise-submit', user, data,
+            recorded_on=recorded_on)
+    finally:
+        namespace_manager.set_namespace(old_namespace)
+
+
 class KhanExerciseRenderer(utils.BaseHandler):
     """A handler that renders Khan Academy Exercise."""
 
@@ -270,28 +287,24 @@ class KhanExerciseRenderer(utils.BaseHandler):
         if not student:
             return False
 
-        # record submission
-        event = models.EventEntity.record(
-            'module-khanex.exercise-submit', self.get_user(), data)
+        # record submission; the event is only read by analytics, so it is
+        # written off the request path
+        deferred.defer(
+            _record_event, namespace_manager.get_namespace(),
+            self.get_user(), data, datetime.datetime.now())
 
         # update progress
         unit_id, lesson_id = self._get_unit_lesson_from(data)
         self.get_course().get_progress_tracker().put_activity_accessed(
             student, unit_id, lesson_id)
 
-        return True,event
+        return True
 
-    def _get_unit_lesson_from(self, data):
-        """Extract unit and lesson id from exercise data submission."""
+    def _get_origin_query_from(self, data):
+        """Extract the query of the page an exercise was embedded into."""
 
-        # we need to figure out unit and lesson id for the exercise;
-        # we currently have no direct way of doing it, so we have to do it
-        # indirectly == ugly...; an exercise captures a page URL where it was
-        # embedded; we can parse that URL out and find all the interesting
-        # parts from the query string
-
-        unit_id = 0
-        lesson_id = 0
+        # an exercise captures a page URL where it was embedded; we can parse
+        # that URL out and find all the interesting parts from the query string
         json = transforms.loads(data)
         if json:
             location = json.get('location')
@@ -303,19 +316,39 @@ class KhanExerciseRenderer(utils.BaseHandler):
                     ity_ef_origin = ity_ef_origin[0]
                     origin_path = urlparse.urlparse(ity_ef_origin)
                     if origin_path.query:
-                        query = urlparse.parse_qs(origin_path.query)
-                        unit_id = self._int_list_to_int(query.get('unit'))
-                        lesson_id = self._int_list_to_int(query.get('lesson'))
+                        return urlparse.parse_qs(origin_path.query)
+        return {}
 
-                        # when we are on the first lesson of a unit, leson_id is
-                        # not present :(; look it up
-                        if not lesson_id:
-                            lessons = self.get_course().get_lessons(unit_id)
-                            if lessons:
-                                lesson_id = lessons[0].lesson_id
+    def _get_unit_lesson_from(self, data):
+        """Extract unit and lesson id from exercise data submission."""
+
+        # we need to figure out unit and lesson id for the exercise;
+        # we currently have no direct way of doing it, so we have to do it
+        # indirectly == ugly...
+
+        unit_id = 0
+        lesson_id = 0
+        query = self._get_origin_query_from(data)
+        if query:
+            unit_id = self._int_list_to_int(query.get('unit'))
+            lesson_id = self._int_list_to_int(query.get('lesson'))
+
+            # when we are on the first lesson of a unit, leson_id is
+            # not present :(; look it up
+            if not lesson_id:
+                lessons = self.get_course().get_lessons(unit_id)
+                if lessons:
+                    lesson_id = lessons[0].lesson_id
 
         return unit_id, lesson_id
 
+    def _get_defy_key_from(self, data):
+        """Extract the key of the G-Defier defy an exercise was answered in."""
+        defy_key = self.request.get('defy')
+        if not defy_key:
+            defy_key = self._get_origin_query_from(data).get('defy', [None])[0]
+        return defy_key
+
     def _int_list_to_int(self, list):
         if list:
             return int(list[0])
@@ -324,13 +357,16 @@ class KhanExerciseRenderer(utils.BaseHandler):
     def post(self):
         """Handle POST, i.e. 'Check Answer' button is pressed."""
         data = self.request.get('ity_ef_audit')
-        result, event = self._record_student_submission(data)
-        if result:
+        if self._record_student_submission(data):
             ATTEMPT_COUNT.inc()
+
+            # score passed answers given in a G-Defier arena right away
+            js_data = json.loads(data)
+            defy_key = self._get_defy_key_from(data)
+            if js_data.get('pass') and defy_key:
+                gDefier_model.record_answer(self, defy_key, js_data)
+
             self.response.write('{}')  # we must return valid JSON on success
-            data = json.loads(data)
-            if data['pass']:
-                self.redirect('/gDefier/arena?khandata='+str(event.key()))
             return
 
         self.error(404)
@@ -0,0 +1,115 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Functional tests for models.courses."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+import time
+
+from models import config
+from models import courses
+from models import models
+from tests.functional import actions
+
+# Disable complaints about docstrings for self-documenting tests.
+# pylint: disable-msg=g-missing-docstring
+
+
+class _AppContext(object):
+
+    def get_namespace_name(self):
+        return ''
+
+
+class _CachedValue(courses.AbstractCachedObject):
+    """Caches a plain value, so tests can tell which copy they got."""
+
+    VERSION = 'test'
+
+    def __init__(self, value=None):
+        self.version = self.VERSION
+        self.value = value
+
+    @classmethod
+    def new_memento(cls):
+        return _CachedValue()
+
+    @classmethod
+    def instance_from_memento(cls, unused_app_context, memento):
+        return memento.value
+
+    @classmethod
+    def memento_from_instance(cls, value):
+        return _CachedValue(value)
+
+
+class AbstractCachedObjectTestCase(actions.TestBase):
+
+    def setUp(self):  # pylint: disable-msg=g-bad-name
+        super(AbstractCachedObjectTestCase, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.app_context = _AppContext()
+        self.builds = []
+
+    def tearDown(self):  # pylint: disable-msg=g-bad-name
+        config.Registry.test_overrides = {}
+        super(AbstractCachedObjectTestCase, self).tearDown()
+
+    def build(self):
+        self.builds.append(True)
+        return 'built'
+
+    def make_stale(self):
+        _CachedValue.save(self.app_context, 'stale')
+        envelope = models.MemcacheManager.get(_CachedValue._make_key())
+        envelope['expires_on'] = time.time() - 1
+        models.MemcacheManager.set(_CachedValue._make_key(), envelope)
+
+    def hold_lease(self):
+        models.MemcacheManager.add(
+            '%s:lease' % _CachedValue._make_key(), True)
+
+    def test_builds_once_and_serves_from_cache(self):
+        for unused_attempt in range(3):
+            self.assertEqual(
+                'built',
+                _CachedValue.load_or_build(self.app_context, self.build))
+        self.assertEqual(1, len(self.builds))
+
+    def test_stale_value_is_rebuilt(self):
+        self.make_stale()
+        self.assertEqual(
+            'built', _CachedValue.load_or_build(self.app_context, self.build))
+        self.assertEqual('built', _CachedValue.load(self.app_context))
+        self.assertEqual(1, len(self.builds))
+
+    def test_stale_value_is_served_while_another_request_rebuilds(self):
+        self.make_stale()
+        self.hold_lease()
+        self.assertEqual(
+            'stale', _CachedValue.load_or_build(self.app_context, self.build))
+        self.assertEqual(0, len(self.builds))
+
+    def test_missing_value_is_built_after_waiting_for_another_request(self):
+        self.hold_lease()
+        old_wait_secs = courses.CACHED_OBJECT_WAIT_SECS
+        try:
+            courses.CACHED_OBJECT_WAIT_SECS = 0
+            self.assertEqual(
+                'built',
+                _CachedValue.load_or_build(self.app_context, self.build))
+        finally:
+            courses.CACHED_OBJECT_WAIT_SECS = old_wait_secs
+        self.assertEqual(1, len(self.builds))
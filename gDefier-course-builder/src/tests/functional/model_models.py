@@ -20,9 +20,13 @@ __author__ = [
 
 import datetime
 
+from models import config
 from models import models
 from tests.functional import actions
 
+from google.appengine.api import memcache
+from google.appengine.api import users
+
 # Disable complaints about docstrings for self-documenting tests.
 # pylint: disable-msg=g-missing-docstring
 
@@ -39,6 +43,23 @@ class EventEntityTestCase(actions.ExportTestBase):
         self.assertEqual('transformed_1', exported.user_id)
         self.assertEqual(key, models.EventEntity.safe_key(key, self.transform))
 
+    def test_record_keeps_time_of_event_recorded_later(self):
+        recorded_on = datetime.datetime(2013, 1, 2, 3, 4, 5)
+        user = users.User(email='test@example.com', _user_id='1')
+        event = models.EventEntity.record(
+            'source', user, '{}', recorded_on=recorded_on)
+        event = models.EventEntity.get(event.key())
+        self.assertEqual(recorded_on, event.recorded_on)
+        self.assertEqual('1', event.user_id)
+
+    def test_record_defaults_to_time_event_is_stored(self):
+        before = datetime.datetime.now()
+        user = users.User(email='test@example.com', _user_id='1')
+        event = models.EventEntity.record('source', user, '{}')
+        event = models.EventEntity.get(event.key())
+        self.assertTrue(event.recorded_on)
+        self.assertTrue(before <= event.recorded_on <= datetime.datetime.now())
+
 
 class PersonalProfileTestCase(actions.ExportTestBase):
 
@@ -125,6 +146,21 @@ class QuestionDAOTestCase(actions.TestBase):
         self.assertFalse(models.QuestionDAO.load(not_found_id))
         self.assertEqual([], models.QuestionDAO.used_by(not_found_id))
 
+    def test_bulk_load_returns_dto_or_none_for_each_id(self):
+        question_id = models.QuestionDAO.save(
+            models.QuestionDTO(None, {'description': 'bulk'}))
+        not_found_id = 1000
+
+        # Loads from the datastore first and from memcache then.
+        for unused_attempt in range(2):
+            dtos = models.QuestionDAO.bulk_load(
+                [not_found_id, question_id, None])
+            self.assertEqual(3, len(dtos))
+            self.assertIsNone(dtos[0])
+            self.assertEqual(question_id, dtos[1].id)
+            self.assertEqual('bulk', dtos[1].description)
+            self.assertIsNone(dtos[2])
+
 
 class StudentTestCase(actions.ExportTestBase):
 
@@ -180,3 +216,100 @@ class StudentPropertyEntityTestCase(actions.ExportTestBase):
             'transformed_%s-%s' % (user_id, property_name),
             models.StudentPropertyEntity.safe_key(
                 student_property_key, self.transform).name())
+
+
+class LocalCacheTestCase(actions.TestBase):
+
+    def test_least_recently_used_items_are_evicted_first(self):
+        cache = models.LocalCache(max_bytes=300)
+        cache.put('ns', 'a', 'a' * 100, 1)
+        cache.put('ns', 'b', 'b' * 100, 1)
+        self.assertEqual('a' * 100, cache.get('ns', 'a', 1))
+        cache.put('ns', 'c', 'c' * 100, 1)
+        self.assertEqual('a' * 100, cache.get('ns', 'a', 1))
+        self.assertIsNone(cache.get('ns', 'b', 1))
+        self.assertEqual('c' * 100, cache.get('ns', 'c', 1))
+        self.assertTrue(cache.size <= 300)
+
+    def test_items_too_large_are_not_cached(self):
+        cache = models.LocalCache(max_bytes=100)
+        cache.put('ns', 'a', 'a' * 200, 1)
+        self.assertIsNone(cache.get('ns', 'a', 1))
+        self.assertEqual(0, cache.size)
+
+    def test_items_of_other_version_namespace_or_expired_are_misses(self):
+        cache = models.LocalCache()
+        cache.put('ns', 'a', 'value', 1)
+        self.assertIsNone(cache.get('other_ns', 'a', 1))
+        self.assertIsNone(cache.get('ns', 'a', 2))
+        self.assertIsNone(cache.get('ns', 'a', 1))
+
+        cache = models.LocalCache(ttl=-1)
+        cache.put('ns', 'a', 'value', 1)
+        self.assertIsNone(cache.get('ns', 'a', 1))
+
+    def test_readers_get_their_own_copy(self):
+        cache = models.LocalCache()
+        cache.put('ns', 'a', {'items': [1]}, 1)
+        cache.get('ns', 'a', 1)['items'].append(2)
+        self.assertEqual({'items': [1]}, cache.get('ns', 'a', 1))
+
+
+class MemcacheManagerTestCase(actions.TestBase):
+
+    def setUp(self):  # pylint: disable-msg=g-bad-name
+        super(MemcacheManagerTestCase, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        config.Registry.test_overrides[models.CAN_USE_LOCAL_CACHE.name] = True
+        models.LOCAL_CACHE.clear()
+
+    def tearDown(self):  # pylint: disable-msg=g-bad-name
+        config.Registry.test_overrides = {}
+        models.LOCAL_CACHE.clear()
+        super(MemcacheManagerTestCase, self).tearDown()
+
+    def test_multi_operations_return_found_keys_only(self):
+        models.MemcacheManager.set_multi({'foo': 'bar', 'baz': 'qux'})
+        self.assertEqual(
+            {'foo': 'bar', 'baz': 'qux'},
+            models.MemcacheManager.get_multi(['foo', 'baz', 'missing']))
+        models.MemcacheManager.delete_multi(['foo', 'missing'])
+        self.assertEqual(
+            {'baz': 'qux'}, models.MemcacheManager.get_multi(['foo', 'baz']))
+
+    def test_prefix_counters_count_hits_and_misses(self):
+        self.assertEqual('entity:foo', models.get_key_prefix('(entity:foo:1)'))
+        models.MemcacheManager.set('test:prefix:1', 'bar')
+        models.MemcacheManager.get_multi(['test:prefix:1', 'test:prefix:2'])
+        counters = models.PREFIX_COUNTERS['test:prefix']
+        self.assertEqual(1, counters[models.PREFIX_COUNTER_HIT].value)
+        self.assertEqual(1, counters[models.PREFIX_COUNTER_MISS].value)
+        self.assertEqual(1, counters[models.PREFIX_COUNTER_PUT].value)
+
+    def test_local_items_are_served_without_memcache(self):
+        models.MemcacheManager.set('foo', 'bar', local=True)
+        memcache.flush_all()
+        self.assertEqual('bar', models.MemcacheManager.get('foo', local=True))
+        self.assertIsNone(models.MemcacheManager.get('foo'))
+
+    def test_delete_invalidates_all_local_items_of_namespace(self):
+        models.MemcacheManager.set('foo', 'bar', local=True)
+        models.MemcacheManager.set('baz', 'qux', local=True)
+        memcache.flush_all()
+        models.MemcacheManager.delete('foo', local=True)
+        self.assertIsNone(models.MemcacheManager.get('foo', local=True))
+        self.assertIsNone(models.MemcacheManager.get('baz', local=True))
+
+    def test_version_bumped_by_another_instance_invalidates_items(self):
+        models.MemcacheManager.set('foo', 'bar', local=True)
+        namespace = models.MemcacheManager.get_namespace()
+        memcache.incr(
+            models.LOCAL_CACHE_VERSION_KEY, namespace=namespace,
+            initial_value=0)
+        memcache.delete('foo', namespace=namespace)
+
+        # The version of the namespace is only checked once in a while.
+        self.assertEqual('bar', models.MemcacheManager.get('foo', local=True))
+        # pylint: disable-msg=protected-access
+        models.LOCAL_CACHE._versions.clear()
+        self.assertIsNone(models.MemcacheManager.get('foo', local=True))
@@ -0,0 +1,510 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Functional tests for modules.gDefier."""
+
+__author__ = 'Diego Garcia (diego.gmartin@alumnos.uc3m.es)'
+
+from models import config
+from models import models
+from modules.gDefier import arena
+from modules.gDefier import gDefier_model
+from modules.gDefier import leaderboard
+from modules.gDefier import matchmaking
+from modules.gDefier import membership
+from modules.gDefier import stats
+from modules.gDefier import tournament
+from tests.functional import actions
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+# Disable complaints about docstrings for self-documenting tests.
+# pylint: disable-msg=g-missing-docstring
+
+
+def _make_player(name, **values):
+    player = gDefier_model.GDefierPlayer(key_name=name, name=name, **values)
+    player.put()
+    return player
+
+
+class RankingTestCase(actions.TestBase):
+
+    def assert_sorted_and_unique(self, ranking):
+        rows = ranking.page(0, ranking.total)
+        names = [row['name'] for row in rows]
+        self.assertEqual(len(names), len(set(names)))
+        ranks = [row['rank'] for row in rows]
+        self.assertEqual(sorted(ranks), ranks)
+
+    def test_highest_value_ranks_first_for_ascending_metric(self):
+        ranking = leaderboard.Ranking('score', [])
+        ranking.set('a', 10)
+        ranking.set('b', 30)
+        ranking.set('c', 20)
+        self.assertEqual(
+            ['b', 'c', 'a'], [row['name'] for row in ranking.page(0, 10)])
+        self.assertEqual(1, ranking.rank_of(30))
+        self.assertEqual(3, ranking.rank_of(10))
+
+    def test_lowest_value_ranks_first_for_descending_metric(self):
+        ranking = leaderboard.Ranking('fails', [])
+        ranking.set('a', 5)
+        ranking.set('b', 1)
+        self.assertEqual(
+            ['b', 'a'], [row['name'] for row in ranking.page(0, 10)])
+        self.assertEqual(1, ranking.rank_of(1))
+
+    def test_ties_share_rank(self):
+        ranking = leaderboard.Ranking('wins', [])
+        for name in ['a', 'b', 'c']:
+            ranking.set(name, 3)
+        ranking.set('d', 1)
+        self.assertEqual(
+            [1, 1, 1, 4], [row['rank'] for row in ranking.page(0, 10)])
+
+    def test_set_replaces_entry_of_player(self):
+        ranking = leaderboard.Ranking('score', [])
+        ranking.set('a', 10)
+        ranking.set('a', 50)
+        ranking.set('a', 20)
+        self.assertEqual(1, ranking.total)
+        self.assertEqual(20, ranking.value_of('a'))
+        self.assert_sorted_and_unique(ranking)
+
+    def test_remove_does_not_need_value(self):
+        ranking = leaderboard.Ranking('score', [])
+        ranking.set('a', 10)
+        ranking.set('b', 20)
+        ranking.remove('a')
+        ranking.remove('missing')
+        self.assertEqual(1, ranking.total)
+        self.assertEqual(None, ranking.value_of('a'))
+
+    def test_decode_drops_duplicate_entries(self):
+        ranking = leaderboard.Ranking('score', [[-10, 'a'], [-20, 'a']])
+        self.assertEqual(1, ranking.total)
+        self.assert_sorted_and_unique(ranking)
+
+    def test_encode_round_trip(self):
+        ranking = leaderboard.Ranking('score', [])
+        for index in range(100):
+            ranking.set('player%s' % index, index % 7)
+        decoded = leaderboard.Ranking.decode('score', ranking.encode())
+        self.assertEqual(ranking.page(0, 100), decoded.page(0, 100))
+
+
+class LeaderboardTestCase(actions.TestBase):
+
+    def test_load_builds_ranking_from_players(self):
+        _make_player('a', score=5)
+        _make_player('b', score=7)
+        ranking = leaderboard.Leaderboard.load(
+            'score', gDefier_model.GDefierPlayer.all)
+        self.assertEqual(
+            ['b', 'a'], [row['name'] for row in ranking.page(0, 10)])
+
+    def test_changes_are_applied_in_batch(self):
+        _make_player('a', score=5)
+        players = gDefier_model.GDefierPlayer.all
+        leaderboard.Leaderboard.load('score', players)
+
+        leaderboard.Leaderboard.update([
+            ('a', dict(leaderboard.values_of(_make_player('a')), score=9)),
+            ('b', leaderboard.values_of(_make_player('b', score=1)))])
+        self.assertEqual(
+            1, leaderboard.Leaderboard.load('score', players).total)
+
+        self.assertEqual(2, leaderboard.Leaderboard.apply_changes())
+        ranking = leaderboard.Leaderboard.load('score', players)
+        self.assertEqual(9, ranking.value_of('a'))
+        self.assertEqual(1, ranking.value_of('b'))
+        self.assertEqual(0, leaderboard.Leaderboard.apply_changes())
+
+    def test_latest_change_of_player_wins(self):
+        players = gDefier_model.GDefierPlayer.all
+        leaderboard.Leaderboard.load('score', players)
+        values = leaderboard.values_of(_make_player('a'))
+        leaderboard.Leaderboard.update([('a', dict(values, score=3))])
+        leaderboard.Leaderboard.update([('a', dict(values, score=8))])
+        leaderboard.Leaderboard.apply_changes()
+        ranking = leaderboard.Leaderboard.load('score', players)
+        self.assertEqual(1, ranking.total)
+        self.assertEqual(8, ranking.value_of('a'))
+
+        leaderboard.Leaderboard.update([('a', None)])
+        leaderboard.Leaderboard.apply_changes()
+        self.assertEqual(
+            0, leaderboard.Leaderboard.load('score', players).total)
+
+    def test_decoded_ranking_is_kept_until_it_changes(self):
+        players = gDefier_model.GDefierPlayer.all
+        values = leaderboard.values_of(_make_player('a', score=5))
+        ranking = leaderboard.Leaderboard.load('score', players)
+        self.assertIs(ranking, leaderboard.Leaderboard.load('score', players))
+
+        leaderboard.Leaderboard.update([('a', dict(values, score=9))])
+        leaderboard.Leaderboard.apply_changes()
+        changed = leaderboard.Leaderboard.load('score', players)
+        self.assertIsNot(ranking, changed)
+        self.assertEqual(9, changed.value_of('a'))
+
+    def test_rebuild_replaces_stale_entries(self):
+        players = gDefier_model.GDefierPlayer.all
+        leaderboard.Leaderboard.load('score', players)
+        leaderboard.Leaderboard.update([('ghost', dict(
+            leaderboard.values_of(_make_player('ghost')), score=100))])
+        leaderboard.Leaderboard.apply_changes()
+        gDefier_model.GDefierPlayer.get_by_key_name('ghost').delete()
+        _make_player('a', score=2)
+
+        leaderboard.Leaderboard.rebuild(players())
+        ranking = leaderboard.Leaderboard.load('score', players)
+        self.assertEqual(
+            ['a'], [row['name'] for row in ranking.page(0, 10)])
+
+
+class MatchmakingTestCase(actions.TestBase):
+
+    def load(self, block_id='b'):
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        return matchmaking.Matchmaking.load(
+            block_id, gDefier_model._build_matchmaking_index)
+
+    def test_shards_merge_into_same_index(self):
+        index = matchmaking.MatchmakingIndex('b', {})
+        for number in range(50):
+            index.register('player%s' % number)
+        index.pair('player1', 'player2')
+        merged = matchmaking.MatchmakingIndex.merge('b', [
+            index.encode_shard(shard)
+            for shard in range(matchmaking.NUM_SHARDS)])
+        self.assertEqual(index.registered, merged.registered)
+        self.assertEqual(['player2'], merged.played('player1'))
+
+    def test_pairs_span_shards(self):
+        self.load()
+        names = ['player%s' % number for number in range(20)]
+        matchmaking.Matchmaking.register_many('b', names)
+        matchmaking.Matchmaking.pair_many(
+            'b', [(names[0], names[1]), (names[2], names[19])])
+        index = self.load()
+        self.assertEqual(set(names), index.registered)
+        self.assertEqual([names[1]], index.played(names[0]))
+        self.assertEqual([names[2]], index.played(names[19]))
+        self.assertEqual(
+            set(names[2:]), set(index.opponents_of(names[0])))
+
+        matchmaking.Matchmaking.unregister('b', names[19])
+        index = self.load()
+        self.assertNotIn(names[19], index.registered)
+        self.assertEqual([], index.played(names[2]))
+
+    def test_registering_again_does_not_write(self):
+        self.load()
+        matchmaking.Matchmaking.register('b', 'a')
+        key = matchmaking.GDefierMatchmakingEntity.make_key(
+            'b', matchmaking.shard_of('a'))
+        updated_on = matchmaking.GDefierMatchmakingEntity.get(key).updated_on
+        matchmaking.Matchmaking.register('b', 'a')
+        self.assertEqual(
+            updated_on,
+            matchmaking.GDefierMatchmakingEntity.get(key).updated_on)
+
+    def test_register_blocks_is_idempotent_and_repairs_index(self):
+        players = [_make_player('a'), _make_player('b')]
+        blocks = gDefier_model.register_blocks(players, ['x', 'y'])
+        self.assertEqual(4, len(blocks))
+        self.assertEqual(set(['a', 'b']), self.load('x').registered)
+
+        # An index update lost after the blocks were put.
+        matchmaking.Matchmaking.unregister('x', 'b')
+        self.assertEqual(set(['a']), self.load('x').registered)
+
+        again = gDefier_model.register_blocks(players, ['x', 'y'])
+        self.assertEqual(
+            [block.key() for block in blocks],
+            [block.key() for block in again])
+        self.assertEqual(4, gDefier_model.GDefierBlock.all().count())
+        self.assertEqual(set(['a', 'b']), self.load('x').registered)
+
+    def test_rebuild_replaces_index(self):
+        players = [_make_player('a'), _make_player('b')]
+        gDefier_model.register_blocks(players, ['x'])
+        matchmaking.Matchmaking.register('x', 'ghost')
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        matchmaking.Matchmaking.rebuild(
+            'x', gDefier_model._build_matchmaking_index)
+        self.assertEqual(set(['a', 'b']), self.load('x').registered)
+
+
+class StatsTestCase(actions.TestBase):
+
+    def setUp(self):  # pylint: disable-msg=g-bad-name
+        super(StatsTestCase, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.players = [_make_player('a'), _make_player('b')]
+        gDefier_model.register_blocks(self.players, ['x'])
+        self.targets = [str(alumn.key()) for alumn in self.players] + [
+            str(gDefier_model.GDefierBlock.make_key(alumn.key(), 'x'))
+            for alumn in self.players]
+
+    def tearDown(self):  # pylint: disable-msg=g-bad-name
+        config.Registry.test_overrides = {}
+        super(StatsTestCase, self).tearDown()
+
+    def end_defy(self):
+        defy = gDefier_model.GDefierDefy(
+            rname='a', lname='b', blockID='x', participants=['a', 'b'],
+            rscore=[50, 1, 0, 0], lscore=[20, 2, 1, 1])
+        defy.put()
+        ratings = [gDefier_model.elo.DEFAULT_RATING] * 4
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        unused_defy, batch = gDefier_model._end_defy(
+            defy.key(), 'right', 0, self.targets, ratings)
+        self.assertEqual(None, batch)
+        unused_defy, batch = gDefier_model._end_defy(
+            defy.key(), 'left', 0, self.targets, ratings)
+        stats.Stats.buffer(batch)
+        return defy
+
+    def test_ended_defy_writes_no_counter(self):
+        self.end_defy()
+        self.assertEqual(0, stats.GDefierStatShard.all().count())
+        self.assertEqual(1, stats.Stats.pending(self.targets[0])['wins'])
+        self.assertEqual(1, stats.Stats.pending(self.targets[1])['lost'])
+
+    def test_batch_flushed_before_it_is_buffered_is_counted_once(self):
+        defy = gDefier_model.GDefierDefy(
+            rname='a', lname='b', blockID='x', participants=['a', 'b'],
+            rscore=[50, 1, 0, 0], lscore=[20, 2, 1, 1])
+        defy.put()
+        ratings = [gDefier_model.elo.DEFAULT_RATING] * 4
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        gDefier_model._end_defy(defy.key(), 'right', 0, self.targets, ratings)
+        unused_defy, batch = gDefier_model._end_defy(
+            defy.key(), 'left', 0, self.targets, ratings)
+        self.assertEqual(1, stats.Stats.flush())
+        stats.Stats.buffer(batch)
+        self.assertEqual(1, stats.Stats.pending(self.targets[0])['wins'])
+        self.assertEqual(1, stats.Stats.pending(self.targets[0])['wins'])
+
+    def test_defy_ended_twice_is_counted_once(self):
+        defy = self.end_defy()
+        ratings = [gDefier_model.elo.DEFAULT_RATING] * 4
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        unused_defy, batch = gDefier_model._end_defy(
+            defy.key(), 'left', 0, self.targets, ratings)
+        self.assertEqual(None, batch)
+        gDefier_model.fold_stats('', 10)
+        alumn = gDefier_model.GDefierPlayer.get(self.players[0].key())
+        self.assertEqual(1, alumn.wins)
+        self.assertEqual(50, alumn.score)
+
+    def test_fold_materializes_totals_and_rankings(self):
+        leaderboard.Leaderboard.load('wins', gDefier_model.GDefierPlayer.all)
+        self.end_defy()
+        self.end_defy()
+        self.assertEqual(4, gDefier_model.fold_stats('', 10))
+
+        alumn = gDefier_model.GDefierPlayer.get(self.players[0].key())
+        self.assertEqual(2, alumn.wins)
+        self.assertEqual(100, alumn.score)
+        block = gDefier_model.GDefierBlock.get(
+            gDefier_model.GDefierBlock.make_key(alumn.key(), 'x'))
+        self.assertEqual(2, block.wins)
+        for target in self.targets:
+            self.assertEqual(stats.zero(), stats.Stats.pending(target))
+        ranking = leaderboard.Leaderboard.load(
+            'wins', gDefier_model.GDefierPlayer.all)
+        self.assertEqual(2, ranking.value_of('a'))
+        self.assertEqual(0, ranking.value_of('b'))
+
+        self.assertEqual(0, gDefier_model.fold_stats('', 10))
+        alumn = gDefier_model.GDefierPlayer.get(self.players[0].key())
+        self.assertEqual(2, alumn.wins)
+
+    def test_concurrent_fold_is_skipped(self):
+        self.end_defy()
+        token = stats.Stats.acquire_lease(60)
+        self.assertEqual(None, stats.Stats.acquire_lease(60))
+        self.assertEqual(0, gDefier_model.fold_stats('', 10))
+        self.assertEqual(
+            0, gDefier_model.GDefierPlayer.get(self.players[0].key()).wins)
+
+        stats.Stats.release_lease(token)
+        self.assertEqual(4, gDefier_model.fold_stats('', 10))
+        self.assertEqual(
+            1, gDefier_model.GDefierPlayer.get(self.players[0].key()).wins)
+
+    def test_fold_of_shard_applies_once(self):
+        self.end_defy()
+        stats.Stats.flush()
+        target = self.targets[0]
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        folds = [stats.Stats.fold(target, gDefier_model._fold_into_player)
+                 for unused_run in range(2)]
+        self.assertNotEqual(None, folds[0])
+        self.assertEqual(None, folds[1])
+        self.assertEqual(
+            1, gDefier_model.GDefierPlayer.get(self.players[0].key()).wins)
+
+
+class ArenaStateTestCase(actions.TestBase):
+
+    def setUp(self):  # pylint: disable-msg=g-bad-name
+        super(ArenaStateTestCase, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.defy = gDefier_model.GDefierDefy(
+            rname='a', lname='b', participants=['a', 'b'])
+        self.defy.put()
+
+    def tearDown(self):  # pylint: disable-msg=g-bad-name
+        config.Registry.test_overrides = {}
+        super(ArenaStateTestCase, self).tearDown()
+
+    def test_sync_keeps_rounds_advanced_concurrently(self):
+        loaded = arena.ArenaState.load(self.defy)
+        advanced = arena.ArenaState.advance(self.defy, 'right', 2)
+        self.assertEqual(loaded.version + 1, advanced.version)
+
+        # The defy was read before the round was advanced.
+        self.defy.lscore = [50, 1, 0, 0]
+        synced = arena.ArenaState.sync(self.defy)
+        self.assertEqual(advanced.version + 1, synced.version)
+        self.assertEqual(2, synced.round_of('right'))
+        self.assertEqual([50, 1, 0, 0], synced.to_dict()['lscore'])
+        self.assertEqual(
+            synced.to_dict(), arena.ArenaState.peek(self.defy.key()).to_dict())
+
+    def test_sync_creates_missing_state(self):
+        self.assertEqual(None, arena.ArenaState.peek(self.defy.key()))
+        synced = arena.ArenaState.sync(self.defy)
+        self.assertEqual(
+            synced.version, arena.ArenaState.peek(self.defy.key()).version)
+
+
+class MembershipTestCase(actions.TestBase):
+
+    def setUp(self):  # pylint: disable-msg=g-bad-name
+        super(MembershipTestCase, self).setUp()
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        self.group_key = gDefier_model.GDefierGroup(
+            key_name='g', name='g').put()
+        self.existing = gDefier_model.GDefierPlayer(
+            key_name='a', name='a', group=[self.group_key]).put()
+
+        # Queries do not see entities put from now on.
+        stub = self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME)
+        stub.SetConsistencyPolicy(
+            datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0))
+
+    def tearDown(self):  # pylint: disable-msg=g-bad-name
+        config.Registry.test_overrides = {}
+        super(MembershipTestCase, self).tearDown()
+
+    def create_player(self, name):
+        key = gDefier_model.GDefierPlayer(
+            key_name=name, name=name, group=[self.group_key]).put()
+        membership.Membership.add(self.group_key, [key])
+        return key
+
+    def member_keys(self):
+        return gDefier_model.get_member_keys(self.group_key)
+
+    def test_player_created_before_list_is_built_is_member(self):
+        key = self.create_player('b')
+        self.assertEqual(
+            sorted([self.existing, key]), sorted(self.member_keys()))
+
+    def test_player_created_after_list_is_built_is_member(self):
+        self.assertEqual([self.existing], self.member_keys())
+        key = self.create_player('b')
+        self.assertEqual(
+            sorted([self.existing, key]), sorted(self.member_keys()))
+
+    def test_removed_player_is_not_member_of_rebuilt_list(self):
+        self.member_keys()
+        membership.Membership.remove(self.group_key, [self.existing])
+        self.assertEqual([], self.member_keys())
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        models.MemcacheManager.delete(
+            membership.Membership._memcache_key(self.group_key))
+        self.assertEqual([], self.member_keys())
+
+
+class _AppContext(object):
+
+    def get_namespace_name(self):
+        return ''
+
+
+class TournamentTestCase(actions.TestBase):
+
+    def assert_valid_round(self, names, pairs):
+        paired = [name for pair in pairs for name in pair]
+        self.assertEqual(len(paired), len(set(paired)))
+        self.assertTrue(set(paired).issubset(set(names)))
+        self.assertTrue(len(names) - len(paired) <= 1)
+
+    def test_round_robin_pairs_every_player_once(self):
+        names = ['a', 'b', 'c', 'd', 'e']
+        rounds = tournament.round_robin(names)
+        self.assertEqual(5, len(rounds))
+        met = []
+        for pairs in rounds:
+            self.assert_valid_round(names, pairs)
+            met.extend([tuple(sorted(pair)) for pair in pairs])
+        self.assertEqual(10, len(met))
+        self.assertEqual(10, len(set(met)))
+
+    def test_swiss_pairs_similar_scores_and_avoids_rematches(self):
+        names = ['a', 'b', 'c', 'd']
+        scores = {'a': 3, 'b': 2, 'c': 1}
+        played = {'a': ['b'], 'b': ['a']}
+        pairs = tournament.swiss(
+            names, scores, lambda name: played.get(name, []))
+        self.assert_valid_round(names, pairs)
+        self.assertEqual([('a', 'c'), ('b', 'd')], pairs)
+
+    def test_retried_swiss_round_creates_same_defies(self):
+        names = ['a', 'b', 'c', 'd', 'e', 'f']
+        gDefier_model.register_blocks(
+            [_make_player(name) for name in names], ['x'])
+        # Treating as module-protected. pylint: disable-msg=protected-access
+        gDefier_model._create_board('', [{'block_title': 'x'}])
+        job = gDefier_model.ScheduleTournamentJob(
+            _AppContext(), 'x', tournament.SYSTEM_SWISS)
+
+        def fail(unused_self, unused_defies_created):
+            raise Exception('Interrupted.')
+
+        progress = tournament.GDefierTournament.progress
+        batch_size = gDefier_model.PUT_BATCH_SIZE
+        self.swap(tournament.GDefierTournament, 'progress', fail)
+        self.swap(gDefier_model, 'PUT_BATCH_SIZE', 1)
+        self.assertRaises(Exception, job.run)
+        self.swap(tournament.GDefierTournament, 'progress', progress)
+        self.swap(gDefier_model, 'PUT_BATCH_SIZE', batch_size)
+        self.assertEqual(1, gDefier_model.GDefierDefy.all().count())
+
+        self.assertEqual({'rounds': 1, 'defies': 3}, job.run())
+        defies = gDefier_model.GDefierDefy.all().fetch(10)
+        self.assertEqual(3, len(defies))
+        self.assert_valid_round(
+            names, [(defy.rname, defy.lname) for defy in defies])
+        record = tournament.GDefierTournament.get_by_key_name('x')
+        self.assertEqual(1, record.rounds)
+        self.assertEqual(None, record.scheduling_pairs())
@@ -22,6 +22,7 @@ import copy
 import cStringIO
 import csv
 import datetime
+import gzip
 import logging
 import os
 import re
@@ -60,7 +61,9 @@ from controllers_review import PeerReviewDashboardTest
 from review_stats import PeerReviewAnalyticsTest
 from google.appengine.api import memcache
 from google.appengine.api import namespace_manager
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import db
+from google.appengine.ext import testbed
 
 
 # A number of data files in a test course.
@@ -740,6 +743,153 @@ class InfrastructureTest(actions.TestBase):
             u'/assets/js/foo.js', u'/assets/js/bar.js', u'/assets/js/baz.js'])
         assert not fs.list('/foo/bar')
 
+        # Check paged file listing.
+        files, cursor = fs.impl.list_page('/assets', limit=2)
+        assert files == [u'/assets/js/bar.js', u'/assets/js/baz.js']
+        files, cursor = fs.impl.list_page('/assets', cursor=cursor, limit=2)
+        assert files == [u'/assets/js/foo.js']
+        assert not cursor
+
+    def test_datastore_backed_file_system_cached_listing(self):
+        """Tests cached file listings are refreshed when files change."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        try:
+            fs = vfs.AbstractFileSystem(vfs.DatastoreBackedFileSystem('', '/'))
+            fs.put('/assets/a.js', vfs.string_to_stream(u'a'))
+            assert fs.list('/assets') == [u'/assets/a.js']
+
+            fs.put('/assets/b.js', vfs.string_to_stream(u'b'))
+            assert fs.list('/assets') == [u'/assets/a.js', u'/assets/b.js']
+
+            fs.delete('/assets/a.js')
+            assert fs.list('/assets') == [u'/assets/b.js']
+        finally:
+            config.Registry.test_overrides = {}
+
+    def test_datastore_backed_file_system_manifest(self):
+        """Tests existence checks are answered by the manifest of a course."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        try:
+            fs = vfs.AbstractFileSystem(vfs.DatastoreBackedFileSystem('', '/'))
+            fs.put('/views/a.html', vfs.string_to_stream(u'a'))
+            assert fs.isfile('/views/a.html')
+            assert not fs.isfile('/views/b.html')
+            assert fs.impl._get_manifest() == set([u'/views/a.html'])
+
+            # Check files in the manifest are found without reading the
+            # datastore.
+            vfs.FileMetadataEntity.get_by_key_name('/views/a.html').delete()
+            assert fs.isfile('/views/a.html')
+
+            # Check the manifest is kept up to date when files change.
+            fs.delete('/views/a.html')
+            fs.put('/views/b.html', vfs.string_to_stream(u'b'))
+            assert fs.impl._get_manifest() == set([u'/views/b.html'])
+            assert not fs.isfile('/views/a.html')
+            assert fs.isfile('/views/b.html')
+            assert fs.impl.get_multi(
+                ['/views/a.html', '/views/b.html']).keys() == ['/views/b.html']
+        finally:
+            config.Registry.test_overrides = {}
+
+    def test_datastore_backed_file_system_manifest_eventual_consistency(self):
+        """Tests files missing from a manifest being built are still found."""
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        try:
+            # Queries do not see entities put from now on.
+            stub = self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME)
+            stub.SetConsistencyPolicy(
+                datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                    probability=0))
+
+            fs = vfs.AbstractFileSystem(vfs.DatastoreBackedFileSystem('', '/'))
+            fs.put('/gDefier.yaml', vfs.string_to_stream(u'enabled: true'))
+
+            # Check the recent files are applied to the manifest built.
+            assert fs.impl._get_manifest() == set([u'/gDefier.yaml'])
+            assert fs.isfile('/gDefier.yaml')
+
+            # Check the copy kept in memory is used while the version holds.
+            memcache.delete_multi([
+                vfs.DatastoreBackedFileSystem.MANIFEST_KEY,
+                vfs.DatastoreBackedFileSystem.MANIFEST_RECENT_KEY],
+                namespace='')
+            assert fs.impl._get_manifest() == set([u'/gDefier.yaml'])
+
+            # Check a file missing from the manifest is looked up by key.
+            memcache.delete(
+                vfs.DatastoreBackedFileSystem.MANIFEST_VERSION_KEY,
+                namespace='')
+            assert fs.impl._get_manifest() == set()
+            assert fs.isfile('/gDefier.yaml')
+            assert fs.get('/gDefier.yaml').read() == 'enabled: true'
+        finally:
+            config.Registry.test_overrides = {}
+
+    def test_datastore_backed_file_system_chunked_file(self):
+        """Tests large files are stored in chunks and read in ranges."""
+        old_chunk_size = vfs.FILE_CHUNK_SIZE
+        vfs.FILE_CHUNK_SIZE = 4
+        config.Registry.test_overrides[models.CAN_USE_MEMCACHE.name] = True
+        try:
+            fs = vfs.AbstractFileSystem(vfs.DatastoreBackedFileSystem('', '/'))
+            fs.put('/assets/big.bin', vfs.string_to_stream(u'0123456789'))
+            stored = fs.open('/assets/big.bin')
+            assert stored.metadata.size == 10
+            assert stored.read_range(3, 9) == '345678'
+            assert stored.read() == '0123456789'
+            assert not stored.read()
+            assert count_blob_entities(vfs.FileBlobChunkEntity) == 3
+
+            # Check new content replaces old chunks.
+            fs.put('/assets/big.bin', vfs.string_to_stream(u'abcdef'))
+            assert fs.open('/assets/big.bin').read() == 'abcdef'
+            assert count_blob_entities(vfs.FileBlobChunkEntity) == 2
+
+            fs.delete('/assets/big.bin')
+            assert not fs.isfile('/assets/big.bin')
+            assert not count_blob_entities(vfs.FileBlobChunkEntity)
+        finally:
+            vfs.FILE_CHUNK_SIZE = old_chunk_size
+            config.Registry.test_overrides = {}
+
+    def test_datastore_backed_file_system_shares_blobs(self):
+        """Tests files with the same content share one blob across courses."""
+        fs_a = vfs.AbstractFileSystem(vfs.DatastoreBackedFileSystem('a', '/'))
+        fs_b = vfs.AbstractFileSystem(vfs.DatastoreBackedFileSystem('b', '/'))
+        fs_a.put('/assets/logo.png', vfs.string_to_stream(u'logo'))
+        fs_b.put('/assets/logo.png', vfs.string_to_stream(u'logo'))
+        assert count_blob_entities(vfs.FileBlobEntity) == 1
+
+        # Check copying a file only adds a reference to its blob.
+        fs_b.put('/assets/copy.png', fs_a.open('/assets/logo.png'))
+        assert fs_b.get('/assets/copy.png') == 'logo'
+        assert count_blob_entities(vfs.FileBlobEntity) == 1
+
+        # Check the blob is deleted with the last file referring to it.
+        fs_a.delete('/assets/logo.png')
+        fs_b.delete('/assets/logo.png')
+        assert fs_b.get('/assets/copy.png') == 'logo'
+        fs_b.put('/assets/copy.png', vfs.string_to_stream(u'other'))
+        assert count_blob_entities(vfs.FileBlobEntity) == 1
+        fs_b.delete('/assets/copy.png')
+        assert not count_blob_entities(vfs.FileBlobEntity)
+        assert not count_blob_entities(vfs.FileBlobChunkEntity)
+
+    def test_parse_range(self):
+        """Tests parsing of Range headers of static resources."""
+        parse = sites.parse_range
+        assert parse(None, 10) is None
+        assert parse('bytes=0-', 10) == (0, 10)
+        assert parse('bytes=2-4', 10) == (2, 5)
+        assert parse('bytes=5-100', 10) == (5, 10)
+        assert parse('bytes=-3', 10) == (7, 10)
+        assert parse('bytes=-30', 10) == (0, 10)
+        assert parse('bytes=0-1,4-5', 10) is None
+        assert parse('bytes=a-b', 10) is None
+        assert parse('items=0-1', 10) is None
+        self.assertRaises(ValueError, parse, 'bytes=10-', 10)
+
     def test_utf8_datastore(self):
         """Test writing to and reading from datastore using UTF-8 content."""
         event = models.EventEntity()
@@ -1059,6 +1209,9 @@ class AdminAspectTest(actions.TestBase):
         assert_contains('gcb-admin-uptime-sec:', response.body)
         assert_contains('In-process Performance Counters', response.body)
 
+        response = self.testapp.get('/admin?action=cache')
+        assert_contains('Memcache Usage by Key Prefix', response.body)
+
         response = self.testapp.get('/admin?action=deployment')
         assert_contains('application_id: testbed-test', response.body)
         assert_contains('About the Application', response.body)
@@ -1799,6 +1952,44 @@ class StaticHandlerTest(actions.TestBase):
         assert_contains('public', response.headers['Cache-Control'])
         assert_does_not_contain('no-cache', response.headers['Cache-Control'])
 
+    def test_static_files_conditional_get(self):
+        """Test static/zip handlers answer requests for unchanged files."""
+        for url in [
+            '/assets/css/main.css',
+            '/static/inputex-3.1.0/src/inputex/assets/skins/sam/inputex.css']:
+            response = self.testapp.get(url)
+            etag = response.headers['ETag']
+            assert etag
+
+            response = self.testapp.get(
+                url, headers={'If-None-Match': etag}, status=304)
+            assert not response.body
+
+            response = self.testapp.get(
+                url, headers={'If-None-Match': '"other"'})
+            assert_equals(response.status_int, 200)
+
+    def test_static_files_range_and_gzip(self):
+        """Test static handler serves byte ranges and compressed text."""
+        body = self.testapp.get('/assets/css/main.css').body
+
+        response = self.testapp.get(
+            '/assets/css/main.css', headers={'Range': 'bytes=0-9'}, status=206)
+        assert_equals(response.body, body[:10])
+        assert_equals(
+            response.headers['Content-Range'], 'bytes 0-9/%s' % len(body))
+
+        self.testapp.get(
+            '/assets/css/main.css',
+            headers={'Range': 'bytes=%s-' % len(body)}, status=416)
+
+        response = self.testapp.get(
+            '/assets/css/main.css', headers={'Accept-Encoding': 'gzip'})
+        assert_equals(response.headers['Content-Encoding'], 'gzip')
+        assert_equals(
+            gzip.GzipFile(fileobj=cStringIO.StringIO(response.body)).read(),
+            body)
+
 
 class ActivityTest(actions.TestBase):
     """Test for activities."""
@@ -2166,6 +2357,16 @@ class AssessmentTest(actions.TestBase):
             namespace_manager.set_namespace(old_namespace)
 
 
+def count_blob_entities(entity_class):
+    """Counts entities of the blob store shared by all courses."""
+    old_namespace = namespace_manager.get_namespace()
+    try:
+        namespace_manager.set_namespace(vfs.BLOB_NAMESPACE)
+        return entity_class.all().count()
+    finally:
+        namespace_manager.set_namespace(old_namespace)
+
+
 def remove_dir(dir_name):
     """Delete a directory."""
 
@@ -3208,10 +3409,10 @@ class EtlMainTestCase(DatastoreBackedCourseTest):
         old_namespace = namespace_manager.get_namespace()
         try:
             namespace_manager.set_namespace(context.get_namespace_name())
-            self.assertTrue(vfs.FileDataEntity.all().get())
             self.assertTrue(vfs.FileMetadataEntity.all().get())
         finally:
             namespace_manager.set_namespace(old_namespace)
+        self.assertTrue(count_blob_entities(vfs.FileBlobEntity))
 
         # Delete against a datastore with contents runs successfully.
         etl.main(self.delete_datastore_args, environment_class=FakeEnvironment)
@@ -3219,11 +3420,14 @@ class EtlMainTestCase(DatastoreBackedCourseTest):
         # Spot check that those kinds are now empty.
         try:
             namespace_manager.set_namespace(context.get_namespace_name())
-            self.assertFalse(vfs.FileDataEntity.all().get())
             self.assertFalse(vfs.FileMetadataEntity.all().get())
         finally:
             namespace_manager.set_namespace(old_namespace)
 
+        # Check the content of the course was released from the blob store.
+        self.assertFalse(count_blob_entities(vfs.FileBlobEntity))
+        self.assertFalse(count_blob_entities(vfs.FileBlobChunkEntity))
+
         # Delete against a datastore without contents runs successfully.
         etl.main(self.delete_datastore_args, environment_class=FakeEnvironment)
 
@@ -3331,6 +3535,47 @@ class EtlMainTestCase(DatastoreBackedCourseTest):
             [model.key().name() for model in [first_entity, second_entity]],
             [entity['key.name'] for entity in entities])
 
+    def test_download_datastore_includes_file_content(self):
+        """Tests file content stored as shared blobs is downloaded."""
+        download_datastore_args = etl.PARSER.parse_args(
+            [etl._MODE_DOWNLOAD] + self.common_datastore_args +
+            ['--datastore_types', 'FileMetadataEntity'])
+        context = etl_lib.get_context(download_datastore_args.course_url_prefix)
+        path = os.path.join(appengine_config.BUNDLE_ROOT, 'assets/a.txt')
+        context.fs.impl.put(path, etl._ReadWrapper('content'))
+
+        etl.main(download_datastore_args, environment_class=FakeEnvironment)
+        archive = etl._Archive(self.archive_path)
+        archive.open('r')
+        rows = transforms.loads(
+            archive.get(archive.manifest.entities[0].path))['rows']
+        self.assertEqual(
+            ['content'], [row['data'] for row in rows
+                          if row['key.name'] == path])
+
+    def test_download_delete_and_upload_course_round_trips_content(self):
+        """Tests file content survives deleting and uploading a course."""
+        self.upload_all_sample_course_files([])
+        self.import_sample_course()
+        context = etl_lib.get_context(self.url_prefix)
+        path = os.path.join(appengine_config.BUNDLE_ROOT, 'assets/a.bin')
+        content = ''.join([chr(i) for i in range(256)])
+        context.fs.impl.put(path, etl._ReadWrapper(content))
+        etl.main(self.download_course_args, environment_class=FakeEnvironment)
+
+        self.swap(
+            etl, '_raw_input',
+            lambda x: etl._DELETE_DATASTORE_CONFIRMATION_INPUT)
+        etl.main(self.delete_datastore_args, environment_class=FakeEnvironment)
+        self.assertFalse(count_blob_entities(vfs.FileBlobEntity))
+
+        sites.reset_courses()
+        self.create_empty_course(self.raw)
+        etl.main(self.upload_course_args, environment_class=FakeEnvironment)
+        context = etl_lib.get_context(self.url_prefix)
+        self.assertEqual(content, context.fs.impl.get(path).read())
+        self.assertTrue(count_blob_entities(vfs.FileBlobEntity))
+
     def test_download_datastore_with_privacy_maintains_references(self):
         """Test download of datastore data and archive creation."""
         unsafe_user_id = '1'
@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Performance test for a peer review system.
+"""Performance tests for a peer review system and for the G-Defier module.
 
 WARNING! Use this script to test load Course Builder. This is very dangerous
 feature, be careful, because anyone can impersonate super user of your Course
@@ -31,6 +31,15 @@ Here is how to run:
         --start_uid=1 \
         http://mycourse.appspot.com
 
+To load test G-Defier, use a course with the G-Defier module enabled and pass
+the title of one of its blocks; students are paired up, so use an even number
+of threads:
+        python tests/integration/load_test.py \
+        --scenario=gdefier \
+        --gdefier_block="Block 1" \
+        --thread_count=20 \
+        http://localhost:8080/mycourse_DFR
+
 """
 
 __author__ = 'Pavel Simakov (psimakov@google.com)'
@@ -69,6 +78,14 @@ PARSER.add_argument(
     'iteration acts as a unique user with the uid equal to:'
     'start_uid + thread_count * iteration_index.',
     default=1, type=int)
+PARSER.add_argument(
+    '--scenario',
+    help='Test scenario to execute.', default='peer_review',
+    choices=['peer_review', 'gdefier'], type=str)
+PARSER.add_argument(
+    '--gdefier_block',
+    help='Title of the G-Defier block the gdefier scenario plays in.',
+    default=None, type=str)
 
 
 def assert_contains(needle, haystack):
@@ -99,6 +116,9 @@ class WebSession(object):
     PROGRESS_BATCH = 10
     RESPONSE_TIME_HISTOGRAM = [0, 0, 0, 0, 0, 0]
 
+    # Per endpoint path: [request count, total duration, histogram].
+    ENDPOINT_STATS = {}
+
     def __init__(self, uid, common_headers=None):
         if common_headers is None:
             common_headers = {}
@@ -112,19 +132,41 @@ class WebSession(object):
         cls.RESPONSE_TIME_HISTOGRAM[index] += 1
 
     @classmethod
-    def update_duration(cls, duration):
+    def duration_bucket(cls, duration):
         if duration > 30:
-            cls.increment_duration_bucket(0)
+            return 0
         elif duration > 15:
-            cls.increment_duration_bucket(1)
+            return 1
         elif duration > 7:
-            cls.increment_duration_bucket(2)
+            return 2
         elif duration > 3:
-            cls.increment_duration_bucket(3)
+            return 3
         elif duration > 1:
-            cls.increment_duration_bucket(4)
+            return 4
         else:
-            cls.increment_duration_bucket(5)
+            return 5
+
+    @classmethod
+    def update_duration(cls, duration):
+        cls.increment_duration_bucket(cls.duration_bucket(duration))
+
+    @classmethod
+    def update_endpoint_duration(cls, endpoint, duration):
+        stats = cls.ENDPOINT_STATS.setdefault(
+            endpoint, [0, 0.0, [0, 0, 0, 0, 0, 0]])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2][cls.duration_bucket(duration)] += 1
+
+    @classmethod
+    def log_endpoints(cls, elapsed):
+        """Logs latency and throughput of every endpoint requested."""
+        for endpoint in sorted(cls.ENDPOINT_STATS.keys()):
+            count, total, histogram = cls.ENDPOINT_STATS[endpoint]
+            logging.info(
+                '%s: requests:%s, avg(s):%.3f, rps:%.2f, SLA:%s',
+                endpoint, count, total / count, count / max(elapsed, 1e-6),
+                histogram)
 
     @classmethod
     def log_progress(cls, force=False):
@@ -158,6 +200,7 @@ class WebSession(object):
 
     def open(self, request, hint):
         """Executes any HTTP request."""
+        endpoint = urllib2.urlparse.urlparse(request.get_full_url()).path
         start_time = time.time()
         try:
             try_count = 0
@@ -179,8 +222,11 @@ class WebSession(object):
                 'Error in session %s executing: %s', self.uid, hint)
             raise e
         finally:
+            duration = time.time() - start_time
             with WebSession.PROGRESS_LOCK:
-                self.update_duration(time.time() - start_time)
+                self.update_duration(duration)
+                self.update_endpoint_duration(
+                    '%s %s' % (request.get_method(), endpoint), duration)
 
     def get(self, url, expected_code=200):
         """HTTP GET."""
@@ -261,8 +307,8 @@ class TaskThread(threading.Thread):
             raise self.exc_info[1], None, self.exc_info[2]
 
 
-class PeerReviewLoadTest(object):
-    """A peer review load test."""
+class StudentLoadTest(object):
+    """A base class of load tests where every thread acts as a student."""
 
     def __init__(self, base_url, uid):
         self.uid = uid
@@ -279,13 +325,6 @@ class PeerReviewLoadTest(object):
             uid=uid,
             common_headers={'Gcb-Impersonate': json.dumps(impersonate_header)})
 
-    def run(self):
-        self.register_if_has_to()
-        self.submit_peer_review_assessment_if_possible()
-
-        while self.count_completed_reviews() < 2:
-            self.request_and_do_a_review()
-
     def get_hidden_field(self, name, body):
         # The "\s*" denotes arbitrary whitespace; sometimes, this tag is split
         # across multiple lines in the HTML.
@@ -299,19 +338,6 @@ class PeerReviewLoadTest(object):
         reg = re.compile('%s = \'([^\']*)\';\n' % name)
         return reg.search(body).group(1)
 
-    def get_draft_review_url(self, body):
-        """Returns the URL of a draft review on the review dashboard."""
-        # The "\s*" denotes arbitrary whitespace; sometimes, this tag is split
-        # across multiple lines in the HTML.
-        # pylint: disable-msg=anomalous-backslash-in-string
-        reg = re.compile(
-            '<a href="([^"]*)">Assignment [0-9]+</a>\s*\(Draft\)')
-        # pylint: enable-msg=anomalous-backslash-in-string
-        result = reg.search(body)
-        if result is None:
-            return None
-        return result.group(1)
-
     def register_if_has_to(self):
         """Performs student registration action."""
         body = self.session.get('%s/' % self.host)
@@ -334,6 +360,30 @@ class PeerReviewLoadTest(object):
 
         return True
 
+
+class PeerReviewLoadTest(StudentLoadTest):
+    """A peer review load test."""
+
+    def run(self):
+        self.register_if_has_to()
+        self.submit_peer_review_assessment_if_possible()
+
+        while self.count_completed_reviews() < 2:
+            self.request_and_do_a_review()
+
+    def get_draft_review_url(self, body):
+        """Returns the URL of a draft review on the review dashboard."""
+        # The "\s*" denotes arbitrary whitespace; sometimes, this tag is split
+        # across multiple lines in the HTML.
+        # pylint: disable-msg=anomalous-backslash-in-string
+        reg = re.compile(
+            '<a href="([^"]*)">Assignment [0-9]+</a>\s*\(Draft\)')
+        # pylint: enable-msg=anomalous-backslash-in-string
+        result = reg.search(body)
+        if result is None:
+            return None
+        return result.group(1)
+
     def submit_peer_review_assessment_if_possible(self):
         """Submits the peer review assessment."""
         body = self.session.get(
@@ -437,10 +487,151 @@ class PeerReviewLoadTest(object):
         return num_completed
 
 
+class GDefierLoadTest(StudentLoadTest):
+    """A G-Defier load test.
+
+    Threads play in pairs: the first student of a pair invites the second one,
+    which accepts; then both play all rounds of the defy, answer a question
+    every round, end the defy and read the rankings.
+    """
+
+    # Defy keys of every pair of students, keyed by the uid of the inviter.
+    PAIRS_LOCK = threading.Lock()
+    PAIRS = {}
+
+    # Seconds a student waits for the other student of its pair.
+    PAIR_TIMEOUT_SEC = 120
+
+    def __init__(self, base_url, uid, partner_uid, block):
+        super(GDefierLoadTest, self).__init__(base_url, uid)
+        self.partner_uid = partner_uid
+        self.partner_email = 'load_test_bot_%s@example.com' % partner_uid
+        self.block = block
+        self.is_inviter = uid < partner_uid
+        inviter_uid = min(uid, partner_uid)
+        with GDefierLoadTest.PAIRS_LOCK:
+            self.pair = GDefierLoadTest.PAIRS.setdefault(
+                inviter_uid, {
+                    'registered': threading.Event(),
+                    'invited': threading.Event(),
+                    'accepted': threading.Event()})
+
+    def run(self):
+        self.register_if_has_to()
+        self.register_in_gdefier()
+        defy_key = self.start_defy()
+        self.play_defy(defy_key)
+        self.read_rankings()
+
+    def block_url(self, extra=''):
+        return '%s/gDefier/block?%s%s' % (
+            self.host, urllib.urlencode({'title': self.block}), extra)
+
+    def wait_for(self, event, what):
+        if not event.wait(GDefierLoadTest.PAIR_TIMEOUT_SEC):
+            raise Exception('Timed out waiting for %s of %s.' % (
+                what, self.partner_email))
+
+    def register_in_gdefier(self):
+        """Creates the player and registers it in all blocks."""
+        self.session.get('%s/gDefier/register' % self.host)
+        self.session.post('%s/gDefier/register' % self.host, {})
+        body = self.session.get('%s/gDefier/home' % self.host)
+        assert_does_not_contain('disabled_gDefier_module', body)
+        body = self.session.get(self.block_url())
+        assert_contains(self.block, body)
+
+    def get_defy_key(self, body):
+        reg = re.compile(
+            r'<a href="gDefier/arena\?defy=([^"]*)">%s</a>' % re.escape(
+                self.partner_email))
+        result = reg.search(body)
+        if result is None:
+            return None
+        return result.group(1)
+
+    def start_defy(self):
+        """Invites or accepts the other student of the pair."""
+        if self.is_inviter:
+            self.wait_for(self.pair['registered'], 'registration')
+            self.session.get(self.block_url(
+                '&' + urllib.urlencode({'request': self.partner_email})))
+            self.pair['invited'].set()
+            self.wait_for(self.pair['accepted'], 'acceptance')
+        else:
+            self.pair['registered'].set()
+            self.wait_for(self.pair['invited'], 'invitation')
+            self.session.get(self.block_url(
+                '&' + urllib.urlencode({'accept': self.partner_email})))
+            self.pair['accepted'].set()
+
+        body = self.session.get(self.block_url())
+        defy_key = self.get_defy_key(body)
+        if not defy_key:
+            raise Exception('No defy with %s found.' % self.partner_email)
+        return defy_key
+
+    def get_state_version(self, body):
+        return int(re.search(r'var state_version = (\d+);', body).group(1))
+
+    def play_defy(self, defy_key):
+        """Plays all rounds, answering one question per round."""
+        arena_url = '%s/gDefier/arena?%s' % (
+            self.host, urllib.urlencode({'defy': defy_key}))
+        body = self.session.get(arena_url)
+        side = re.search(r'side: "(right|left)"', body).group(1)
+        rounds = int(re.search(r'var rounds = "(\d+)";', body).group(1))
+        version = self.get_state_version(body)
+
+        for number in range(1, rounds + 1):
+            if number < rounds:
+                self.session.post(
+                    arena_url, {'button': number, 'side': side})
+            self.answer_question(defy_key, arena_url, number)
+            state_url = '%s/gDefier/arena/state?%s' % (
+                self.host, urllib.urlencode(
+                    {'defy': defy_key, 'version': version}))
+            response = self.session.get(state_url)
+            if response:
+                payload = json.loads(json.loads(
+                    response[response.index('\n') + 1:])['payload'])
+                version = payload['version']
+
+        self.session.get(arena_url + '&end=' + side)
+
+    def answer_question(self, defy_key, arena_url, number):
+        """Submits a passed Khan exercise answer given in the arena."""
+        audit = {
+            'pass': True,
+            'count_hints': random.randint(0, 1),
+            'attempt_number': random.randint(1, 2),
+            'location': urllib.quote(
+                'ity_ef_origin=%s' % urllib.quote(arena_url)),
+            'round': number}
+        self.session.post(
+            '%s/khan-exercises/khan-exercises/indirect/' % self.host,
+            {'ity_ef_audit': json.dumps(audit), 'defy': defy_key})
+
+    def read_rankings(self):
+        """Reads the rankings the way the G-Defier home page does."""
+        body = self.session.get(
+            '%s/gDefier/leaderboard?metric=score' % self.host)
+        assert_contains('Success.', body)
+        for classification in ['wins', 'lost', 'score']:
+            self.session.post(
+                '%s/gDefier/home' % self.host,
+                {'classification': classification})
+
+
 def run_all(args):
     """Runs test scenario in multiple threads."""
     if args.thread_count < 1 or args.thread_count > 256:
         raise Exception('Please use between 1 and 256 threads.')
+    if args.scenario == 'gdefier':
+        if args.thread_count % 2:
+            raise Exception('Please use an even number of threads.')
+        if not args.gdefier_block:
+            raise Exception('Please specify --gdefier_block.')
 
     start_time = time.time()
     logging.info('Started testing: %s', args.base_url)
@@ -448,6 +639,7 @@ def run_all(args):
     logging.info('start_uid: %s', args.start_uid)
     logging.info('thread_count: %s', args.thread_count)
     logging.info('iteration_count: %s', args.iteration_count)
+    logging.info('scenario: %s', args.scenario)
     logging.info('SLAs are [>30s, >15s, >7s, >3s, >1s, <1s]')
     try:
         for iteration_index in range(0, args.iteration_count):
@@ -455,14 +647,19 @@ def run_all(args):
             tasks = []
             WebSession.PROGRESS_BATCH = args.thread_count
             for index in range(0, args.thread_count):
-                test = PeerReviewLoadTest(
-                    args.base_url,
-                    (
-                        args.start_uid +
-                        iteration_index * args.thread_count +
-                        index))
+                uid = (
+                    args.start_uid +
+                    iteration_index * args.thread_count +
+                    index)
+                if args.scenario == 'gdefier':
+                    # Pair every even thread with the next odd one.
+                    partner_uid = uid + 1 if index % 2 == 0 else uid - 1
+                    test = GDefierLoadTest(
+                        args.base_url, uid, partner_uid, args.gdefier_block)
+                else:
+                    test = PeerReviewLoadTest(args.base_url, uid)
                 task = TaskThread(
-                    test.run, name='PeerReviewLoadTest-%s' % index)
+                    test.run, name='%s-%s' % (test.__class__.__name__, index))
                 tasks.append(task)
             try:
                 TaskThread.execute_task_list(tasks)
@@ -471,6 +668,7 @@ def run_all(args):
                 raise e
     finally:
         WebSession.log_progress(force=True)
+        WebSession.log_endpoints(time.time() - start_time)
         logging.info('Done! Duration (s): %s', time.time() - start_time)
 
 
@@ -110,6 +110,7 @@ __author__ = [
 ]
 
 import argparse
+import base64
 import functools
 import hashlib
 import hmac
@@ -489,13 +490,23 @@ def _delete_datastore(context, batch_size):
 
     for model_class in model_classes:
         _LOG.info('Deleting entities of kind %s', model_class.kind())
-        _process_models(model_class, batch_size, delete=True)
+        if model_class.kind() == vfs.FileMetadataEntity.kind():
+            # File content is in a blob store shared by all courses; release
+            # it along with the files.
+            _process_models(
+                model_class, batch_size, model_map_fn=_delete_file)
+        else:
+            _process_models(model_class, batch_size, delete=True)
 
     _LOG.info('Flushing all caches')
     memcache.flush_all()
     _LOG.info('Done')
 
 
+def _delete_file(metadata):
+    vfs.delete_file_entities([metadata])
+
+
 def _die(message, with_trace=False):
     if with_trace:  # Also logs most recent traceback.
         info = sys.exc_info()
@@ -585,8 +596,11 @@ def _download_datastore(
             found_type, json_path)
         json_file = transforms.JsonFile(json_path)
         json_file.open('w')
+        write_fn = _write_model_to_json_file
+        if found_type == vfs.FileMetadataEntity.kind():
+            write_fn = _write_file_to_json_file
         model_map_fn = functools.partial(
-            _write_model_to_json_file, json_file, privacy_transform_fn)
+            write_fn, json_file, privacy_transform_fn)
         _process_models(
             db.class_for_kind(found_type), batch_size,
             model_map_fn=model_map_fn)
@@ -780,8 +794,8 @@ def _clear_course_cache(context):
 @_retry(message='Checking if the specified course is empty failed; retrying')
 def _context_is_for_empty_course(context):
     # True if course is entirely empty or contains only a course.yaml.
-    current_course_files = context.fs.impl.list(
-        appengine_config.BUNDLE_ROOT)
+    current_course_files, _ = context.fs.impl.list_page(
+        appengine_config.BUNDLE_ROOT, limit=2)
     empty_course_files = [os.path.join(
         appengine_config.BUNDLE_ROOT, _COURSE_YAML_PATH_SUFFIX)]
     return (
@@ -996,6 +1010,22 @@ def _write_model_to_json_file(json_file, privacy_transform_fn, model):
     json_file.write(transforms.dict_to_json(entity_dict, None))
 
 
+def _write_file_to_json_file(json_file, privacy_transform_fn, model):
+    """Writes a FileMetadataEntity with the content of its blob, if any."""
+    entity_dict = _get_entity_dict(model, privacy_transform_fn)
+    if model.blob_hash:
+        # Same encoding as transforms.entity_to_dict uses for raw bytes.
+        data = vfs.ChunkedFileStream(model).read()
+        try:
+            entity_dict['data'] = data.encode('utf-8')
+        except UnicodeDecodeError:
+            entity_dict['data'] = {
+                'type': 'binary',
+                'encoding': 'base64',
+                'content': base64.urlsafe_b64encode(data)}
+    json_file.write(transforms.dict_to_json(entity_dict, None))
+
+
 def main(parsed_args, environment_class=None):
     """Performs the requested ETL operation.
 